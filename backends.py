@@ -0,0 +1,248 @@
+'''
+Embedded DuckDB backend, to run create_tables.py, etl.py and check_tables.py offline.
+
+The pool hands out connections to a local DuckDB database file that behave like the psycopg2
+ones of connections.py: a transaction is opened by the first statement and ended by commit or
+rollback, the statements are timed per stage, and the placeholders and the Redshift dialect of
+sql_queries.py are translated by dialects.py.
+
+A COPY reads the local files standing in for its S3 source: s3://bucket/key is read from
+<data_dir>/key, or <data_dir>/<file name> when the key path does not exist there. A prefix
+loads every file under it and a manifest is a local JSON file listing S3 URLs.
+The files of generate_data.py are loaded with:
+
+    [DB]
+    backend = duckdb
+
+    [LOCAL]
+    database = dwh.duckdb
+    data_dir = data/
+
+    [S3]
+    liquor_sales_data = 's3://local/Iowa_Liquor_Sales.csv'
+'''
+
+import glob
+import json
+import os
+import re
+import threading
+import time
+import connections
+import dialects
+
+# COPY of one local file, the options of a Redshift COPY as DuckDB options
+copy_local_file = "COPY {} FROM '{}' ({})"
+
+select_table_exists = ("SELECT COUNT(*) FROM information_schema.tables "
+                       "WHERE table_schema = current_schema() AND table_name = ?")
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        raise SystemExit('The duckdb backend needs the duckdb package: pip install duckdb')
+    return duckdb
+
+
+def s3_key(url):
+    '''
+    Returns the key of an s3://bucket/key URL, or the URL itself when it is a local path
+    '''
+    if url.startswith('s3://'):
+        return url[len('s3://'):].partition('/')[2]
+    return url
+
+
+class DuckDBCursor:
+    '''
+    A cursor translating the statements for DuckDB and reporting their time to its connection
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self.description = None
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.result = None
+
+    def copy_statements(self, copy):
+        '''
+        Returns the DuckDB COPY of every local file of a Redshift COPY and the bytes of the files
+        '''
+        options = ['FORMAT {}'.format(copy['format'])]
+        if copy['format'] == 'csv':
+            options.append('HEADER {}'.format('true' if copy['header'] else 'false'))
+        if copy['date_format']:
+            options.append('DATEFORMAT {}'.format(dialects.quote(copy['date_format'])))
+        if copy['compression']:
+            options.append('COMPRESSION {}'.format(copy['compression']))
+        paths = self.connection.pool.local_files(copy['source'], copy['manifest'])
+        target = copy['table'] + (' ' + copy['columns'] if copy['columns'] else '')
+        return ([copy_local_file.format(target, path.replace("'", "''"), ', '.join(options)) for path in paths],
+                sum(os.path.getsize(path) for path in paths))
+
+    def translate(self, query):
+        '''
+        Returns the DuckDB statements of a Redshift statement and the bytes it loads
+        '''
+        copy = dialects.parse_copy(query)
+        if copy:
+            return self.copy_statements(copy)
+        create = re.match(r'\s*CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS\s+(\w+)', query, re.IGNORECASE)
+        if create and self.connection.duckdb.execute(select_table_exists, [create.group(1).lower()]).fetchone()[0]:
+            # Nothing to create, and the sequences of the existing table must not be reset
+            return [], None
+        return dialects.to_duckdb(query), None
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        self.result, self.rowcount, self.description = None, -1, None
+        try:
+            statements, loaded = self.translate(query)
+            self.connection.begin()
+            for statement in statements:
+                statement, params = dialects.to_duckdb_params(statement, vars)
+                result = self.connection.duckdb.execute(statement, params)
+                if re.match(r'\s*(INSERT|UPDATE|DELETE|COPY)\b', statement, re.IGNORECASE):
+                    # DuckDB returns the affected rows as the result of the statement
+                    self.rowcount = max(self.rowcount, 0) + result.fetchone()[0]
+                else:
+                    self.result, self.description = result, result.description
+        except Exception:
+            self.connection.record(query, time.perf_counter() - start, self.rowcount)
+            raise
+        self.connection.record(query, time.perf_counter() - start, self.rowcount, loaded)
+
+    def fetchone(self):
+        return self.result.fetchone()
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+    def fetchmany(self, size=1):
+        return self.result.fetchmany(size)
+
+
+class DuckDBConnection:
+    '''
+    A connection of the DuckDB database with the transactions of psycopg2:
+    the first statement opens one, commit and rollback end it
+    '''
+    def __init__(self, pool, duckdb):
+        self.pool = pool
+        self.duckdb = duckdb
+        self.record = lambda query, elapsed, rowcount, loaded=None: None
+        self.in_transaction = False
+        self.closed = False
+
+    def cursor(self):
+        return DuckDBCursor(self)
+
+    def begin(self):
+        if not self.in_transaction:
+            self.duckdb.execute('BEGIN TRANSACTION')
+            self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.duckdb.execute('COMMIT')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.duckdb.execute('ROLLBACK')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.duckdb.close()
+
+
+class DuckDBPool(connections.ConnectionPool):
+    '''
+    A pool of connections to an embedded DuckDB database, with the timing and retries of ConnectionPool
+    '''
+    def __init__(self, database, data_dir, size=4, retries=3, retry_backoff=2.0):
+        duckdb = import_duckdb()
+        self.database = duckdb.connect(database)
+        self.data_dir = data_dir
+        self.size = size
+        self.idle = []
+        # Concurrent transactions writing the same rows conflict, the later one is retried
+        self.transient_errors = (duckdb.TransactionException,)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timings = []
+        self.stage_name = None
+        self.stage_seconds = {}
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else DuckDBConnection(self, self.database.cursor())
+        conn.record = self.record
+        return conn
+
+    def putconn(self, conn, discard=False):
+        # Like psycopg2, a transaction left open is rolled back
+        if not conn.closed:
+            conn.rollback()
+        with self.lock:
+            if discard or conn.closed or len(self.idle) >= self.size:
+                conn.close()
+            else:
+                self.idle.append(conn)
+
+    def local_path(self, url):
+        '''
+        Returns the local file or directory standing in for an S3 URL
+        '''
+        key = s3_key(url)
+        path = os.path.join(self.data_dir, key)
+        if not os.path.exists(path) and os.path.exists(os.path.join(self.data_dir, os.path.basename(key))):
+            path = os.path.join(self.data_dir, os.path.basename(key))
+        return path
+
+    def local_files(self, url, manifest=False):
+        '''
+        Returns the local files loaded by a COPY from an S3 URL, prefix or manifest
+        '''
+        path = self.local_path(url)
+        if manifest:
+            with open(path) as f:
+                return [file for entry in json.load(f)['entries'] for file in self.local_files(entry['url'])]
+        if os.path.isfile(path):
+            return [path]
+        if os.path.isdir(path):
+            path = os.path.join(path, '')
+        files = sorted(file for file in glob.glob(path + '**', recursive=True) if os.path.isfile(file))
+        if not files:
+            raise FileNotFoundError('No local file for {} under {}'.format(url, self.data_dir))
+        return files
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+        self.database.close()
+
+
+def pool_from_config(config, size=4):
+    '''
+    Creates a pool of the DuckDB database of the [LOCAL] section of dwh.cfg
+    '''
+    return DuckDBPool(config.get('LOCAL', 'database', fallback='dwh.duckdb').strip() or 'dwh.duckdb',
+                      config.get('LOCAL', 'data_dir', fallback='data').strip() or 'data', size,
+                      retries=config.getint('DB', 'retries', fallback=3),
+                      retry_backoff=config.getfloat('DB', 'retry_backoff', fallback=2.0))
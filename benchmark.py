@@ -0,0 +1,292 @@
+'''
+End-to-end benchmark of the pipeline on generated data.
+
+The source files of generate_data.py are generated at each scale factor, then the tables are
+created, staged, merged, rolled up and checked with the queries of sql_queries.py against a
+local Postgres or the embedded DuckDB of backends.py standing in for Redshift. Each stage runs in its own process, so that its
+peak memory is its own, and reports its wall time, the rows it processed and the rows per second.
+
+The results are appended to a JSON lines file with the commit they were measured on, and
+--compare prints the change against the previous commit measured at the same scale.
+
+    python benchmark.py --scale 1 10 100 --dsn "dbname=bench" --compare
+    python benchmark.py --scale 1 10 --backend duckdb
+
+The Redshift statements are rewritten for Postgres by dialects.to_postgres, and only the staging
+COPY differs: the files are streamed with COPY FROM STDIN instead of being read from S3.
+DuckDB runs the Redshift statements themselves, COPY included, on a database file kept with the
+generated files.
+'''
+
+import argparse
+import configparser
+import csv
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from sql_queries import (drop_table_queries, create_table_queries, merge_table_queries, refresh_rollup_queries,
+                         reconcile_rollups, staging_data_formats, staging_copy_columns)
+from dialects import to_postgres
+import calendar_dim
+import county_keys
+import weather_cities
+import connections
+import data_quality
+import generate_data
+
+STAGES = ['generate', 'create', 'stage', 'insert', 'rollups', 'check']
+
+copy_from_stdin = "COPY {} FROM STDIN WITH (FORMAT csv, HEADER true)"
+
+# Redshift COPY of a generated file, read from the data directory by the DuckDB backend
+copy_generated_file = "COPY {} FROM 's3://local/{}' {} {}"
+
+# The sources hold MM/DD/YYYY dates, read by Redshift with DATEFORMAT
+set_date_style = "SET DateStyle TO 'ISO, MDY'"
+
+
+def peak_memory_mb():
+    '''
+    Returns the peak resident memory of this process in MB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def inserted_rows(pool, first):
+    '''
+    Returns the rows inserted by the statements timed since the first-th one
+    '''
+    return sum(max(timing.rows, 0) for timing in pool.timings[first:]
+               if timing.label.upper().startswith('INSERT'))
+
+
+def translate(backend, queries):
+    '''
+    Rewrites the Redshift statements for Postgres, the DuckDB backend translates them itself
+    '''
+    return queries if backend == 'duckdb' else [to_postgres(query) for query in queries]
+
+
+def json_as_csv(path, columns):
+    '''
+    Returns a JSON lines file as CSV with a header, for COPY FROM STDIN
+    '''
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(columns)
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            writer.writerow([record.get(column) for column in columns])
+    output.seek(0)
+    return output
+
+
+def stage_generate(pool, backend, data_dir, scale, seed):
+    files = generate_data.generate(data_dir, scale, seed)
+    return sum(rows for _, rows in files.values())
+
+
+def stage_create(pool, backend, data_dir, scale, seed):
+    pool.run(translate(backend, drop_table_queries + create_table_queries))
+    return 0
+
+
+def copy_table(table):
+    '''
+    Returns the table a COPY loads, with the columns of its file when it has derived ones
+    '''
+    return '{} {}'.format(table, staging_copy_columns[table]) if table in staging_copy_columns else table
+
+
+def copy_generated_files(cur):
+    rows = 0
+    for table, name in generate_data.FILES.items():
+        header = 'ignoreheader 1' if name.endswith('.csv') else ''
+        cur.execute(copy_generated_file.format(copy_table(table), name, staging_data_formats[table], header))
+        rows += max(cur.rowcount, 0)
+    return rows
+
+
+def stream_generated_files(cur, data_dir):
+    rows = 0
+    cur.execute(set_date_style)
+    for table, name in generate_data.FILES.items():
+        path = os.path.join(data_dir, name)
+        if name.endswith('.json'):
+            cur.copy_expert(copy_from_stdin.format(copy_table(table)), json_as_csv(path, generate_data.TEMPERATURE_KEYS))
+        else:
+            with open(path) as f:
+                cur.copy_expert(copy_from_stdin.format(copy_table(table)), f)
+        rows += max(cur.rowcount, 0)
+    return rows
+
+
+def stage_stage(pool, backend, data_dir, scale, seed):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            rows = copy_generated_files(cur) if backend == 'duckdb' else stream_generated_files(cur, data_dir)
+            county_keys.normalize_keys(cur)
+        conn.commit()
+    return rows
+
+
+def extend_calendar(cur):
+    calendar_dim.extend_time_dim(cur, *calendar_dim.staged_date_range(cur, 'staging_liquor_sales'))
+    weather_cities.load_weather_cities(cur)
+
+
+def stage_insert(pool, backend, data_dir, scale, seed):
+    # time_dim and the weather cities are generated, then the merges are listed with every table
+    # after the tables it references, and the stores are assigned their weather city
+    first = len(pool.timings)
+    pool.transaction(extend_calendar)
+    for queries in merge_table_queries:
+        pool.run(translate(backend, queries))
+    pool.transaction(weather_cities.assign_weather_cities)
+    return inserted_rows(pool, first)
+
+
+def stage_rollups(pool, backend, data_dir, scale, seed):
+    first = len(pool.timings)
+    pool.run(translate(backend, refresh_rollup_queries))
+    records = pool.fetch(reconcile_rollups)
+    if any(tuple(record[1:]) != tuple(records[0][1:]) for record in records[1:]):
+        raise ValueError('Rollups do not reconcile with sales_fact: {}'.format(records))
+    return inserted_rows(pool, first)
+
+
+def stage_check(pool, backend, data_dir, scale, seed):
+    results = []
+    for table in data_quality.CHECKS:
+        results += pool.transaction(lambda cur: data_quality.run_checks(cur, table))
+    failed = data_quality.failures(results)
+    if failed:
+        raise ValueError('Data quality checks failed: {}'.format(
+            ', '.join('{}.{}'.format(r['table'], r['check']) for r in failed)))
+    # Every table is scanned once, so the rows processed are the rows of the checked tables
+    return int(sum(r['metric'] for r in results if r['check'] == 'row_count'))
+
+
+def run_stage(stage, backend, dsn, config_path, data_dir, scale, seed):
+    '''
+    Runs one stage in the calling process. Returns its seconds, rows and peak memory in MB.
+    '''
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    if backend == 'duckdb':
+        # The database file is kept with the files, the next stage runs in another process
+        os.makedirs(data_dir, exist_ok=True)
+        config.read_dict({'DB': {'backend': 'duckdb'},
+                          'LOCAL': {'database': os.path.join(data_dir, 'benchmark.duckdb'), 'data_dir': data_dir}})
+    pool = connections.pool_from_config(config, 1, dsn)
+    try:
+        start = time.perf_counter()
+        rows = globals()['stage_' + stage](pool, backend, data_dir, scale, seed)
+        seconds = time.perf_counter() - start
+    finally:
+        pool.close()
+    return seconds, rows, peak_memory_mb()
+
+
+def run_benchmark(backend, dsn, config_path, data_dir, scale, seed):
+    '''
+    Runs every stage at one scale factor, each in a new process. Returns one result per stage.
+    '''
+    results = []
+    for stage in STAGES:
+        with multiprocessing.Pool(1, maxtasksperchild=1) as workers:
+            seconds, rows, peak = workers.apply(run_stage, (stage, backend, dsn, config_path, data_dir, scale, seed))
+        results.append({'scale': scale, 'stage': stage, 'backend': backend, 'seconds': round(seconds, 3),
+                        'rows': rows, 'rows_per_s': round(rows / seconds, 1) if seconds else 0.0,
+                        'peak_mb': round(peak, 1)})
+        print('{:>4}x {:<10} {:>9.2f}s {:>12} row(s) {:>12.0f} rows/s {:>8.1f} MB'.format(
+            scale, stage, seconds, rows, results[-1]['rows_per_s'], peak))
+    return results
+
+
+def current_commit():
+    '''
+    Returns the abbreviated hash of the checked out commit, with + when the tree has changes
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True)
+        return commit + ('+' if dirty.strip() else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, results, commit, seed):
+    measured_at = datetime.datetime.utcnow().isoformat(timespec='seconds')
+    with open(path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(dict(result, commit=commit, seed=seed, measured_at=measured_at)) + '\n')
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_comparison(history, results, commit):
+    '''
+    Prints the change of every stage since the latest result of another commit at the same scale
+    on the same backend
+    '''
+    print("------------------------------------------------------")
+    print('{:>5} {:<10} {:>10} {:>10} {:>8}   {}'.format('scale', 'stage', 'before s', 'now s', 'change', 'before'))
+    for result in results:
+        previous = [h for h in history if h['scale'] == result['scale'] and h['stage'] == result['stage']
+                    and h.get('backend', 'postgres') == result['backend'] and h.get('commit') != commit]
+        if not previous:
+            print('{:>4}x {:<10} {:>10} {:>10.2f}'.format(result['scale'], result['stage'], '-', result['seconds']))
+            continue
+        before = previous[-1]
+        change = (result['seconds'] - before['seconds']) / before['seconds'] * 100 if before['seconds'] else 0
+        print('{:>4}x {:<10} {:>10.2f} {:>10.2f} {:>7.1f}%   {}'.format(
+            result['scale'], result['stage'], before['seconds'], result['seconds'], change, before.get('commit')))
+    print("------------------------------------------------------")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on generated data against a local engine')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1], help='scale factors, e.g. 1 10 100')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--backend', choices=['postgres', 'duckdb'], default='postgres')
+    parser.add_argument('--dsn', default=None, help='libpq DSN of a local Postgres')
+    parser.add_argument('--data-dir', default='benchmark_data', help='directory of the generated files')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='file the results are appended to')
+    parser.add_argument('--compare', action='store_true', help='compare with the results of the previous commit')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    dsn = args.dsn or config.get('API', 'dsn', fallback='').strip() or None
+    if args.backend == 'postgres' and not dsn:
+        raise SystemExit('A local Postgres DSN is required (--dsn or dsn in the [API] section of dwh.cfg)')
+
+    commit = current_commit()
+    history = load_results(args.output)
+    for scale in args.scale:
+        data_dir = os.path.join(args.data_dir, '{}x'.format(scale))
+        results = run_benchmark(args.backend, dsn, 'dwh.cfg', data_dir, scale, args.seed)
+        save_results(args.output, results, commit, args.seed)
+        if args.compare:
+            print_comparison(history, results, commit)
+    print('Results appended to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
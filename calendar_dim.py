@@ -0,0 +1,185 @@
+'''
+Calendar generator of time_dim.
+
+time_dim is not derived from the staged sales: the days of a date range are generated here,
+with their attributes, and only the days missing from the table are inserted. The range covers
+the horizon of the [CALENDAR] section of dwh.cfg and the dates of the staged sales, so once the
+horizon is loaded a run only reads the coverage of time_dim and inserts nothing.
+This file is shared by etl.py and the Airflow DAG.
+
+    [CALENDAR]
+    start = 2012-01-01
+    years_ahead = 1
+
+Attributes of a day:
+    year, month, day, quarter
+    weekday       0 (Sunday) to 6 (Saturday), as EXTRACT(dw) in Redshift
+    week          ISO week of the year
+    holiday       name of the holiday, or of the weekday it is observed on, NULL otherwise
+    us_holiday    a US federal holiday or its observed day
+    iowa_holiday  a paid holiday of the State of Iowa (Iowa Code 1C.2) or its observed day
+    payday        a semi-monthly payday: the 15th and the last day of the month, or the
+                  business day before when they fall on a weekend or a federal holiday
+'''
+
+import datetime
+from sql_queries import (select_time_dim_coverage, select_complete_time_dim_dates, time_dim_incomplete_delete,
+                         time_dim_rows_insert, select_staged_date_range,
+                         table_version_delete, time_dim_version_insert)
+
+MONDAY, THURSDAY = 0, 3
+
+# Rows inserted by one multi-row INSERT
+BATCH_SIZE = 1000
+
+
+def nth_weekday(year, month, weekday, n):
+    '''
+    Returns the n-th weekday (0 for Monday) of a month, the last one when n is -1
+    '''
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+# Name, date in a year (None before it was instituted), US federal, Iowa
+HOLIDAYS = [
+    ("New Year's Day", lambda year: datetime.date(year, 1, 1), True, True),
+    ('Martin Luther King Jr. Day', lambda year: nth_weekday(year, 1, MONDAY, 3), True, True),
+    ("Washington's Birthday", lambda year: nth_weekday(year, 2, MONDAY, 3), True, False),
+    ('Memorial Day', lambda year: nth_weekday(year, 5, MONDAY, -1), True, True),
+    ('Juneteenth', lambda year: datetime.date(year, 6, 19) if year >= 2021 else None, True, False),
+    ('Independence Day', lambda year: datetime.date(year, 7, 4), True, True),
+    ('Labor Day', lambda year: nth_weekday(year, 9, MONDAY, 1), True, True),
+    ('Columbus Day', lambda year: nth_weekday(year, 10, MONDAY, 2), True, False),
+    ('Veterans Day', lambda year: datetime.date(year, 11, 11), True, True),
+    ('Thanksgiving Day', lambda year: nth_weekday(year, 11, THURSDAY, 4), True, True),
+    ('Day after Thanksgiving', lambda year: nth_weekday(year, 11, THURSDAY, 4) + datetime.timedelta(days=1),
+     False, True),
+    ('Christmas Day', lambda year: datetime.date(year, 12, 25), True, True),
+]
+
+
+def holidays(first_year, last_year):
+    '''
+    Returns {date: (name, us, iowa)} of the holidays of the years and of the days they are
+    observed on: the Friday before a Saturday holiday, the Monday after a Sunday one
+    '''
+    days = {}
+    for year in range(first_year, last_year + 1):
+        for name, rule, us, iowa in HOLIDAYS:
+            day = rule(year)
+            if day is None:
+                continue
+            days.setdefault(day, (name, us, iowa))
+            shift = {5: -1, 6: 1}.get(day.weekday())
+            if shift:
+                days.setdefault(day + datetime.timedelta(days=shift), (name + ' (observed)', us, iowa))
+    return days
+
+
+def calendar_rows(first, last):
+    '''
+    Returns the rows of time_dim for every day from first to last, in the column order of
+    time_dim_rows_insert. The attributes are computed over the whole range at once with pandas.
+    '''
+    import numpy as np
+    import pandas as pd
+
+    days = pd.date_range(first, last, freq='D')
+    # The observed day of a holiday can fall in the year before or after it
+    special = pd.DataFrame.from_dict(holidays(first.year - 1, last.year + 1), orient='index',
+                                     columns=['holiday', 'us_holiday', 'iowa_holiday'])
+    special.index = pd.to_datetime(special.index)
+    special = special.reindex(days)
+    us_holiday = special['us_holiday'].fillna(False).astype(bool)
+    iowa_holiday = special['iowa_holiday'].fillna(False).astype(bool)
+
+    # Semi-monthly paydays: the 15th and the last day of every month, moved back to the previous
+    # business day when they fall on a weekend or a federal holiday
+    months = pd.date_range(first.replace(day=1), last, freq='MS')
+    due = np.concatenate([(months + pd.Timedelta(days=14)).values, (months + pd.offsets.MonthEnd(0)).values])
+    federal = special.index[us_holiday].values.astype('datetime64[D]')
+    paid = np.busday_offset(due.astype('datetime64[D]'), 0, roll='backward', holidays=federal)
+    payday = np.isin(days.values.astype('datetime64[D]'), paid)
+
+    return list(zip(days.date,
+                    days.year.tolist(),
+                    days.month.tolist(),
+                    days.day.tolist(),
+                    ((days.dayofweek + 1) % 7).tolist(),
+                    days.isocalendar().week.tolist(),
+                    days.quarter.tolist(),
+                    special['holiday'].astype(object).where(special['holiday'].notna(), None).tolist(),
+                    us_holiday.tolist(),
+                    iowa_holiday.tolist(),
+                    payday.tolist()))
+
+
+def horizon(config, today=None):
+    '''
+    Returns the first and last day of the calendar set in the [CALENDAR] section of dwh.cfg:
+    from start to the end of the year years_ahead after today
+    '''
+    today = today or datetime.date.today()
+    start = config.get('CALENDAR', 'start', fallback='2012-01-01').strip() or '2012-01-01'
+    years_ahead = config.getint('CALENDAR', 'years_ahead', fallback=1)
+    return (datetime.datetime.strptime(start, '%Y-%m-%d').date(),
+            datetime.date(today.year + years_ahead, 12, 31))
+
+
+def staged_date_range(cur, staging_table):
+    '''
+    Returns the first and last date of a staging table, Nones when it is empty
+    '''
+    cur.execute(select_staged_date_range.format(staging_table))
+    return cur.fetchone()
+
+
+def literal(value):
+    '''
+    Returns a generated value as an SQL literal
+    '''
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (str, datetime.date)):
+        return "'{}'".format(str(value).replace("'", "''"))
+    return str(value)
+
+
+def insert_rows(cur, rows):
+    # The values are generated, so they are written as literals: binding thousands of
+    # parameters costs more than the insert on some engines
+    for start in range(0, len(rows), BATCH_SIZE):
+        values = ', '.join('(' + ', '.join(literal(value) for value in row) + ')'
+                           for row in rows[start:start + BATCH_SIZE])
+        cur.execute(time_dim_rows_insert + values)
+
+
+def extend_time_dim(cur, first, last):
+    '''
+    Inserts the days from first to last missing from time_dim, along with the days between
+    them and the rows already there, and regenerates the rows without the calendar attributes
+    (loaded before they existed). Does not commit. Returns the number of days inserted.
+    '''
+    cur.execute(select_time_dim_coverage)
+    covered_first, covered_last, days, complete = cur.fetchone()
+    if covered_first is not None:
+        first, last = min(first, covered_first), max(last, covered_last)
+        if (covered_first, covered_last) == (first, last) and days == complete == (last - first).days + 1:
+            print('time_dim covers {} to {}'.format(first, last))
+            return 0
+
+    cur.execute(select_complete_time_dim_dates)
+    kept = {row[0] for row in cur.fetchall()}
+    rows = [row for row in calendar_rows(first, last) if row[0] not in kept]
+    cur.execute(time_dim_incomplete_delete)
+    insert_rows(cur, rows)
+    cur.execute(table_version_delete.format('time_dim'))
+    cur.execute(time_dim_version_insert, (datetime.datetime.utcnow(),))
+    print('time_dim extended by {} day(s), covers {} to {}'.format(len(rows), first, last))
+    return len(rows)
@@ -1,46 +1,84 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import sample_rows_queries, count_rows_queries
+import time
+import uuid
+import connections
+import data_quality
+import metrics
+from sql_queries import reconcile_rollups
 
-def check_tables(cur, conn):
+def check_tables(cur, conn, tables=None):
     '''
-    Check if the tables is properly created
+    Runs the data quality checks of every table, one scan per table,
+    and records them in dq_results. Fails when a check of severity error fails.
     '''
-    for query1, query2 in zip(sample_rows_queries, count_rows_queries):
-        print('Executing {}...'.format(query1))
+    run_id = uuid.uuid4().hex
+    failed = []
+    for table in tables or data_quality.CHECKS:
+        query, _ = data_quality.compile_checks(table, data_quality.CHECKS[table])
+        print('Executing {}...'.format(query))
         print("------------------------------------------------------")
-        cur.execute(query1)
-        rows = cur.fetchall()
-        for row in rows:
-            print(row)
-        conn.commit()
-        print("------------------------------------------------------")
-
-        print('Executing {}...'.format(query2))
-        print("------------------------------------------------------")
-        cur.execute(query2)
-        row = cur.fetchone()
-        print("{} row(s) found".format(row[0]))
+        results = data_quality.run_checks(cur, table, run_id=run_id)
         conn.commit()
+        for result in results:
+            print(data_quality.format_result(result))
+        failed += data_quality.failures(results)
         print("======================================================")
+    if failed:
+        raise ValueError('Data quality checks failed: {}'.format(
+            ', '.join('{}.{}'.format(r['table'], r['check']) for r in failed)))
+
+
+def check_rollups(cur, conn):
+    '''
+    Checks that the totals of every rollup table match sales_fact
+    '''
+    print('Executing {}...'.format(reconcile_rollups))
+    print("------------------------------------------------------")
+    cur.execute(reconcile_rollups)
+    rows = cur.fetchall()
+    conn.commit()
+    expected = rows[0][1:]
+    for row in rows:
+        print("{:<25} rows={} sold={} volume={} sales={}".format(*row))
+    mismatches = [row[0] for row in rows[1:] if tuple(row[1:]) != tuple(expected)]
+    print("======================================================")
+    if mismatches:
+        raise ValueError('Rollups do not reconcile with sales_fact: {}'.format(', '.join(mismatches)))
 
 
 def main():
+
+    parser = argparse.ArgumentParser(description='Run the data quality checks and reconcile the rollups')
+    parser.add_argument('--profile', action='store_true',
+                        help='print every statement ranked by the time spent in it')
+    args = parser.parse_args()
     
     # Read config data
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
     
     # Establish connection
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    # Check tables
-    print('Checking the data...')
-    check_tables(cur, conn)
-    print('Checking complete')
-    
-    conn.close()
+    pool = connections.pool_from_config(config, 1)
+    started, status = time.time(), 'failure'
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+
+            # Check tables
+            print('Checking the data...')
+            with pool.stage('check'):
+                check_tables(cur, conn)
+            with pool.stage('reconcile'):
+                check_rollups(cur, conn)
+            print('Checking complete')
+        status = 'success'
+        if args.profile:
+            metrics.print_profile(pool.timings)
+    finally:
+        metrics.emitter_from_config(config).emit(uuid.uuid4().hex, 'check_tables', pool.timings,
+                                                 pool.stage_seconds, started, status)
+        pool.close()
 
 
 if __name__ == "__main__":
@@ -1,42 +1,66 @@
+import argparse
 import configparser
-import psycopg2
+import time
+import uuid
+import connections
+import metrics
+import migrations
 from sql_queries import create_table_queries, drop_table_queries
 
 
 def drop_tables(cur, conn):
     '''
-    Drops all the table using queries in sql_queries
+    Drops all the table using queries in sql_queries, in a single transaction
     '''
     for query in drop_table_queries:
         cur.execute(query)
-        conn.commit()
+    conn.commit()
 
 
 def create_tables(cur, conn):
     '''
-    Creates tables using queries in sql_queries
+    Creates tables using queries in sql_queries, in a single transaction
     '''
     for query in create_table_queries:
         cur.execute(query)
-        conn.commit()
+    conn.commit()
 
 
 def main():
 
+    parser = argparse.ArgumentParser(description='Create the staging and final tables')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='drop every table (and the load watermark) before creating them')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the schema changes without applying them')
+    parser.add_argument('--profile', action='store_true',
+                        help='print every statement ranked by the time spent in it')
+    args = parser.parse_args()
+
     # Read credentials from config file 
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
     # Establish Connection
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-
-    # Drop tables 
-    drop_tables(cur, conn)
-    # Create tables
-    create_tables(cur, conn)
+    pool = connections.pool_from_config(config, 1)
+    started, status = time.time(), 'failure'
+    try:
+        with pool.connection() as conn, pool.stage('migrate'):
+            cur = conn.cursor()
 
-    conn.close()
+            # Drop tables only on a full refresh, otherwise only apply the changed definitions
+            if args.full_refresh:
+                drop_tables(cur, conn)
+                create_tables(cur, conn)
+            else:
+                migrations.migrate(cur, conn, create_table_queries, args.dry_run)
+        status = 'success'
+        if args.profile:
+            metrics.print_profile(pool.timings)
+    finally:
+        metrics.emitter_from_config(config).emit(uuid.uuid4().hex, 'create_tables', pool.timings,
+                                                 pool.stage_seconds, started, status)
+        pool.close()
     print('Tables created')
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+'''
+Connection management shared by the scripts, the query service and the DAG callables.
+
+Connections come from a thread-safe pool and are opened with TCP keepalives and a statement
+timeout. A transaction that fails on a transient error (dropped connection, serialization
+conflict) is retried on a fresh connection. The work of a transaction is run again in full, so it
+must be idempotent: the load of a staging table empties it and runs its COPY in one transaction,
+and the merges delete-then-insert. Every statement run on a pooled connection is timed, with
+the rows it affected, the bytes it loaded (for a COPY on Redshift) and the stage of the run it
+belongs to, see metrics.py.
+
+Settings are read from the [DB] section of dwh.cfg. With backend = duckdb the pool is the
+embedded DuckDB database of backends.py instead, which runs the same statements offline.
+'''
+
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+# Errors after which the transaction is run again in full on a new connection. The error may
+# be raised after the commit reached the server, so the work must be safe to repeat.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError,
+                    psycopg2.extensions.TransactionRollbackError)
+
+# A statement run on a pooled connection. bytes is None when unknown.
+StatementTiming = namedtuple('StatementTiming', ['label', 'seconds', 'rows', 'bytes', 'stage'])
+
+# Bytes read from S3 by the last COPY of the session, from the load system tables of Redshift
+select_copy_bytes = "SELECT COALESCE(SUM(bytes), 0) FROM stl_file_scan WHERE query = pg_last_copy_id()"
+
+
+def cluster_dsn(config):
+    '''
+    Builds the DSN of the cluster from the [CLUSTER] section of dwh.cfg
+    '''
+    cluster = config['CLUSTER']
+    return psycopg2.extensions.make_dsn(host=cluster.get('host'), dbname=cluster.get('db_name'),
+                                        user=cluster.get('db_user'), password=cluster.get('db_password'),
+                                        port=cluster.get('db_port'))
+
+
+def statement_label(query):
+    '''
+    Returns the first line of a statement, used to report its timing
+    '''
+    query = query.decode() if isinstance(query, bytes) else str(query)
+    return ' '.join(query.split())[:80]
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    '''
+    A cursor reporting the time taken by every statement to its connection
+    '''
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            self.connection.record(query, time.perf_counter() - start, self.rowcount)
+            raise
+        elapsed = time.perf_counter() - start
+        loaded = self.connection.copy_bytes() if statement_label(query).upper().startswith('COPY') else None
+        self.connection.record(query, elapsed, self.rowcount, loaded)
+        return result
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    '''
+    A connection whose cursors are timed. The pool sets record when it hands the connection out.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.record = lambda query, elapsed, rowcount, loaded=None: None
+        self.configured = False
+        self.redshift = False
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', TimedCursor)
+        return super().cursor(*args, **kwargs)
+
+    def copy_bytes(self):
+        '''
+        Returns the bytes loaded by the last COPY, None when the server does not report them
+        '''
+        if not self.redshift:
+            return None
+        with super().cursor() as cur:
+            cur.execute(select_copy_bytes)
+            return int(cur.fetchone()[0])
+
+
+class ConnectionPool:
+    '''
+    A thread-safe pool of timed connections with reconnect and retry
+    '''
+    transient_errors = TRANSIENT_ERRORS
+
+    def __init__(self, dsn, size=4, statement_timeout=0, connect_timeout=10, keepalives_idle=60,
+                 retries=3, retry_backoff=2.0):
+        dsn = psycopg2.extensions.make_dsn(dsn, connect_timeout=connect_timeout, keepalives=1,
+                                           keepalives_idle=keepalives_idle, keepalives_interval=10,
+                                           keepalives_count=5)
+        self.pool = ThreadedConnectionPool(1, size, dsn, connection_factory=TimedConnection)
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timings = []
+        self.stage_name = None
+        self.stage_seconds = {}
+        self.lock = threading.Lock()
+
+    def record(self, query, elapsed, rowcount, loaded=None):
+        with self.lock:
+            self.timings.append(StatementTiming(statement_label(query), elapsed, rowcount, loaded, self.stage_name))
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Attributes the statements run in a with block, on any thread, to a stage of the run
+        and adds its wall time to stage_seconds
+        '''
+        previous, self.stage_name = self.stage_name, name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0) + time.perf_counter() - start
+            self.stage_name = previous
+
+    def getconn(self):
+        '''
+        Returns a live connection of the pool, replacing the ones closed by the server
+        '''
+        conn = self.pool.getconn()
+        if conn.closed:
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+        conn.record = self.record
+        if not conn.configured:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute('SET statement_timeout TO {}'.format(int(self.statement_timeout * 1000)))
+                cur.execute('SELECT version()')
+                conn.redshift = 'Redshift' in cur.fetchone()[0]
+            conn.commit()
+            conn.configured = True
+        return conn
+
+    def putconn(self, conn, discard=False):
+        '''
+        Gives a connection back to the pool, closing it with discard
+        '''
+        self.pool.putconn(conn, close=discard or bool(conn.closed))
+
+    @contextmanager
+    def connection(self):
+        '''
+        Lends a connection for the duration of a with block. The open transaction is rolled back
+        if the block fails, and the connection is discarded if it is no longer usable.
+        '''
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except self.transient_errors:
+            discard = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.putconn(conn, discard)
+
+    def transaction(self, work):
+        '''
+        Runs work(cur) in a single transaction and returns its result.
+        The whole transaction is retried with an exponential backoff after a transient error.
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as conn:
+                    with conn.cursor() as cur:
+                        result = work(cur)
+                    conn.commit()
+                    return result
+            except self.transient_errors as error:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                print('Transient error ({}), retrying in {:.0f}s...'.format(str(error).strip(), delay))
+                time.sleep(delay)
+
+    def run(self, queries, params=None):
+        '''
+        Runs statements in a single transaction
+        '''
+        def work(cur):
+            for query in queries:
+                cur.execute(query, params)
+        self.transaction(work)
+
+    def fetch(self, query, params=None, as_dicts=False):
+        '''
+        Runs a query and returns its rows, as dicts keyed by column with as_dicts
+        '''
+        def work(cur):
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            if as_dicts:
+                columns = [d[0] for d in cur.description]
+                rows = [dict(zip(columns, row)) for row in rows]
+            return rows
+        return self.transaction(work)
+
+    def slowest(self, limit=10):
+        '''
+        Returns the StatementTiming of the slowest statements run so far
+        '''
+        with self.lock:
+            return sorted(self.timings, key=lambda t: t.seconds, reverse=True)[:limit]
+
+    def take_timings(self):
+        '''
+        Returns the StatementTiming of the statements run so far and forgets them
+        '''
+        with self.lock:
+            timings, self.timings, self.stage_seconds = self.timings, [], {}
+        return timings
+
+    def close(self):
+        self.pool.closeall()
+
+
+def engine(conn):
+    '''
+    Returns the engine of a pooled connection: redshift, postgres or duckdb (backends.py)
+    '''
+    if getattr(conn, 'redshift', False):
+        return 'redshift'
+    return 'duckdb' if hasattr(conn, 'duckdb') else 'postgres'
+
+
+def pool_from_config(config, size=4, dsn=None):
+    '''
+    Creates a pool for the cluster (or the given DSN) with the [DB] settings of dwh.cfg
+    '''
+    if config.get('DB', 'backend', fallback='redshift').strip() == 'duckdb':
+        import backends
+        return backends.pool_from_config(config, size)
+    return ConnectionPool(dsn or cluster_dsn(config), size,
+                          statement_timeout=config.getfloat('DB', 'statement_timeout', fallback=0),
+                          connect_timeout=config.getint('DB', 'connect_timeout', fallback=10),
+                          keepalives_idle=config.getint('DB', 'keepalives_idle', fallback=60),
+                          retries=config.getint('DB', 'retries', fallback=3),
+                          retry_backoff=config.getfloat('DB', 'retry_backoff', fallback=2.0))
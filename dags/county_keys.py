@@ -0,0 +1,44 @@
+'''
+Keys of the census and crime counties.
+
+The counties of the two sources used to be matched on their names, cut at a fixed length:
+'Adair County' and 'Adair County, IA'. A name spelled differently in one source dropped its
+county from county_census_dim without notice. They are now matched on the FIPS code of the
+county, an integer: county_id of the census is the 5-digit code, and county_fips of the crime
+data is the state code times 1000 plus the county code, computed here once the raw file is
+staged (normalize.py writes it in the typed files).
+
+The Iowa counties of either source that find no match are reported, rather than dropped
+silently by the inner join of the dimension.
+This file is shared by etl.py and the Airflow DAG.
+'''
+
+from sql_queries import staging_crime_fips_update, county_key_reconciliation
+
+
+def normalize_keys(cur, census_table='staging_census', crime_table='staging_crime'):
+    '''
+    Computes the FIPS code of the staged crime counties, unless they are typed (where
+    normalize.py computed it), and returns the rows of the reconciliation report:
+    (source, county_fips, county_name, issue). Does not commit.
+    '''
+    if not crime_table.endswith('_typed'):
+        cur.execute(staging_crime_fips_update)
+    cur.execute(county_key_reconciliation.format(census_table, crime_table))
+    return cur.fetchall()
+
+
+def format_report(rows):
+    '''
+    Returns the lines of the reconciliation report
+    '''
+    lines = ["------------------------------------------------------"]
+    if rows:
+        lines.append('{:<8} {:>11} {:<30} {}'.format('source', 'county_fips', 'county_name', 'issue'))
+        for source, county_fips, county_name, issue in rows:
+            lines.append('{:<8} {:>11} {:<30} {}'.format(
+                source, '-' if county_fips is None else county_fips, county_name or '-', issue))
+    else:
+        lines.append('Every Iowa county of the census and crime data has a match')
+    lines.append("------------------------------------------------------")
+    return lines
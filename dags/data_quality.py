@@ -0,0 +1,202 @@
+'''
+Declarative data quality checks.
+
+Every table declares its checks in CHECKS. The checks of a table are compiled into a single
+aggregate query, so that they are all answered by one scan of the table. The results are
+recorded in the dq_results history table and compared with the previous run.
+This file is shared by check_tables.py and the Airflow DAG.
+
+Check kinds:
+    row_count    rows in the table, at least min, and not dropping by more than max_drop
+                 (a fraction) compared to the previous run
+    null_ratio   share of NULLs in column, at most max
+    range        rows of column outside [min, max], at most max_violations
+    unique       duplicated non-NULL values of column, must be 0
+    fk_coverage  share of the non-NULL values of column found in references (table.column),
+                 at least min
+Checks with severity 'warn' are reported but do not fail the run.
+'''
+
+import datetime
+import uuid
+from sql_queries import select_previous_dq_results
+
+CHECKS = {
+    'staging_liquor_sales': [
+        {'check': 'row_count', 'min': 1, 'severity': 'warn'},
+        {'check': 'null_ratio', 'column': 'date', 'max': 0.0},
+        {'check': 'null_ratio', 'column': 'store_num', 'max': 0.01},
+        {'check': 'null_ratio', 'column': 'item_num', 'max': 0.01},
+    ],
+    'staging_temperature': [
+        {'check': 'row_count', 'min': 1},
+        {'check': 'range', 'column': 'temperature', 'min': -99, 'max': 130},
+    ],
+    'staging_census': [
+        {'check': 'row_count', 'min': 1},
+        {'check': 'null_ratio', 'column': 'county_id', 'max': 0.0},
+    ],
+    'staging_crime': [
+        {'check': 'row_count', 'min': 1},
+        {'check': 'range', 'column': 'fips_st', 'min': 1, 'max': 78},
+    ],
+    'sales_fact': [
+        # A day reloaded from a corrected, smaller extract replaces its rows with fewer ones
+        {'check': 'row_count', 'min': 1, 'max_drop': 0.01},
+        {'check': 'null_ratio', 'column': 'date', 'max': 0.0},
+        {'check': 'range', 'column': 'sold_count', 'min': -10000, 'max': 100000},
+        {'check': 'fk_coverage', 'column': 'date', 'references': 'time_dim.date', 'min': 1.0},
+        {'check': 'fk_coverage', 'column': 'store_id', 'references': 'store_dim.store_id', 'min': 0.999},
+        {'check': 'fk_coverage', 'column': 'item_id', 'references': 'item_dim.item_id', 'min': 0.999},
+        {'check': 'fk_coverage', 'column': 'county_id', 'references': 'county_census_dim.county_id', 'min': 0.95,
+         'severity': 'warn'},
+        {'check': 'fk_coverage', 'column': 'city_id', 'references': 'city_dim.city_id', 'min': 1.0},
+    ],
+    'store_dim': [
+        {'check': 'row_count', 'min': 1, 'max_drop': 0.0},
+        {'check': 'unique', 'column': 'store_id'},
+        {'check': 'null_ratio', 'column': 'county', 'max': 0.05},
+        {'check': 'null_ratio', 'column': 'weather_city_id', 'max': 0.05, 'severity': 'warn'},
+    ],
+    'item_dim': [
+        {'check': 'row_count', 'min': 1, 'max_drop': 0.0},
+        {'check': 'unique', 'column': 'item_id'},
+    ],
+    'time_dim': [
+        {'check': 'row_count', 'min': 1, 'max_drop': 0.0},
+        {'check': 'unique', 'column': 'date'},
+        {'check': 'range', 'column': 'month', 'min': 1, 'max': 12},
+        {'check': 'range', 'column': 'weekday', 'min': 0, 'max': 6},
+    ],
+    'temperature_dim': [
+        {'check': 'row_count', 'min': 1},
+        {'check': 'range', 'column': 'temperature', 'min': -99, 'max': 130},
+    ],
+    'county_census_dim': [
+        {'check': 'row_count', 'min': 90},
+        {'check': 'unique', 'column': 'county_id'},
+        {'check': 'range', 'column': 'county_id', 'min': 19001, 'max': 19197},
+    ],
+    'city_dim': [
+        {'check': 'row_count', 'min': 1, 'max_drop': 0.0},
+        {'check': 'unique', 'column': 'city'},
+    ],
+}
+
+
+def check_name(check):
+    '''
+    Returns the name a check is recorded under, e.g. fk_coverage(store_id)
+    '''
+    if 'column' in check:
+        return '{}({})'.format(check['check'], check['column'])
+    return check['check']
+
+
+def compile_checks(table, checks):
+    '''
+    Compiles the checks of a table into one aggregate query.
+    Returns the query and, for each check, the positions of its aggregates in the result row.
+    '''
+    aggregates, joins, positions = ['COUNT(*)'], [], []
+
+    def add(expression):
+        aggregates.append(expression)
+        return len(aggregates) - 1
+
+    for check in checks:
+        kind, column = check['check'], 't.{}'.format(check.get('column'))
+        if kind == 'row_count':
+            positions.append([0])
+        elif kind == 'null_ratio':
+            positions.append([0, add('SUM(CASE WHEN {} IS NULL THEN 1 ELSE 0 END)'.format(column))])
+        elif kind == 'range':
+            positions.append([add('SUM(CASE WHEN {0} < {1} OR {0} > {2} THEN 1 ELSE 0 END)'.format(
+                column, check['min'], check['max']))])
+        elif kind == 'unique':
+            positions.append([add('COUNT({})'.format(column)), add('COUNT(DISTINCT {})'.format(column))])
+        elif kind == 'fk_coverage':
+            # Joining the distinct keys keeps one row per row of the table, so it is still one scan
+            alias = 'fk{}'.format(len(joins))
+            ref_table, ref_column = check['references'].split('.')
+            joins.append('LEFT JOIN (SELECT DISTINCT {} AS k FROM {}) {} ON {} = {}.k'.format(
+                ref_column, ref_table, alias, column, alias))
+            positions.append([add('SUM(CASE WHEN {} IS NOT NULL THEN 1 ELSE 0 END)'.format(column)),
+                              add('SUM(CASE WHEN {}.k IS NOT NULL THEN 1 ELSE 0 END)'.format(alias))])
+        else:
+            raise ValueError('Unknown check {} on {}'.format(kind, table))
+    query = 'SELECT {}\nFROM {} t\n{}'.format(',\n       '.join(aggregates), table, '\n'.join(joins))
+    return query.strip(), positions
+
+
+def evaluate(check, values, previous):
+    '''
+    Computes the metric of a check from its aggregates and tells whether it passed
+    '''
+    kind = check['check']
+    values = [float(v or 0) for v in values]
+    if kind == 'row_count':
+        metric = values[0]
+        passed = metric >= check.get('min', 0)
+        if passed and 'max_drop' in check and previous:
+            passed = metric >= previous * (1 - check['max_drop'])
+    elif kind == 'null_ratio':
+        metric = values[1] / values[0] if values[0] else 0.0
+        passed = metric <= check['max']
+    elif kind == 'range':
+        metric = values[0]
+        passed = metric <= check.get('max_violations', 0)
+    elif kind == 'unique':
+        metric = values[0] - values[1]
+        passed = metric == 0
+    else:
+        metric = values[1] / values[0] if values[0] else 1.0
+        passed = metric >= check['min']
+    return metric, passed
+
+
+def run_checks(cur, table, checks=None, run_id=None):
+    '''
+    Runs all the checks of a table in one scan, records them in dq_results
+    and returns one result per check
+    '''
+    checks = CHECKS[table] if checks is None else checks
+    run_id = run_id or uuid.uuid4().hex
+    cur.execute(select_previous_dq_results, (table, table))
+    previous = dict(cur.fetchall())
+
+    query, positions = compile_checks(table, checks)
+    cur.execute(query)
+    row = cur.fetchone()
+
+    checked_at = datetime.datetime.utcnow()
+    results = []
+    for check, position in zip(checks, positions):
+        name = check_name(check)
+        metric, passed = evaluate(check, [row[i] for i in position], previous.get(name))
+        results.append({'table': table, 'check': name, 'metric': metric, 'previous': previous.get(name),
+                        'passed': passed, 'severity': check.get('severity', 'error')})
+
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(results))
+    params = [v for r in results for v in (run_id, checked_at, table, r['check'], r['metric'], r['passed'])]
+    cur.execute('INSERT INTO dq_results (run_id, checked_at, table_name, check_name, metric, passed) '
+                'VALUES ' + values, params)
+    return results
+
+
+def format_result(result):
+    '''
+    Formats a result with its change since the previous run
+    '''
+    status = 'PASS' if result['passed'] else ('WARN' if result['severity'] == 'warn' else 'FAIL')
+    change = ''
+    if result['previous'] is not None:
+        change = ' (previous {:g}, {:+g})'.format(result['previous'], result['metric'] - result['previous'])
+    return '{} {:<20} {:<45} {:g}{}'.format(status, result['table'], result['check'], result['metric'], change)
+
+
+def failures(results):
+    '''
+    Returns the failed checks whose severity fails the run
+    '''
+    return [r for r in results if not r['passed'] and r['severity'] == 'error']
@@ -4,66 +4,338 @@ import logging
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators.python_operator import PythonOperator
-from airflow.contrib.hooks.aws_hook import AwsHook
 from airflow.hooks.postgres_hook import PostgresHook
-from airflow.operators.postgres_operator import PostgresOperator
+from airflow.utils import timezone
+from psycopg2.extensions import make_dsn
 import sql_queries as sq
+from scheduler import table_dependencies, critical_path
+import calendar_dim
+import county_keys
+import data_quality
+import load_ledger
+import maintenance
+import connections
+import metrics
+import migrations
+import weather_cities
+
+# The scheduler parses this file every few seconds: the settings of dwh.cfg are only read
+# by the tasks (sq.get_config), and the DAG itself is set here
+START_DATE = datetime.datetime(2012, 1, 1)
+MAX_ACTIVE_RUNS = 4
+
+# Pool of the worker process, see redshift_pool
+pool = None
+
+
+def redshift_pool():
+    '''
+    Returns the connection pool of this worker process, created on first use from the
+    "redshift" Airflow connection with the [DB] settings of dwh.cfg
+    '''
+    global pool
+    if pool is None:
+        redshift = PostgresHook.get_connection("redshift")
+        dsn = make_dsn(host=redshift.host, dbname=redshift.schema, user=redshift.login,
+                       password=redshift.password, port=redshift.port)
+        pool = connections.pool_from_config(sq.get_config(), 1, dsn)
+    return pool
+
+def log_statement_timings(context):
+    '''
+    Logs the time taken by the statements run by this task and emits the metrics of the task,
+    as a stage of the DAG run
+    '''
+    timings = [timing._replace(stage=context['task'].task_id) for timing in redshift_pool().take_timings()]
+    for timing in sorted(timings, key=lambda t: t.seconds, reverse=True)[:10]:
+        logging.info("{:>8.1f}s {:>10} row(s)  {}".format(timing.seconds, timing.rows, timing.label))
+    metrics.emitter_from_config(sq.get_config()).emit(context['run_id'], 'etl_process', timings)
+
+def is_latest_run(context):
+    '''
+    Tells whether a run is for the latest schedule interval or was triggered by hand, like
+    LatestOnlyOperator, but without skipping the downstream tasks
+    '''
+    dag_run = context.get('dag_run')
+    if dag_run and dag_run.external_trigger:
+        return True
+    next_execution_date = context['next_execution_date']
+    return next_execution_date <= timezone.utcnow() < context['dag'].following_schedule(next_execution_date)
+
+
+def create_tables(*args, **kwargs):
+    '''
+    Applies the changed table definitions.
+    A run triggered with {"full_refresh": true} recreates the staging tables first, so that the
+    sources are staged again, and queues every date of sales_fact to rebuild the rollups.
+    The final tables are kept: the days are reloaded by backfilling them again.
+    '''
+    dag_run = kwargs.get('dag_run')
+    full_refresh = bool(dag_run and dag_run.conf and dag_run.conf.get('full_refresh'))
+    if full_refresh:
+        logging.info("Full refresh requested, recreating the staging tables")
+        redshift_pool().run(sq.staging_drop_then_create_tables_queries + [sq.partition_staging_drop.format(
+            sq.partition_staging_table.format(kwargs['ds_nodash']))])
+    redshift_pool().transaction(
+        lambda cur: migrations.apply(cur, migrations.plan(cur, sq.create_if_not_exists_queries)))
+    if full_refresh:
+        redshift_pool().run([sq.rollup_pending_dates_backfill])
+    log_statement_timings(kwargs)
 
-    
 def load_data_to_redshift(*args, **kwargs):
     '''
-    Loads data from S3 to Redshift
+    Reloads a reference staging table from S3. The reference data is not partitioned by day,
+    so it is only reloaded by the latest run and the runs of a backfill keep the staged copy.
+    '''
+    table_name = kwargs['table_name']
+    if not is_latest_run(kwargs):
+        logging.info(f"Not the latest run, keeping the staged {table_name}")
+        return
+    from airflow.hooks.S3_hook import S3Hook
+
+    # The source is reloaded in full when any of its files is missing from the load ledger or
+    # changed, and recorded in the same transaction since the staged copy is kept until then
+    client = S3Hook("aws_credentials").get_conn()
+    copy = sq.load_data_from_S3.format(table_name + ' ' + sq.staging_copy_columns.get(table_name, ''),
+                                       kwargs['s3_url'])
+
+    def reload(cur):
+        copies = load_ledger.plan_copies(cur, table_name, [copy], lambda url: load_ledger.s3_objects(client, url),
+                                         full=True)
+        if not copies:
+            logging.info(f"The source of {table_name} is unchanged, keeping the staged copy")
+            return
+        cur.execute(sq.staging_table_clear.format(table_name))
+        loads = []
+        for query, obj in copies:
+            cur.execute(query)
+            loads.append((obj, cur.rowcount))
+        load_ledger.record(cur, table_name, loads)
+
+    redshift_pool().transaction(reload)
+    log_statement_timings(kwargs)
+
+def load_sales_partition(*args, **kwargs):
+    '''
+    Stages the sales files of the execution date, found under the year=/month=/day= prefix of
+    that day, in the staging table of the day. A day without files leaves it empty.
+    The root of the partitions is liquor_sales_partitions in the [DAG] section of dwh.cfg.
+    '''
+    from airflow.hooks.S3_hook import S3Hook
+
+    day = kwargs['execution_date']
+    table_name = sq.partition_staging_table.format(kwargs['ds_nodash'])
+    root = sq.get_config().get('DAG', 'liquor_sales_partitions',
+                               fallback='s3://myawsbucket20201109/liquor_sales').rstrip('/')
+    prefix = '{}/year={:%Y}/month={:%m}/day={:%d}/'.format(root, day, day, day)
+    bucket, _, key_prefix = prefix[len('s3://'):].partition('/')
+    queries = [sq.partition_staging_create.format(table_name), sq.staging_table_clear.format(table_name)]
+    if S3Hook("aws_credentials").list_keys(bucket, prefix=key_prefix):
+        queries += [sq.load_data_from_S3.format(table_name, "'{}'".format(prefix)),
+                    sq.partition_staging_prune.format(table_name, kwargs['ds'])]
+    else:
+        logging.info(f"No sales files under {prefix}")
+    redshift_pool().run(queries)
+    log_statement_timings(kwargs)
+
+def extend_calendar(*args, **kwargs):
+    '''
+    Generates the days of the calendar horizon missing from time_dim, and the execution date
+    if it is outside of the horizon. Once the horizon is loaded nothing is inserted.
+    The horizon is set in the [CALENDAR] section of dwh.cfg.
+    '''
+    day = datetime.datetime.strptime(kwargs['ds'], '%Y-%m-%d').date()
+    first, last = calendar_dim.horizon(sq.get_config())
+    # Concurrent runs extending the calendar conflict, the later one is retried and finds it loaded
+    redshift_pool().transaction(lambda cur: calendar_dim.extend_time_dim(cur, min(first, day), max(last, day)))
+    log_statement_timings(kwargs)
+
+def load_weather_cities(*args, **kwargs):
+    '''
+    Inserts the weather cities of weather_cities.py missing from weather_city_dim
+    '''
+    redshift_pool().transaction(weather_cities.load_weather_cities)
+    log_statement_timings(kwargs)
+
+def assign_weather_cities(*args, **kwargs):
+    '''
+    Stores the nearest weather city of the stores whose nearest city changed
+    '''
+    redshift_pool().transaction(weather_cities.assign_weather_cities)
+    log_statement_timings(kwargs)
+
+def reconcile_county_keys(*args, **kwargs):
+    '''
+    Keys the staged crime counties on their FIPS code and logs the Iowa counties of the census
+    or crime data without a match, on the latest run only (the reference data is not reloaded
+    by the others)
+    '''
+    if not is_latest_run(kwargs):
+        logging.info("Not the latest run, the reference data was not reloaded")
+        return
+    rows = redshift_pool().transaction(county_keys.normalize_keys)
+    for line in county_keys.format_report(rows):
+        logging.info(line)
+    log_statement_timings(kwargs)
+
+def merge_dimension(*args, **kwargs):
+    '''
+    Replaces the stores or items of the execution date whose attributes changed, and keeps their
+    previous version when dimension_history is set in the [ETL] section of dwh.cfg
+    '''
+    table_name = kwargs['table_name']
+    history = sq.get_config().getboolean('ETL', 'dimension_history', fallback=False)
+    merge = sq.dimension_merge(table_name, sq.dimension_changes_inserts[table_name], history)
+    redshift_pool().run(sq.partition_queries(merge, kwargs['ds_nodash']))
+    log_statement_timings(kwargs)
+
+def merge_reference_table(*args, **kwargs):
+    '''
+    Merges a table built from the reference data, on the latest run only
+    '''
+    if not is_latest_run(kwargs):
+        logging.info("Not the latest run, the reference data was not reloaded")
+        return
+    redshift_pool().run(kwargs['queries'])
+    log_statement_timings(kwargs)
+
+def merge_sales_fact(*args, **kwargs):
+    '''
+    Replaces the sales of the execution date in sales_fact with those of its staging table
+    '''
+    redshift_pool().run(sq.sales_fact_partition_merge(kwargs['ds'], kwargs['ds_nodash']))
+    log_statement_timings(kwargs)
+
+def merge_city_dim(*args, **kwargs):
+    '''
+    Adds the cities of the sales of the execution date to city_dim
     '''
-    aws_hook = AwsHook("aws_credentials")
-    credentials = aws_hook.get_credentials()
-    redshift_hook = PostgresHook("redshift")
-    redshift_hook.run(sq.load_data_from_S3.format(kwargs['table_name'], kwargs['s3_url']))
+    redshift_pool().run(sq.partition_queries(sq.city_dim_table_merge, kwargs['ds_nodash']))
+    log_statement_timings(kwargs)
+
+def refresh_rollups(*args, **kwargs):
+    '''
+    Re-aggregates the rollups of the dates queued by the merges of sales_fact
+    '''
+    redshift_pool().run(sq.refresh_rollup_queries)
+    log_statement_timings(kwargs)
+
+def update_watermark(*args, **kwargs):
+    '''
+    Moves the high-water mark of sales_fact to its latest date and invoice
+    '''
+    redshift_pool().run(sq.sales_fact_watermark_upsert, {'last_source_mtime': None})
+    log_statement_timings(kwargs)
+
+def drop_sales_partition(*args, **kwargs):
+    '''
+    Drops the staging table of the execution date once it is merged
+    '''
+    table_name = sq.partition_staging_table.format(kwargs['ds_nodash'])
+    redshift_pool().run([sq.partition_staging_drop.format(table_name)])
+    log_statement_timings(kwargs)
 
 def check_tables(*args, **kwargs):
     '''
-    Runs simple queries to check the tables are properly populated
+    Runs the data quality checks of a table in a single scan and records them in dq_results.
+    With partition, the staging table of the execution date is checked with the checks of table_name.
     '''
     table_name = kwargs['table_name']
-    redshift_hook = PostgresHook("redshift")
-    #Count rows
-    query = "SELECT COUNT(*) FROM {}".format(table_name)
-    logging.info("Executing a query: {}".format(query))
-    records = redshift_hook.get_records(query)
-    if len(records) < 1 or len(records[0]) < 1:
-        raise ValueError(f"Data quality check failed. {table_name} returned no results")
-    num_records = records[0][0]
-    if num_records < 1:
-        raise ValueError('Not a single record was found in this step')
-    logging.info(f"Data quality on table {table_name} check passed with {records[0][0]} records")
-    
-    #Show the first 5 rows
-    query = "SELECT * FROM {} LIMIT 5".format(table_name)
-    logging.info("Executing a query: {}".format(query))
-    records = redshift_hook.get_records(query)
+    checks = data_quality.CHECKS[table_name]
+    if kwargs.get('partition'):
+        table_name = sq.partition_staging_table.format(kwargs['ds_nodash'])
+    results = redshift_pool().transaction(
+        lambda cur: data_quality.run_checks(cur, table_name, checks, run_id=kwargs.get('run_id')))
+    for result in results:
+        logging.info(data_quality.format_result(result))
+    log_statement_timings(kwargs)
+    failed = data_quality.failures(results)
+    if failed:
+        raise ValueError("Data quality check failed on {}: {}".format(
+            table_name, ', '.join(r['check'] for r in failed)))
+    logging.info(f"Data quality on table {table_name} check passed")
+
+
+def check_rollups(*args, **kwargs):
+    '''
+    Checks that the totals of every rollup table match sales_fact. They only match once
+    every pending date is refreshed, which a concurrent run of a backfill may not have done yet.
+    '''
+    pending = redshift_pool().fetch(sq.count_rollup_pending_dates)[0][0]
+    if pending:
+        logging.info(f"{pending} date(s) pending for another run, the rollups are reconciled by its check")
+        log_statement_timings(kwargs)
+        return
+    records = redshift_pool().fetch(sq.reconcile_rollups)
+    expected = tuple(records[0][1:])
     for rec in records:
         logging.info(rec)
+    log_statement_timings(kwargs)
+    mismatches = [rec[0] for rec in records[1:] if tuple(rec[1:]) != expected]
+    if mismatches:
+        raise ValueError(f"Rollups do not reconcile with sales_fact: {', '.join(mismatches)}")
+    logging.info("Rollups reconcile with sales_fact")
+
+def maintain_tables(*args, **kwargs):
+    '''
+    Runs the ANALYZE and VACUUM due on the tables within the time budget of the [MAINTENANCE]
+    section of dwh.cfg, on the latest run only: Redshift runs one VACUUM at a time, and the
+    backfilled days are maintained together by the run that catches up
+    '''
+    if not is_latest_run(kwargs):
+        logging.info("Not the latest run, the tables are maintained by the latest one")
+        return
+    with redshift_pool().connection() as conn:
+        results = maintenance.maintain(conn, sq.get_config())
+    for line in maintenance.format_report(results):
+        logging.info(line)
+    log_statement_timings(kwargs)
+
+def report_critical_path(*args, **kwargs):
+    '''
+    Logs the chain of dependent tasks that bounded the duration of this run
+    '''
+    dag_run = kwargs['dag_run']
+    durations = {ti.task_id: ti.duration or 0 for ti in dag_run.get_task_instances()}
+    dependencies = {task.task_id: set(task.upstream_task_ids) for task in kwargs['dag'].tasks}
+    path, total = critical_path(durations, dependencies)
+    for task_id in path:
+        logging.info("{:<40} {:>8.1f}s".format(task_id, durations[task_id]))
+    logging.info("Critical path: {} ({:.1f}s)".format(' -> '.join(path), total))
 
     
 # Define a DAG object     
+# One run per day of sales, templated on its execution date. Past days are caught up (or
+# backfilled with `airflow backfill`) with at most max_active_runs days loading at once,
+# and rerunning a day replaces its rows.
+default_args = {
+    'depends_on_past': False,
+    'retries': 2,
+    'retry_delay': datetime.timedelta(minutes=5)
+}
+
 dag = DAG(
         'etl_process',
-        start_date=datetime.datetime.now())
+        default_args=default_args,
+        start_date=START_DATE,
+        schedule_interval='@daily',
+        catchup=True,
+        max_active_runs=MAX_ACTIVE_RUNS)
 
 #------------------------------------------------------------------------------------------------------
 # Define tasks 
 
-create_tables_task = PostgresOperator(
+create_tables_task = PythonOperator(
     task_id="create_tables",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.drop_then_create_tables_queries
+    python_callable=create_tables,
+    provide_context=True
 )
 
 load_liquor_data_task = PythonOperator(
     task_id="load_liquor_data",
-    python_callable=load_data_to_redshift,
-    op_kwargs={'table_name': 'staging_liquor_sales',
-               's3_url': "'s3://myawsbucket20201109/Iowa_Liquor_Sales_small.csv'"},
+    python_callable=load_sales_partition,
+    provide_context=True,
     dag=dag
 )
 
@@ -71,13 +343,15 @@ check_load_liquor_task = PythonOperator(
     task_id="check_load_liquor",
     dag=dag,
     python_callable=check_tables,
-    op_kwargs = {'table_name': 'staging_liquor_sales'}
+    provide_context=True,
+    op_kwargs = {'table_name': 'staging_liquor_sales', 'partition': True}
 )
 
 
 load_census_data_task = PythonOperator(
     task_id="load_census_data",
     python_callable=load_data_to_redshift,
+    provide_context=True,
     op_kwargs={'table_name': 'staging_census',
                's3_url': "'s3://myawsbucket20201109/acs2017_county_data.csv'"},
     dag=dag
@@ -87,6 +361,7 @@ check_load_census_task = PythonOperator(
     task_id="check_load_census",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'staging_census'}
 )
 
@@ -94,6 +369,7 @@ check_load_census_task = PythonOperator(
 load_crime_data_task = PythonOperator(
     task_id="load_crime_data",
     python_callable=load_data_to_redshift,
+    provide_context=True,
     op_kwargs={'table_name': 'staging_crime',
                's3_url': "'s3://myawsbucket20201109/crime_data_w_population_and_crime_rate.csv'"},
     dag=dag
@@ -103,6 +379,7 @@ check_load_crime_task = PythonOperator(
     task_id="check_load_crime",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'staging_crime'}
 )
 
@@ -110,6 +387,7 @@ check_load_crime_task = PythonOperator(
 load_temperature_data_task = PythonOperator(
     task_id="load_temperature_data",
     python_callable=load_data_to_redshift,
+    provide_context=True,
     op_kwargs={'table_name': 'staging_temperature',
                's3_url': "'s3://myawsbucket20201109/city_temperature_small.csv'"},
     dag=dag
@@ -119,32 +397,43 @@ check_load_temperature_task = PythonOperator(
     task_id="check_load_temperature",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'staging_temperature'}
 )
 
 
+reconcile_county_keys_task = PythonOperator(
+    task_id="reconcile_county_keys",
+    dag=dag,
+    python_callable=reconcile_county_keys,
+    provide_context=True
+)
+
+
 load_to_insert_dummy = DummyOperator(task_id='load_to_insert',  dag=dag)
 
-insert_sales_fact_task = PostgresOperator(
+insert_sales_fact_task = PythonOperator(
     task_id="insert_sales_fact_table",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.sales_fact_table_insert
+    python_callable=merge_sales_fact,
+    provide_context=True
 )
 
 check_insert_sales_fact_task = PythonOperator(
     task_id="check_insert_sales_fact",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'sales_fact'}
 )
 
 
-insert_county_census_dim_task = PostgresOperator(
+insert_county_census_dim_task = PythonOperator(
     task_id="insert_county_census_dim_table",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.county_census_dim_table_insert
+    python_callable=merge_reference_table,
+    provide_context=True,
+    op_kwargs = {'queries': sq.county_census_dim_table_merge}
 )
 
 
@@ -152,64 +441,143 @@ check_insert_county_census_dim_task = PythonOperator(
     task_id="check_insert_county_census_dim",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'county_census_dim'}
 )
 
-insert_item_dim_task = PostgresOperator(
+insert_item_dim_task = PythonOperator(
     task_id="insert_item_dim_table",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.item_dim_table_insert
+    python_callable=merge_dimension,
+    provide_context=True,
+    op_kwargs = {'table_name': 'item_dim'}
+)
+
+insert_city_dim_task = PythonOperator(
+    task_id="insert_city_dim_table",
+    dag=dag,
+    python_callable=merge_city_dim,
+    provide_context=True
+)
+
+check_insert_city_dim_task = PythonOperator(
+    task_id="check_insert_city_dim",
+    dag=dag,
+    python_callable=check_tables,
+    provide_context=True,
+    op_kwargs = {'table_name': 'city_dim'}
 )
 
 check_insert_item_dim_task = PythonOperator(
     task_id="check_insert_item_dim",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'item_dim'}
 )
 
 
-insert_store_dim_task = PostgresOperator(
+insert_store_dim_task = PythonOperator(
     task_id="insert_store_dim_table",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.store_dim_table_insert
+    python_callable=merge_dimension,
+    provide_context=True,
+    op_kwargs = {'table_name': 'store_dim'}
 )
 
 check_insert_store_dim_task = PythonOperator(
     task_id="check_insert_store_dim",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'store_dim'}
 )
 
-insert_temperature_dim_task = PostgresOperator(
+insert_temperature_dim_task = PythonOperator(
     task_id="insert_temperature_dim_table",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.temperature_dim_table_insert
+    python_callable=merge_reference_table,
+    provide_context=True,
+    op_kwargs = {'queries': sq.temperature_dim_table_merge}
 )
 
 check_insert_temperature_dim_task = PythonOperator(
     task_id="check_insert_temperature_dim",
     dag=dag,
     python_callable=check_tables,
+    provide_context=True,
     op_kwargs = {'table_name': 'temperature_dim'}
 )
 
-insert_time_dim_task = PostgresOperator(
+insert_time_dim_task = PythonOperator(
     task_id="insert_time_dim_table",
     dag=dag,
-    postgres_conn_id="redshift",
-    sql= sq.time_dim_table_insert
+    python_callable=extend_calendar,
+    provide_context=True
 )
 
 check_insert_time_dim_task = PythonOperator(
     task_id="check_insert_time_dim",
     dag=dag,
     python_callable=check_tables,
-    op_kwargs = {'table_name': 'county_census_dim'}
+    provide_context=True,
+    op_kwargs = {'table_name': 'time_dim'}
+)
+
+insert_weather_city_dim_task = PythonOperator(
+    task_id="insert_weather_city_dim_table",
+    dag=dag,
+    python_callable=load_weather_cities,
+    provide_context=True
+)
+
+assign_weather_cities_task = PythonOperator(
+    task_id="assign_weather_cities",
+    dag=dag,
+    python_callable=assign_weather_cities,
+    provide_context=True
+)
+
+refresh_rollups_task = PythonOperator(
+    task_id="refresh_rollups",
+    dag=dag,
+    python_callable=refresh_rollups,
+    provide_context=True
+)
+
+check_rollups_task = PythonOperator(
+    task_id="check_rollups",
+    dag=dag,
+    python_callable=check_rollups,
+    provide_context=True
+)
+
+update_watermark_task = PythonOperator(
+    task_id="update_watermark",
+    dag=dag,
+    python_callable=update_watermark,
+    provide_context=True
+)
+
+drop_liquor_partition_task = PythonOperator(
+    task_id="drop_liquor_partition",
+    dag=dag,
+    python_callable=drop_sales_partition,
+    provide_context=True
+)
+
+maintain_tables_task = PythonOperator(
+    task_id="maintain_tables",
+    dag=dag,
+    python_callable=maintain_tables,
+    provide_context=True
+)
+
+report_critical_path_task = PythonOperator(
+    task_id="report_critical_path",
+    dag=dag,
+    python_callable=report_critical_path,
+    provide_context=True
 )
 
 end = DummyOperator(task_id='end',  dag=dag)
@@ -226,16 +594,9 @@ check_load_tasks = [check_load_liquor_task,
                    check_load_crime_task, 
                    check_load_temperature_task]
 
-insert_tasks = [insert_sales_fact_task, 
-                insert_county_census_dim_task,
-                insert_item_dim_task,
-                insert_store_dim_task,
-                insert_temperature_dim_task,
-                insert_temperature_dim_task,
-                insert_time_dim_task]
-
 check_insert_tasks = [check_insert_sales_fact_task, 
                       check_insert_county_census_dim_task,
+                      check_insert_city_dim_task,
                       check_insert_item_dim_task,
                       check_insert_store_dim_task,
                       check_insert_temperature_dim_task,
@@ -244,19 +605,53 @@ check_insert_tasks = [check_insert_sales_fact_task,
 
 create_tables_task >> load_data_tasks
 
-load_liquor_data_task      >> check_load_liquor_task     
+load_liquor_data_task      >> check_load_liquor_task
 load_census_data_task      >> check_load_census_task 
 load_crime_data_task       >> check_load_crime_task 
 load_temperature_data_task >> check_load_temperature_task
 
-check_load_tasks >> load_to_insert_dummy >> insert_tasks 
+check_load_tasks >> load_to_insert_dummy
+
+# The crime counties are keyed on their FIPS code before county_census_dim joins them
+[check_load_census_task, check_load_crime_task] >> reconcile_county_keys_task >> insert_county_census_dim_task
+
+# The dimensions are inserted in parallel and each table waits only for the
+# tables it references (REFERENCES clauses of sql_queries)
+insert_tasks_by_table = {'sales_fact': insert_sales_fact_task,
+                         'county_census_dim': insert_county_census_dim_task,
+                         'city_dim': insert_city_dim_task,
+                         'item_dim': insert_item_dim_task,
+                         'store_dim': insert_store_dim_task,
+                         'temperature_dim': insert_temperature_dim_task,
+                         'time_dim': insert_time_dim_task,
+                         'weather_city_dim': insert_weather_city_dim_task}
+table_deps = table_dependencies(sq.create_if_not_exists_queries)
+for table, insert_task in insert_tasks_by_table.items():
+    upstream = table_deps.get(table, set()) & set(insert_tasks_by_table)
+    if upstream:
+        [insert_tasks_by_table[dep] for dep in sorted(upstream)] >> insert_task
+    else:
+        load_to_insert_dummy >> insert_task
 
 insert_sales_fact_task        >> check_insert_sales_fact_task,    
 insert_county_census_dim_task >> check_insert_county_census_dim_task,   
+insert_city_dim_task          >> check_insert_city_dim_task,
 insert_item_dim_task          >> check_insert_item_dim_task,  
 insert_store_dim_task         >> check_insert_store_dim_task, 
 insert_temperature_dim_task   >> check_insert_temperature_dim_task, 
 insert_temperature_dim_task   >> check_insert_temperature_dim_task,
 insert_time_dim_task          >> check_insert_time_dim_task  
 
-check_insert_tasks >> end
\ No newline at end of file
+# The stores are assigned the nearest city with temperatures once both are merged
+[insert_store_dim_task, insert_temperature_dim_task] >> assign_weather_cities_task >> check_insert_store_dim_task
+
+insert_sales_fact_task >> refresh_rollups_task >> check_rollups_task
+
+check_insert_tasks >> update_watermark_task
+# The staging table of the day is dropped once every table reading it is merged
+[insert_sales_fact_task, insert_city_dim_task, insert_item_dim_task,
+ insert_store_dim_task] >> drop_liquor_partition_task
+
+# The tables are maintained once every load and merge of the run is done
+[update_watermark_task, check_rollups_task, drop_liquor_partition_task] >> maintain_tables_task
+maintain_tables_task >> report_critical_path_task >> end
\ No newline at end of file
@@ -0,0 +1,123 @@
+'''
+Ledger of the source files loaded into the staging tables.
+
+A COPY loads whatever its S3 URL points to: a file, or every file under a prefix. Before the
+staging, the objects of the URL are listed with their size and checksum (the ETag of S3, the
+MD5 of a local file) and compared with the load_ledger table, and only the new or changed
+objects are copied, one COPY each, so that the rows of every object are known. A source
+restaged in full (census, crime, temperatures) is copied again as a whole when any of its
+objects changed, and otherwise keeps its staged copy.
+The objects are recorded with their rows by the caller once they are merged, so a run failing
+before the merge stages them again.
+
+The objects are listed from S3, or from the data directory of the DuckDB backend standing in
+for S3 (see backends.py), so the ledger can be tried offline.
+This file is shared by etl.py and the Airflow DAG.
+'''
+
+import collections
+import datetime
+import hashlib
+import os
+import re
+from sql_queries import select_load_ledger, load_ledger_delete, load_ledger_insert
+
+# modified is the naive UTC time the object was last written
+SourceObject = collections.namedtuple('SourceObject', ['url', 'size', 'checksum', 'modified'])
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def copy_source(query):
+    '''
+    Returns the source URL of a COPY statement and whether it is a manifest
+    '''
+    source = re.search(r"\bfrom\s+'([^']+)'", query, re.IGNORECASE).group(1)
+    return source, re.search(r'\bmanifest\b', query, re.IGNORECASE) is not None
+
+
+def s3_objects(client, url):
+    '''
+    Lists the objects of an S3 URL, the object itself or the objects under the prefix
+    '''
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    objects = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            modified = obj['LastModified'].astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            objects.append(SourceObject('s3://{}/{}'.format(bucket, obj['Key']), obj['Size'],
+                                        obj['ETag'].strip('"'), modified))
+    return objects
+
+
+def file_checksum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def local_objects(pool, url):
+    '''
+    Lists the local files standing in for an S3 URL in the data directory of a DuckDB pool,
+    under the URL each of them is read from. Nothing is listed for a missing path, as on S3.
+    '''
+    bucket = url[len('s3://'):].partition('/')[0]
+    try:
+        paths = pool.local_files(url)
+    except FileNotFoundError:
+        return []
+    objects = []
+    for path in paths:
+        key = os.path.relpath(path, pool.data_dir).replace(os.sep, '/')
+        objects.append(SourceObject('s3://{}/{}'.format(bucket, key), os.path.getsize(path), file_checksum(path),
+                                    datetime.datetime.utcfromtimestamp(os.path.getmtime(path))))
+    return objects
+
+
+def object_lister(config, pool):
+    '''
+    Returns the function listing the objects of a URL: the local files of the DuckDB backend,
+    or the S3 objects with the keys of the [AWS] section of dwh.cfg
+    '''
+    if config.get('DB', 'backend', fallback='redshift').strip() == 'duckdb':
+        return lambda url: local_objects(pool, url)
+    import boto3
+    client = boto3.client('s3', aws_access_key_id=config.get('AWS', 'key', fallback=None) or None,
+                          aws_secret_access_key=config.get('AWS', 'secret', fallback=None) or None)
+    return lambda url: s3_objects(client, url)
+
+
+def plan_copies(cur, table, queries, list_objects, full=False):
+    '''
+    Returns (query, object) for the objects of the COPY statements of a staging table that are
+    not in the ledger or changed since they were loaded. With full, every object is copied
+    when any of them is. The COPY of a manifest is one object, the manifest file.
+    '''
+    cur.execute(select_load_ledger, (table,))
+    loaded = {url: (size, checksum) for url, size, checksum in cur.fetchall()}
+    copies = []
+    for query in queries:
+        source, manifest = copy_source(query)
+        for obj in list_objects(source):
+            if manifest:
+                copies.append((query, obj))
+            else:
+                copies.append((query.replace("'{}'".format(source), "'{}'".format(obj.url), 1), obj))
+    changed = [(query, obj) for query, obj in copies if loaded.get(obj.url) != (obj.size, obj.checksum)]
+    if full and changed:
+        return copies
+    return changed
+
+
+def record(cur, table, loads):
+    '''
+    Records the objects copied into a staging table, loads being (object, rows). Does not commit.
+    '''
+    loaded_at = datetime.datetime.utcnow()
+    for obj, rows in loads:
+        cur.execute(load_ledger_delete, (table, obj.url))
+        cur.execute(load_ledger_insert, (table, obj.url, obj.size, obj.checksum, rows, loaded_at))
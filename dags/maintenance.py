@@ -0,0 +1,157 @@
+'''
+ANALYZE and VACUUM of the tables whose health calls for it, after a load.
+
+The COPY statements run with statupdate off and the merges delete and append rows, so after a
+load the planner may work from stale statistics, and sales_fact holds unsorted rows and deleted
+rows not reclaimed yet. The health of every table is read from svv_table_info, and a table over
+a threshold of the [MAINTENANCE] section of dwh.cfg gets:
+
+    stale statistics over analyze_threshold %       ANALYZE
+    unsorted rows over sort_threshold %             VACUUM SORT ONLY
+    deleted rows over delete_threshold %            VACUUM DELETE ONLY
+    both                                            VACUUM FULL
+
+The ANALYZE come first, they are cheap and the plans of the next queries depend on them, then
+the VACUUM, the table with the most MB to reorganize first. They run until budget_seconds is
+spent: an operation expected to outlast the time left, at the seconds per MB of the operations
+of its kind already run, is left to the next load. The staging tables, emptied by every load,
+are not maintained.
+
+On Postgres the health is derived from pg_stat_user_tables: the rows modified since the last
+analyze and the dead rows. It has no sort order, and its VACUUM reclaims the deleted rows.
+DuckDB keeps its statistics as it writes, so its tables are always reported healthy.
+This file is shared by etl.py and the Airflow DAG.
+'''
+
+import collections
+import time
+import connections
+from sql_queries import (select_table_health, select_table_health_postgres, select_table_health_duckdb,
+                         analyze_table, vacuum_sort_table, vacuum_delete_table, vacuum_full_table,
+                         vacuum_postgres_table)
+
+TableHealth = collections.namedtuple('TableHealth', ['table', 'unsorted', 'stats_off', 'deleted', 'rows', 'size_mb'])
+
+Operation = collections.namedtuple('Operation', ['table', 'kind', 'statement', 'reason', 'size_mb'])
+
+HEALTH_QUERIES = {'redshift': select_table_health, 'postgres': select_table_health_postgres,
+                  'duckdb': select_table_health_duckdb}
+
+
+def thresholds(config):
+    '''
+    Returns the thresholds in percent and the time budget in seconds of the [MAINTENANCE] section
+    '''
+    return {'analyze': config.getfloat('MAINTENANCE', 'analyze_threshold', fallback=10),
+            'sort': config.getfloat('MAINTENANCE', 'sort_threshold', fallback=5),
+            'delete': config.getfloat('MAINTENANCE', 'delete_threshold', fallback=5),
+            'budget': config.getfloat('MAINTENANCE', 'budget_seconds', fallback=900)}
+
+
+def read_health(cur, engine):
+    '''
+    Returns the TableHealth of the tables of the current schema, but the staging tables
+    '''
+    cur.execute(HEALTH_QUERIES[engine])
+    return [TableHealth(table.strip(), float(unsorted), float(stats_off), float(deleted), int(rows or 0),
+                        float(size_mb or 0))
+            for table, unsorted, stats_off, deleted, rows, size_mb in cur.fetchall()
+            if not table.strip().startswith('staging_')]
+
+
+def plan(health, limits, engine):
+    '''
+    Returns the Operation due on the tables, in the order they run
+    '''
+    analyzes, vacuums = [], []
+    for table in health:
+        if table.stats_off > limits['analyze']:
+            analyzes.append(Operation(table.table, 'analyze', analyze_table.format(table.table),
+                                      'stats off {:.0f}%'.format(table.stats_off), table.size_mb))
+        # Postgres has no sort order
+        sort = table.unsorted > limits['sort'] and engine != 'postgres'
+        delete = table.deleted > limits['delete']
+        if sort and delete:
+            kind, statement = 'vacuum full', vacuum_full_table
+        elif sort:
+            kind, statement = 'vacuum sort', vacuum_sort_table
+        elif delete and engine == 'postgres':
+            kind, statement = 'vacuum', vacuum_postgres_table
+        elif delete:
+            kind, statement = 'vacuum delete', vacuum_delete_table
+        else:
+            continue
+        reasons, share = [], 0
+        if sort:
+            reasons.append('unsorted {:.0f}%'.format(table.unsorted))
+            share = max(share, table.unsorted)
+        if delete:
+            reasons.append('deleted {:.0f}%'.format(table.deleted))
+            share = max(share, table.deleted)
+        vacuums.append(Operation(table.table, kind, statement.format(table.table), ', '.join(reasons),
+                                 table.size_mb * share / 100))
+    analyzes.sort(key=lambda op: op.size_mb, reverse=True)
+    vacuums.sort(key=lambda op: op.size_mb, reverse=True)
+    return analyzes + vacuums
+
+
+def run_operations(conn, operations, budget_seconds):
+    '''
+    Runs the operations in order until the budget is spent, each in autocommit as VACUUM cannot
+    run in a transaction. Returns (operation, seconds), seconds being None for those left to the
+    next load.
+    '''
+    conn.commit()
+    conn.autocommit = True
+    results, spent = [], collections.defaultdict(lambda: [0.0, 0.0])
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            for op in operations:
+                left = budget_seconds - (time.perf_counter() - start)
+                seconds, size_mb = spent[op.kind]
+                expected = seconds / size_mb * op.size_mb if size_mb else 0
+                if left <= 0 or expected > left:
+                    results.append((op, None))
+                    continue
+                print('Executing {}...'.format(op.statement))
+                began = time.perf_counter()
+                cur.execute(op.statement)
+                # The DuckDB backend opens a transaction for every statement
+                conn.commit()
+                elapsed = time.perf_counter() - began
+                spent[op.kind][0] += elapsed
+                spent[op.kind][1] += op.size_mb
+                results.append((op, elapsed))
+    finally:
+        conn.autocommit = False
+    return results
+
+
+def maintain(conn, config):
+    '''
+    Reads the health of the tables and runs the ANALYZE and VACUUM due within the time budget.
+    Returns (operation, seconds) as run_operations.
+    '''
+    limits, kind = thresholds(config), connections.engine(conn)
+    with conn.cursor() as cur:
+        health = read_health(cur, kind)
+    conn.commit()
+    operations = plan(health, limits, kind)
+    if limits['budget'] <= 0 or not operations:
+        return [(op, None) for op in operations]
+    return run_operations(conn, operations, limits['budget'])
+
+
+def format_report(results):
+    '''
+    Returns the lines of the report of the operations
+    '''
+    lines = ["------------------------------------------------------"]
+    if not results:
+        lines.append('Every table is within the maintenance thresholds')
+    for op, seconds in results:
+        lines.append('{:<25} {:<14} {:<30} {}'.format(
+            op.table, op.kind, op.reason, 'left to the next load' if seconds is None else '{:.1f}s'.format(seconds)))
+    lines.append("------------------------------------------------------")
+    return lines
@@ -0,0 +1,107 @@
+'''
+A small dependency-aware executor for the table loads.
+The dependencies between the final tables are derived from the REFERENCES clauses
+of their CREATE TABLE statements. This file is shared by etl.py and the Airflow DAG.
+'''
+
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def create_target(query):
+    '''
+    Returns the name of the table created by a CREATE TABLE statement
+    '''
+    return re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE).group(1)
+
+
+def insert_target(query):
+    '''
+    Returns the name of the table an INSERT statement writes to
+    '''
+    return re.search(r'INSERT\s+INTO\s+(\w+)', query, re.IGNORECASE).group(1)
+
+
+def table_dependencies(create_queries):
+    '''
+    Maps every table to the set of tables it references
+    '''
+    dependencies = {}
+    for query in create_queries:
+        referenced = re.findall(r'REFERENCES\s+(\w+)', query, re.IGNORECASE)
+        dependencies[create_target(query)] = set(referenced)
+    return dependencies
+
+
+def topological_order(tasks, dependencies):
+    '''
+    Orders the tasks so that every task comes after the tasks it depends on.
+    Dependencies on tables that are not among the tasks are ignored.
+    '''
+    order, done, visiting = [], set(), set()
+
+    def visit(task):
+        if task in done:
+            return
+        if task in visiting:
+            raise ValueError('Dependency cycle involving {}'.format(task))
+        visiting.add(task)
+        for dep in sorted(dependencies.get(task, set()) & set(tasks)):
+            visit(dep)
+        visiting.discard(task)
+        done.add(task)
+        order.append(task)
+
+    for task in tasks:
+        visit(task)
+    return order
+
+
+def run_graph(tasks, dependencies, run, max_workers=4):
+    '''
+    Runs run(task, payload) for every task in tasks ({name: payload}) on a thread pool,
+    starting each task as soon as all of its dependencies have finished.
+    Returns {name: (start, end)} measured with time.perf_counter().
+    '''
+    order = topological_order(tasks, dependencies)
+    pending = {task: dependencies.get(task, set()) & set(tasks) for task in order}
+    timings, running = {}, {}
+
+    def timed(task):
+        start = time.perf_counter()
+        run(task, tasks[task])
+        return start, time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ready = [task for task in order if task in pending and not pending[task] - set(timings)]
+            for task in ready:
+                del pending[task]
+                running[executor.submit(timed, task)] = task
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                timings[task] = future.result()
+    return timings
+
+
+def critical_path(durations, dependencies):
+    '''
+    Finds the chain of dependent tasks with the longest total duration.
+    Returns the tasks of the chain in execution order and its total duration.
+    '''
+    finish, previous = {}, {}
+    for task in topological_order(list(durations), dependencies):
+        deps = dependencies.get(task, set()) & set(durations)
+        before = max(deps, key=lambda dep: finish[dep], default=None)
+        finish[task] = durations[task] + (finish[before] if before else 0)
+        previous[task] = before
+    if not finish:
+        return [], 0
+    task = max(finish, key=finish.get)
+    total, path = finish[task], []
+    while task:
+        path.append(task)
+        task = previous[task]
+    return path[::-1], total
@@ -1,18 +1,30 @@
-import configparser, os
+import configparser, functools, os, re
 
 '''
 This file contains all the SQL statements used in this project.
+
+It is imported by the DAG file, which the scheduler parses every few seconds, so dwh.cfg is
+only read when a task runs: the statements depending on it are templates formatted on first use
+(see __getattr__), and the DAG parses without the config file.
 '''
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+@functools.lru_cache(maxsize=None)
+def get_config():
+    '''
+    Reads dwh.cfg once per process, on first use
+    '''
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    return config
+
 
-S3_CRIME_DATA = config.get('S3', 'crime_data')
-S3_CENSUS_DATA = config.get('S3', 'county_census_data')
-S3_TEMPERATURE_DATA = config.get('S3', 'temperature_data')
-S3_LIQUOR_SALES_DATA = config.get('S3', 'liquor_sales_data')
-DWH_IAM_ROLE_ARN = config.get("IAM_ROLE", "ARN")
+def config_fields():
+    '''
+    Returns the dwh.cfg values of the templates: the S3 URLs of the [S3] section and the IAM role
+    '''
+    config = get_config()
+    return dict(config['S3'], iam=config.get('IAM_ROLE', 'ARN'))
 
 # DROP TABLES
 
@@ -27,6 +39,18 @@ item_dim_table_drop = "DROP TABLE IF EXISTS item_dim;"
 time_dim_table_drop = "DROP TABLE IF EXISTS time_dim;"
 temperature_dim_table_drop = "DROP TABLE IF EXISTS temperature_dim;"
 county_census_dim_table_drop = "DROP TABLE IF EXISTS county_census_dim;"
+city_dim_table_drop = "DROP TABLE IF EXISTS city_dim;"
+weather_city_dim_table_drop = "DROP TABLE IF EXISTS weather_city_dim;"
+staging_store_weather_table_drop = "DROP TABLE IF EXISTS staging_store_weather;"
+staging_store_dim_table_drop = "DROP TABLE IF EXISTS staging_store_dim;"
+staging_item_dim_table_drop = "DROP TABLE IF EXISTS staging_item_dim;"
+store_dim_history_table_drop = "DROP TABLE IF EXISTS store_dim_history;"
+item_dim_history_table_drop = "DROP TABLE IF EXISTS item_dim_history;"
+
+load_watermark_table_drop = "DROP TABLE IF EXISTS load_watermark;"
+table_versions_table_drop = "DROP TABLE IF EXISTS table_versions;"
+dq_results_table_drop = "DROP TABLE IF EXISTS dq_results;"
+load_ledger_table_drop = "DROP TABLE IF EXISTS load_ledger;"
 
 # CREATE TABLES
 staging_liquor_sales_table_create = ("""
@@ -73,7 +97,7 @@ staging_temperature_table_create = ("""
 
 staging_census_table_create = ("""
     CREATE TABLE IF NOT EXISTS staging_census (
-        county_id          INTEGER,
+        county_id          INTEGER DISTKEY SORTKEY,
         state              VARCHAR(30),
         county             VARCHAR(80),
         total_pop          INTEGER,
@@ -138,7 +162,8 @@ staging_crime_table_create = ("""
         arson                 INTEGER,
         population            INTEGER,
         fips_st               INTEGER,
-        fips_cty              INTEGER
+        fips_cty              INTEGER,
+        county_fips           INTEGER DISTKEY SORTKEY
     );
 """)
 
@@ -146,6 +171,7 @@ staging_crime_table_create = ("""
 sales_fact_table_create = ("""
     CREATE TABLE IF NOT EXISTS sales_fact (
         sales_id      INTEGER     IDENTITY(0,1) SORTKEY,
+        invoice_num   VARCHAR(30),
         date          DATE        REFERENCES time_dim (date),
         store_id      INTEGER     REFERENCES store_dim (store_id),
         brand_id      INTEGER,
@@ -153,19 +179,24 @@ sales_fact_table_create = ("""
         sold_count    INTEGER,
         volume_sold   INTEGER,
         sales         DECIMAL(8,2),
-        county        VARCHAR(25) REFERENCES county_census_dim (county),
-        city          VARCHAR(25)
+        county_id     INTEGER     REFERENCES county_census_dim (county_id),
+        city_id       INTEGER     REFERENCES city_dim (city_id)
     );
 """)
 
 store_dim_table_create = ("""
     CREATE TABLE IF NOT EXISTS store_dim (
-        store_id    INTEGER PRIMARY KEY,
-        store_name  VARCHAR(100),
-        address     VARCHAR(200),
-        city        VARCHAR(25),
-        zip_code    VARCHAR(5),
-        county      VARCHAR(25)
+        store_id            INTEGER PRIMARY KEY,
+        store_name          VARCHAR(100),
+        address             VARCHAR(200),
+        city                VARCHAR(25),
+        zip_code            VARCHAR(5),
+        county              VARCHAR(25),
+        longitude           DECIMAL(9,6),
+        latitude            DECIMAL(9,6),
+        weather_city_id     INTEGER REFERENCES weather_city_dim (weather_city_id),
+        weather_distance_km DECIMAL(7,1),
+        row_hash            CHAR(32)
     );
 
 """)
@@ -178,33 +209,42 @@ item_dim_table_create = ("""
     brand_name          VARCHAR(100),
     bottle_volume       INTEGER,
     state_bottle_cost   DECIMAL(8,2),
-    state_bottle_retail DECIMAL(8,2)
+    state_bottle_retail DECIMAL(8,2),
+    row_hash            CHAR(32)
     );
 """)
 
 time_dim_table_create = ("""
     CREATE TABLE IF NOT EXISTS time_dim (
-        date    DATE PRIMARY KEY,
-        year    NUMERIC,
-        month   NUMERIC,
-        day     NUMERIC,
-        weekday NUMERIC
+        date         DATE PRIMARY KEY,
+        year         NUMERIC,
+        month        NUMERIC,
+        day          NUMERIC,
+        weekday      NUMERIC,
+        week         INTEGER,
+        quarter      INTEGER,
+        holiday      VARCHAR(50),
+        us_holiday   BOOLEAN,
+        iowa_holiday BOOLEAN,
+        payday       BOOLEAN
     );
 
 """)
 
 temperature_dim_table_create = ("""
     CREATE TABLE IF NOT EXISTS temperature_dim (
-        date         DATE,
-        city         VARCHAR(25),
-        temperature  DECIMAL(4,1),
+        date            DATE,
+        city            VARCHAR(25),
+        temperature     DECIMAL(4,1),
+        weather_city_id INTEGER REFERENCES weather_city_dim (weather_city_id),
         PRIMARY KEY (date, city)
     );
 """)
 
 county_census_dim_table_create = ("""
     CREATE TABLE IF NOT EXISTS county_census_dim (
-        county                VARCHAR(25) PRIMARY KEY,
+        county_id             INTEGER PRIMARY KEY,
+        county                VARCHAR(25),
         total_pop             INTEGER,
         men                   INTEGER,
         women                 INTEGER,
@@ -224,10 +264,182 @@ county_census_dim_table_create = ("""
     );
 """)
 
+# Integer keys of the cities, so that sales_fact does not repeat the names
+city_dim_table_create = ("""
+    CREATE TABLE IF NOT EXISTS city_dim (
+        city_id  INTEGER IDENTITY(1,1) PRIMARY KEY,
+        city     VARCHAR(25)
+    );
+""")
+
+# Cities of the temperature data with their coordinates, loaded by weather_cities.py.
+# Every store is assigned the nearest one, so that its temperatures join on an integer key.
+weather_city_dim_table_create = ("""
+    CREATE TABLE IF NOT EXISTS weather_city_dim (
+        weather_city_id INTEGER IDENTITY(1,1) PRIMARY KEY,
+        city            VARCHAR(25),
+        state           VARCHAR(25),
+        latitude        DECIMAL(9,6),
+        longitude       DECIMAL(9,6)
+    );
+""")
+
+# Nearest weather city of the stores whose assignment changed, applied to store_dim
+staging_store_weather_table_create = ("""
+    CREATE TABLE IF NOT EXISTS staging_store_weather (
+        store_id            INTEGER,
+        weather_city_id     INTEGER,
+        weather_distance_km DECIMAL(7,1)
+    );
+""")
+
+# Latest version of the stores and items of a batch whose attributes changed, see DIMENSION MERGES
+staging_store_dim_table_create = ("""
+    CREATE TABLE IF NOT EXISTS staging_store_dim (
+        store_id     INTEGER,
+        store_name   VARCHAR(100),
+        address      VARCHAR(200),
+        city         VARCHAR(25),
+        zip_code     VARCHAR(5),
+        county       VARCHAR(25),
+        longitude    DECIMAL(9,6),
+        latitude     DECIMAL(9,6),
+        row_hash     CHAR(32),
+        valid_from   DATE
+    );
+""")
+
+staging_item_dim_table_create = ("""
+    CREATE TABLE IF NOT EXISTS staging_item_dim (
+        item_id             INTEGER,
+        brand_id            INTEGER,
+        item_name           VARCHAR(200),
+        brand_name          VARCHAR(100),
+        bottle_volume       INTEGER,
+        state_bottle_cost   DECIMAL(8,2),
+        state_bottle_retail DECIMAL(8,2),
+        row_hash            CHAR(32),
+        valid_from          DATE
+    );
+""")
+
+# Every version of the stores and items with the days it was valid, from the first day it was
+# sold under to the first day of the next version (NULL for the current one).
+# Kept when dimension_history is set in the [ETL] section of dwh.cfg.
+store_dim_history_table_create = ("""
+    CREATE TABLE IF NOT EXISTS store_dim_history (
+        store_id     INTEGER SORTKEY,
+        store_name   VARCHAR(100),
+        address      VARCHAR(200),
+        city         VARCHAR(25),
+        zip_code     VARCHAR(5),
+        county       VARCHAR(25),
+        longitude    DECIMAL(9,6),
+        latitude     DECIMAL(9,6),
+        row_hash     CHAR(32),
+        valid_from   DATE,
+        valid_to     DATE
+    );
+""")
+
+item_dim_history_table_create = ("""
+    CREATE TABLE IF NOT EXISTS item_dim_history (
+        item_id             INTEGER SORTKEY,
+        brand_id            INTEGER,
+        item_name           VARCHAR(200),
+        brand_name          VARCHAR(100),
+        bottle_volume       INTEGER,
+        state_bottle_cost   DECIMAL(8,2),
+        state_bottle_retail DECIMAL(8,2),
+        row_hash            CHAR(32),
+        valid_from          DATE,
+        valid_to            DATE
+    );
+""")
+
+# CONTROL TABLES
+load_watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_watermark (
+        table_name        VARCHAR(50) PRIMARY KEY,
+        max_date          DATE,
+        max_invoice_num   VARCHAR(30),
+        last_source_mtime TIMESTAMP,
+        updated_at        TIMESTAMP
+    );
+""")
+
+# Time each table was last loaded. The query service polls it to invalidate its cache.
+table_versions_table_create = ("""
+    CREATE TABLE IF NOT EXISTS table_versions (
+        table_name VARCHAR(50) PRIMARY KEY,
+        loaded_at  TIMESTAMP
+    );
+""")
+
+# Stamps the load time of a table. Takes the table name; the last statements of the merge of the
+# table, since the DELETE holds the write lock of table_versions, shared by the merges run in
+# parallel, until the merge commits.
+table_version_delete = "DELETE FROM table_versions WHERE table_name = '{}'"
+table_version_insert = "INSERT INTO table_versions (table_name, loaded_at) VALUES ('{}', GETDATE())"
+
+# History of the data quality checks of data_quality.py, one row per check and run
+dq_results_table_create = ("""
+    CREATE TABLE IF NOT EXISTS dq_results (
+        run_id     VARCHAR(250),
+        checked_at TIMESTAMP,
+        table_name VARCHAR(50),
+        check_name VARCHAR(100),
+        metric     DOUBLE PRECISION,
+        passed     BOOLEAN
+    );
+""")
+
+# Source files loaded into the staging tables, see load_ledger.py
+load_ledger_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_ledger (
+        table_name VARCHAR(50),
+        source_url VARCHAR(1024),
+        size       BIGINT,
+        checksum   VARCHAR(64),
+        row_count  BIGINT,
+        loaded_at  TIMESTAMP,
+        PRIMARY KEY (table_name, source_url)
+    );
+""")
+
+load_ledger_clear = "DELETE FROM load_ledger;"
+select_load_ledger = "SELECT source_url, size, checksum FROM load_ledger WHERE table_name = %s"
+load_ledger_delete = "DELETE FROM load_ledger WHERE table_name = %s AND source_url = %s"
+load_ledger_insert = ("INSERT INTO load_ledger (table_name, source_url, size, checksum, row_count, loaded_at) "
+                      "VALUES (%s, %s, %s, %s, %s, %s)")
+
+# Metrics of the previous run of the checks of a table
+select_previous_dq_results = ("""
+    SELECT check_name, metric
+    FROM   dq_results
+    WHERE  table_name = %s
+    AND    run_id = (SELECT run_id FROM dq_results WHERE table_name = %s ORDER BY checked_at DESC LIMIT 1)
+""")
+
+# Columns of the existing tables, compared with the CREATE statements by migrations.py
+select_catalog_columns = ("""
+    SELECT   table_name, column_name, data_type, character_maximum_length, numeric_precision, numeric_scale
+    FROM     information_schema.columns
+    WHERE    table_schema = current_schema()
+    ORDER BY table_name, ordinal_position
+""")
 
 
 # Copy S3 data to STAGING TABLES
-load_data_from_S3 = ("""
+# Columns of the source files, when the staging table has columns derived after the load
+staging_copy_columns = {
+    'staging_crime': ('(county_name, crime_rate_per_100000, index_1, edition, part, idno, cpoparst, cpopcrim, '
+                      'ag_arrst, ag_off, covind, index_2, modindx, murder, rape, robbery, agasslt, burglry, '
+                      'larceny, mvtheft, arson, population, fips_st, fips_cty)'),
+}
+
+# Templates of the dwh.cfg values, formatted on first use
+load_data_from_S3_template = ("""
     copy {{}}
     from {{}}
     region 'us-west-2'
@@ -236,111 +448,125 @@ load_data_from_S3 = ("""
     format as csv
     ignoreheader 1 
     DATEFORMAT AS 'MM/DD/YYYY'
-""").format(iam = DWH_IAM_ROLE_ARN)
+""")
 
 
-copy_from_s3_to_staging_census_table = ("""
+copy_from_s3_to_staging_census_table_template = ("""
     copy staging_census
-    from {}
+    from {county_census_data}
     region 'us-west-2'
-    iam_role '{}'
+    iam_role '{iam}'
     compupdate off statupdate off
     format as csv
     ignoreheader 1 
-""").format(S3_CENSUS_DATA, DWH_IAM_ROLE_ARN)
+""")
 
-copy_from_s3_to_staging_crime_table = ("""
-    copy staging_crime
-    from {}
+copy_from_s3_to_staging_crime_table_template = ("""
+    copy staging_crime {staging_crime_columns}
+    from {crime_data}
     region 'us-west-2'
-    iam_role '{}'
+    iam_role '{iam}'
     compupdate off statupdate off
     format as csv
     ignoreheader 1 
-""").format(S3_CRIME_DATA , DWH_IAM_ROLE_ARN)
+""")
 
-copy_from_s3_to_staging_temperature_table = ("""
+copy_from_s3_to_staging_temperature_table_template = ("""
     copy staging_temperature
-    from {}
+    from {temperature_data}
     region 'us-west-2'
-    iam_role '{}'
+    iam_role '{iam}'
     json 'auto'
-""").format(S3_TEMPERATURE_DATA , DWH_IAM_ROLE_ARN)
+""")
 
-copy_from_s3_to_staging_liquor_sales_table = ("""
+copy_from_s3_to_staging_liquor_sales_table_template = ("""
     copy staging_liquor_sales
-    from {}
+    from {liquor_sales_data}
     region 'us-west-2'
-    iam_role '{}'
+    iam_role '{iam}'
     compupdate off statupdate off
     format as csv
     ignoreheader 1 
     DATEFORMAT AS 'MM/DD/YYYY'
-""").format(S3_LIQUOR_SALES_DATA , DWH_IAM_ROLE_ARN)
+""")
+
+# Copy the compressed parts listed in a manifest written by split_files.py.
+# The parts have no header line. Takes the table, the quoted manifest URL,
+# the compression (gzip or zstd) and the data format of the table.
+load_manifest_from_S3_template = ("""
+    copy {{}}
+    from {{}}
+    region 'us-west-2'
+    iam_role '{iam}'
+    manifest
+    {{}}
+    compupdate off statupdate off
+    {{}}
+""")
 
+# Statements formatted from their template on first use
+config_templates = {
+    'load_data_from_S3': load_data_from_S3_template,
+    'copy_from_s3_to_staging_census_table': copy_from_s3_to_staging_census_table_template,
+    'copy_from_s3_to_staging_crime_table': copy_from_s3_to_staging_crime_table_template,
+    'copy_from_s3_to_staging_temperature_table': copy_from_s3_to_staging_temperature_table_template,
+    'copy_from_s3_to_staging_liquor_sales_table': copy_from_s3_to_staging_liquor_sales_table_template,
+    'load_manifest_from_S3': load_manifest_from_S3_template,
+}
+
+
+def __getattr__(name):
+    '''
+    Formats a statement depending on dwh.cfg when it is first read, and keeps it
+    '''
+    if name not in config_templates:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    query = globals()[name] = config_templates[name].format(
+        staging_crime_columns=staging_copy_columns['staging_crime'], **config_fields())
+    return query
+
+staging_data_formats = {
+    'staging_liquor_sales': "format as csv DATEFORMAT AS 'MM/DD/YYYY'",
+    'staging_census': "format as csv",
+    'staging_crime': "format as csv",
+    'staging_temperature': "json 'auto'"
+}
 
 # POPULATING FINAL TABLES W/ INSERT SELECT
 
+# The Iowa county numbers of the sales data (1 to 99) follow the alphabetical order of the
+# counties, like their FIPS codes (19001 to 19197, odd numbers only), so the FIPS key is computed.
 sales_fact_table_insert = ("""
-    INSERT INTO sales_fact (date, store_id, brand_id, item_id, sold_count, volume_sold, sales, county, city)
-    SELECT sls.date,
+    INSERT INTO sales_fact (invoice_num, date, store_id, brand_id, item_id, sold_count, volume_sold, sales, county_id, city_id)
+    SELECT sls.invoice_num,
+           sls.date,
            sls.store_num                                            AS store_id,
            sls.vendor_num                                           AS brand_id,
            sls.item_num                                             AS item_id,
            sls.bottle_sold                                          AS sold_count,
            sls.volume_sold_ltr                                      AS volume_sold,
            TO_NUMBER(RIGHT(sls.sale, LEN(sls.sale)-1), '99999D99')  AS sales,
-           sls.county_name                                          AS county,
-           sls.city                        
-    FROM   staging_liquor_sales sls    
-""")
-
-store_dim_table_insert = ("""
-    INSERT INTO store_dim (store_id, store_name, address, city, zip_code, county)
-    SELECT DISTINCT sls.store_num   AS store_id,
-                    sls.store_name,
-                    sls.address,
-                    sls.city,
-                    sls.zip         AS zip_code,
-                    sls.county_name AS county
-    FROM            staging_liquor_sales sls
-""")
-
-
-item_dim_table_insert = ("""
-    INSERT INTO item_dim (item_id, brand_id, item_name, brand_name, bottle_volume, state_bottle_cost, state_bottle_retail)
-    SELECT DISTINCT sls.item_num    AS item_id,
-                    sls.vendor_num  AS brand_id,
-                    sls.item_name,
-                    sls.vendor_name AS brand_name,
-                    sls.bottle_volume,
-                    TO_NUMBER(RIGHT(sls.state_bottle_cost, LEN(sls.sale)-1), '99999D99'),
-                    TO_NUMBER(RIGHT(sls.state_bottle_retail, LEN(sls.sale)-1), '99999D99')
-    FROM            staging_liquor_sales sls
-""")
-
-time_dim_table_insert = ("""
-    INSERT INTO time_dim (date, year, month, day, weekday)
-    SELECT DISTINCT sls.date,
-                    EXTRACT(yr FROM sls.date)  AS year,
-                    EXTRACT(mon FROM sls.date) AS month,
-                    EXTRACT(d FROM sls.date)   AS day,
-                    EXTRACT(dw FROM sls.date)   AS weekday
-    FROM            staging_liquor_sales sls
+           CASE WHEN sls.county_num BETWEEN 1 AND 99 THEN 19000 + 2 * sls.county_num - 1 END AS county_id,
+           cty.city_id
+    FROM   staging_liquor_sales sls
+    LEFT JOIN city_dim cty ON cty.city = INITCAP(TRIM(sls.city))
 """)
 
 temperature_dim_table_insert = ("""
-    INSERT INTO temperature_dim (date, city, temperature)
-    SELECT DISTINCT TO_DATE(CONCAT(year::TEXT, CONCAT(RIGHT((100+month)::VARCHAR, 2), RIGHT((100+day)::VARCHAR, 2))), 'YYYYMMDD') AS date,
-                    city,
-                    temperature
-    FROM staging_temperature
-    WHERE country = 'US' AND state = 'Iowa'
+    INSERT INTO temperature_dim (date, city, temperature, weather_city_id)
+    SELECT DISTINCT TO_DATE(CONCAT(tmp.year::TEXT, CONCAT(RIGHT((100+tmp.month)::VARCHAR, 2), RIGHT((100+tmp.day)::VARCHAR, 2))), 'YYYYMMDD') AS date,
+                    tmp.city,
+                    tmp.temperature,
+                    wc.weather_city_id
+    FROM staging_temperature tmp
+    LEFT JOIN weather_city_dim wc ON wc.city = tmp.city AND wc.state = tmp.state
+    WHERE tmp.country = 'US' AND tmp.state = 'Iowa'
 """)
 
 county_census_dim_table_insert = ("""
-    INSERT INTO county_census_dim (county, total_pop, men, women, hispanic, white, black, native, asian, pacific, voting_age_citizen, income, income_per_cap, poverty, child_poverty, unemployment, crime_rate_per_100000)
-    SELECT DISTINCT LEFT(cen.county, LEN(cen.county) - 7) AS county,
+    INSERT INTO county_census_dim (county_id, county, total_pop, men, women, hispanic, white, black, native, asian, pacific, voting_age_citizen, income, income_per_cap, poverty, child_poverty, unemployment, crime_rate_per_100000)
+    SELECT DISTINCT cen.county_id,
+                    LEFT(cen.county, LEN(cen.county) - 7) AS county,
                     cen.total_pop,
                     cen.men,
                     cen.women,
@@ -358,11 +584,638 @@ county_census_dim_table_insert = ("""
                     cen.unemployment, 
                     cri.crime_rate_per_100000
     FROM            staging_census cen
-    INNER JOIN staging_crime cri ON LEFT(cen.county, LEN(cen.county) - 7) = LEFT(cri.county_name, LEN(cri.county_name) - 11)
-    WHERE cen.state = 'Iowa' AND RIGHT(cri.county_name, 2) = 'IA'
+    INNER JOIN staging_crime cri ON cri.county_fips = cen.county_id
+    WHERE cen.state = 'Iowa'
     
 """)
 
+city_dim_table_insert = ("""
+    INSERT INTO city_dim (city)
+    SELECT DISTINCT INITCAP(TRIM(sls.city))
+    FROM   staging_liquor_sales sls
+    WHERE  sls.city IS NOT NULL
+    AND    INITCAP(TRIM(sls.city)) NOT IN (SELECT city FROM city_dim)
+""")
+
+
+# ROLLUP TABLES
+# Pre-aggregated sales for the dashboards. The dates touched by each sales_fact merge are
+# queued in rollup_pending_dates, and only those dates (and their months) are re-aggregated.
+rollup_pending_dates_table_drop = "DROP TABLE IF EXISTS rollup_pending_dates;"
+daily_store_item_sales_table_drop = "DROP TABLE IF EXISTS daily_store_item_sales;"
+monthly_county_sales_table_drop = "DROP TABLE IF EXISTS monthly_county_sales;"
+monthly_city_sales_table_drop = "DROP TABLE IF EXISTS monthly_city_sales;"
+monthly_brand_sales_table_drop = "DROP TABLE IF EXISTS monthly_brand_sales;"
+
+rollup_pending_dates_table_create = ("""
+    CREATE TABLE IF NOT EXISTS rollup_pending_dates (
+        date DATE PRIMARY KEY
+    );
+""")
+
+daily_store_item_sales_table_create = ("""
+    CREATE TABLE IF NOT EXISTS daily_store_item_sales (
+        date        DATE,
+        store_id    INTEGER,
+        item_id     INTEGER,
+        brand_id    INTEGER,
+        county      VARCHAR(25),
+        city        VARCHAR(25),
+        sold_count  BIGINT,
+        volume_sold BIGINT,
+        sales       DECIMAL(18,2),
+        sales_rows  BIGINT
+    );
+""")
+
+monthly_county_sales_table_create = ("""
+    CREATE TABLE IF NOT EXISTS monthly_county_sales (
+        year        INTEGER,
+        month       INTEGER,
+        county      VARCHAR(25),
+        sold_count  BIGINT,
+        volume_sold BIGINT,
+        sales       DECIMAL(18,2),
+        sales_rows  BIGINT
+    );
+""")
+
+monthly_city_sales_table_create = ("""
+    CREATE TABLE IF NOT EXISTS monthly_city_sales (
+        year        INTEGER,
+        month       INTEGER,
+        city        VARCHAR(25),
+        sold_count  BIGINT,
+        volume_sold BIGINT,
+        sales       DECIMAL(18,2),
+        sales_rows  BIGINT
+    );
+""")
+
+monthly_brand_sales_table_create = ("""
+    CREATE TABLE IF NOT EXISTS monthly_brand_sales (
+        year        INTEGER,
+        month       INTEGER,
+        brand_id    INTEGER,
+        sold_count  BIGINT,
+        volume_sold BIGINT,
+        sales       DECIMAL(18,2),
+        sales_rows  BIGINT
+    );
+""")
+
+# Queues the staged dates. Takes the staging table; part of the sales_fact merge
+# so that both commit together.
+rollup_pending_dates_insert = ("""
+    INSERT INTO rollup_pending_dates (date)
+    SELECT DISTINCT sls.date
+    FROM   {} sls
+    WHERE  sls.date IS NOT NULL
+    AND    sls.date NOT IN (SELECT date FROM rollup_pending_dates)
+""")
+
+# Queues every loaded date, to build the rollups of an existing sales_fact
+rollup_pending_dates_backfill = ("""
+    INSERT INTO rollup_pending_dates (date)
+    SELECT DISTINCT date
+    FROM   sales_fact
+    WHERE  date IS NOT NULL
+    AND    date NOT IN (SELECT date FROM rollup_pending_dates)
+""")
+
+daily_store_item_sales_delete = ("""
+    DELETE FROM daily_store_item_sales
+    USING  rollup_pending_dates p
+    WHERE  daily_store_item_sales.date = p.date
+""")
+
+daily_store_item_sales_insert = ("""
+    INSERT INTO daily_store_item_sales (date, store_id, item_id, brand_id, county, city, sold_count, volume_sold, sales, sales_rows)
+    SELECT   f.date,
+             f.store_id,
+             f.item_id,
+             f.brand_id,
+             cen.county,
+             cty.city,
+             SUM(f.sold_count),
+             SUM(f.volume_sold),
+             SUM(f.sales),
+             COUNT(*)
+    FROM     sales_fact f
+    JOIN     rollup_pending_dates p ON f.date = p.date
+    LEFT JOIN county_census_dim cen ON f.county_id = cen.county_id
+    LEFT JOIN city_dim cty ON f.city_id = cty.city_id
+    GROUP BY f.date, f.store_id, f.item_id, f.brand_id, cen.county, cty.city
+""")
+
+# The months of the pending dates, which the monthly rollups rebuild from the daily one
+pending_months = ("""
+    SELECT DISTINCT EXTRACT(yr FROM date)::INTEGER  AS year,
+                    EXTRACT(mon FROM date)::INTEGER AS month
+    FROM   rollup_pending_dates
+""")
+
+monthly_county_sales_delete = ("""
+    DELETE FROM monthly_county_sales
+    USING  ({}) pm
+    WHERE  monthly_county_sales.year = pm.year
+    AND    monthly_county_sales.month = pm.month
+""").format(pending_months)
+
+monthly_county_sales_insert = ("""
+    INSERT INTO monthly_county_sales (year, month, county, sold_count, volume_sold, sales, sales_rows)
+    SELECT   pm.year,
+             pm.month,
+             d.county,
+             SUM(d.sold_count),
+             SUM(d.volume_sold),
+             SUM(d.sales),
+             SUM(d.sales_rows)
+    FROM     daily_store_item_sales d
+    JOIN     ({}) pm
+    ON       EXTRACT(yr FROM d.date) = pm.year AND EXTRACT(mon FROM d.date) = pm.month
+    GROUP BY pm.year, pm.month, d.county
+""").format(pending_months)
+
+monthly_city_sales_delete = ("""
+    DELETE FROM monthly_city_sales
+    USING  ({}) pm
+    WHERE  monthly_city_sales.year = pm.year
+    AND    monthly_city_sales.month = pm.month
+""").format(pending_months)
+
+monthly_city_sales_insert = ("""
+    INSERT INTO monthly_city_sales (year, month, city, sold_count, volume_sold, sales, sales_rows)
+    SELECT   pm.year,
+             pm.month,
+             d.city,
+             SUM(d.sold_count),
+             SUM(d.volume_sold),
+             SUM(d.sales),
+             SUM(d.sales_rows)
+    FROM     daily_store_item_sales d
+    JOIN     ({}) pm
+    ON       EXTRACT(yr FROM d.date) = pm.year AND EXTRACT(mon FROM d.date) = pm.month
+    GROUP BY pm.year, pm.month, d.city
+""").format(pending_months)
+
+monthly_brand_sales_delete = ("""
+    DELETE FROM monthly_brand_sales
+    USING  ({}) pm
+    WHERE  monthly_brand_sales.year = pm.year
+    AND    monthly_brand_sales.month = pm.month
+""").format(pending_months)
+
+monthly_brand_sales_insert = ("""
+    INSERT INTO monthly_brand_sales (year, month, brand_id, sold_count, volume_sold, sales, sales_rows)
+    SELECT   pm.year,
+             pm.month,
+             d.brand_id,
+             SUM(d.sold_count),
+             SUM(d.volume_sold),
+             SUM(d.sales),
+             SUM(d.sales_rows)
+    FROM     daily_store_item_sales d
+    JOIN     ({}) pm
+    ON       EXTRACT(yr FROM d.date) = pm.year AND EXTRACT(mon FROM d.date) = pm.month
+    GROUP BY pm.year, pm.month, d.brand_id
+""").format(pending_months)
+
+rollup_pending_dates_clear = "DELETE FROM rollup_pending_dates;"
+
+# Run in a single transaction, the queue is only emptied once every rollup is refreshed
+refresh_rollup_queries = [
+    daily_store_item_sales_delete,
+    daily_store_item_sales_insert,
+    monthly_county_sales_delete,
+    monthly_county_sales_insert,
+    monthly_city_sales_delete,
+    monthly_city_sales_insert,
+    monthly_brand_sales_delete,
+    monthly_brand_sales_insert,
+    rollup_pending_dates_clear,
+    table_version_delete.format('daily_store_item_sales'),
+    table_version_insert.format('daily_store_item_sales'),
+    table_version_delete.format('monthly_county_sales'),
+    table_version_insert.format('monthly_county_sales'),
+    table_version_delete.format('monthly_city_sales'),
+    table_version_insert.format('monthly_city_sales'),
+    table_version_delete.format('monthly_brand_sales'),
+    table_version_insert.format('monthly_brand_sales')
+]
+
+# Totals of sales_fact and of every rollup, which must all be equal
+reconcile_rollups = ("""
+    SELECT 'sales_fact' AS source, COUNT(*) AS sales_rows, COALESCE(SUM(sold_count), 0) AS sold_count,
+           COALESCE(SUM(volume_sold), 0) AS volume_sold, COALESCE(SUM(sales), 0) AS sales
+    FROM   sales_fact
+    WHERE  date IS NOT NULL
+    UNION ALL
+    SELECT 'daily_store_item_sales', COALESCE(SUM(sales_rows), 0), COALESCE(SUM(sold_count), 0),
+           COALESCE(SUM(volume_sold), 0), COALESCE(SUM(sales), 0)
+    FROM   daily_store_item_sales
+    UNION ALL
+    SELECT 'monthly_county_sales', COALESCE(SUM(sales_rows), 0), COALESCE(SUM(sold_count), 0),
+           COALESCE(SUM(volume_sold), 0), COALESCE(SUM(sales), 0)
+    FROM   monthly_county_sales
+    UNION ALL
+    SELECT 'monthly_city_sales', COALESCE(SUM(sales_rows), 0), COALESCE(SUM(sold_count), 0),
+           COALESCE(SUM(volume_sold), 0), COALESCE(SUM(sales), 0)
+    FROM   monthly_city_sales
+    UNION ALL
+    SELECT 'monthly_brand_sales', COALESCE(SUM(sales_rows), 0), COALESCE(SUM(sold_count), 0),
+           COALESCE(SUM(volume_sold), 0), COALESCE(SUM(sales), 0)
+    FROM   monthly_brand_sales
+""")
+
+
+# COUNTY KEYS
+# The census and crime counties are joined on their FIPS code: county_id of the census is the
+# 5-digit code, and the crime data has the state and county parts, combined into county_fips once
+# staged by county_keys.py. The typed files of normalize.py already hold county_fips.
+staging_crime_fips_update = ("""
+    UPDATE staging_crime
+    SET    county_fips = fips_st * 1000 + fips_cty
+    WHERE  fips_st IS NOT NULL AND fips_cty IS NOT NULL
+""")
+
+# Iowa counties of either source without a match in the other. Takes the census and crime tables.
+county_key_reconciliation = ("""
+    SELECT   'census' AS source, cen.county_id AS county_fips, cen.county AS county_name, 'no crime row' AS issue
+    FROM     {0} cen
+    LEFT JOIN {1} cri ON cri.county_fips = cen.county_id
+    WHERE    cen.state = 'Iowa' AND cri.county_fips IS NULL
+    UNION ALL
+    SELECT   'crime', cri.county_fips, cri.county_name,
+             CASE WHEN cri.county_fips IS NULL THEN 'no FIPS code' ELSE 'no census row' END
+    FROM     {1} cri
+    LEFT JOIN {0} cen ON cen.county_id = cri.county_fips
+    WHERE    (cri.fips_st = 19 OR cri.county_fips IS NULL) AND cen.county_id IS NULL
+    ORDER BY 2, 1
+""")
+
+
+# CALENDAR
+# time_dim is generated by calendar_dim.py for a range of days rather than derived from the
+# staged sales. Rows without week were loaded before the calendar attributes existed.
+select_time_dim_coverage = "SELECT MIN(date), MAX(date), COUNT(*), COUNT(week) FROM time_dim;"
+select_complete_time_dim_dates = "SELECT date FROM time_dim WHERE week IS NOT NULL;"
+time_dim_incomplete_delete = "DELETE FROM time_dim WHERE week IS NULL;"
+# Followed by the rows, as a multi-row VALUES list
+time_dim_rows_insert = ("INSERT INTO time_dim (date, year, month, day, weekday, week, quarter, holiday, "
+                        "us_holiday, iowa_holiday, payday) VALUES ")
+# Stamps time_dim in table_versions, takes the UTC time of the load
+time_dim_version_insert = "INSERT INTO table_versions (table_name, loaded_at) VALUES ('time_dim', %s);"
+# Takes the staging table
+select_staged_date_range = "SELECT MIN(date), MAX(date) FROM {};"
+
+
+# WEATHER CITIES
+# Loaded by weather_cities.py. The cities and the stores are read and the nearest city of every
+# store is computed in Python, the changed assignments are then applied in one UPDATE.
+select_weather_cities = "SELECT city, state FROM weather_city_dim;"
+# Followed by the rows, as a multi-row VALUES list
+weather_city_insert = "INSERT INTO weather_city_dim (city, state, latitude, longitude) VALUES "
+# The candidates of the stores are the cities with temperatures
+select_measured_weather_cities = ("""
+    SELECT weather_city_id, latitude, longitude
+    FROM   weather_city_dim
+    WHERE  weather_city_id IN (SELECT DISTINCT weather_city_id FROM temperature_dim)
+""")
+select_store_locations = ("""
+    SELECT store_id, latitude, longitude, weather_city_id
+    FROM   store_dim
+    WHERE  latitude IS NOT NULL AND longitude IS NOT NULL
+""")
+staging_store_weather_clear = "DELETE FROM staging_store_weather;"
+# Followed by the rows, as a multi-row VALUES list
+staging_store_weather_insert = "INSERT INTO staging_store_weather (store_id, weather_city_id, weather_distance_km) VALUES "
+store_dim_weather_update = ("""
+    UPDATE store_dim
+    SET    weather_city_id = sw.weather_city_id,
+           weather_distance_km = sw.weather_distance_km
+    FROM   staging_store_weather sw
+    WHERE  store_dim.store_id = sw.store_id
+""")
+
+
+# DIMENSION MERGES
+# store_dim and item_dim hold one row per store and item. The staged sales repeat the attributes
+# of a store or item on every row, and they change over time (names, addresses, prices), so the
+# latest version of every staged key is hashed (MD5 of its attributes) into staging_store_dim and
+# staging_item_dim, and only the keys whose hash differs from the dimension are replaced.
+# With dimension_history, the previous version of a replaced key is closed in the history table
+# and the new one opened (type-2), valid from the first day it was sold under.
+# Takes the staging table of the sales.
+store_dim_changes_insert_template = ("""
+    INSERT INTO staging_store_dim (store_id, store_name, address, city, zip_code, county, longitude, latitude, row_hash, valid_from)
+    SELECT ver.store_id, ver.store_name, ver.address, ver.city, ver.zip_code, ver.county, ver.longitude, ver.latitude,
+           ver.row_hash, ver.valid_from
+    FROM (
+        SELECT   att.store_id, att.store_name, att.address, att.city, att.zip_code, att.county, att.longitude, att.latitude,
+                 MD5(COALESCE(att.store_name, '') || '|' || COALESCE(att.address, '') || '|' || COALESCE(att.city, '') || '|' ||
+                     COALESCE(att.zip_code, '') || '|' || COALESCE(att.county, '') || '|' ||
+                     COALESCE(CAST(att.longitude AS VARCHAR), '') || '|' || COALESCE(CAST(att.latitude AS VARCHAR), '')) AS row_hash,
+                 MIN(att.date) AS valid_from,
+                 ROW_NUMBER() OVER (PARTITION BY att.store_id ORDER BY MAX(att.date) DESC, MIN(att.date) DESC) AS version
+        FROM (
+            SELECT sls.store_num   AS store_id,
+                   sls.store_name,
+                   sls.address,
+                   sls.city,
+                   sls.zip         AS zip_code,
+                   sls.county_name AS county,
+                   CASE WHEN sls.store_location LIKE 'POINT (%'
+                        THEN CAST(SPLIT_PART(TRIM(REPLACE(REPLACE(sls.store_location, 'POINT (', ''), ')', '')), ' ', 1) AS DECIMAL(9,6))
+                   END             AS longitude,
+                   CASE WHEN sls.store_location LIKE 'POINT (%'
+                        THEN CAST(SPLIT_PART(TRIM(REPLACE(REPLACE(sls.store_location, 'POINT (', ''), ')', '')), ' ', 2) AS DECIMAL(9,6))
+                   END             AS latitude,
+                   sls.date
+            FROM   {} sls
+            WHERE  sls.store_num IS NOT NULL
+        ) att
+        GROUP BY att.store_id, att.store_name, att.address, att.city, att.zip_code, att.county, att.longitude, att.latitude
+    ) ver
+    LEFT JOIN store_dim cur ON cur.store_id = ver.store_id
+    WHERE ver.version = 1 AND (cur.row_hash IS NULL OR cur.row_hash <> ver.row_hash)
+""")
+
+# Takes the staging table of the sales and the expressions of the bottle cost and retail price
+item_dim_changes_insert_template = ("""
+    INSERT INTO staging_item_dim (item_id, brand_id, item_name, brand_name, bottle_volume, state_bottle_cost, state_bottle_retail, row_hash, valid_from)
+    SELECT ver.item_id, ver.brand_id, ver.item_name, ver.brand_name, ver.bottle_volume, ver.state_bottle_cost, ver.state_bottle_retail,
+           ver.row_hash, ver.valid_from
+    FROM (
+        SELECT   att.item_id, att.brand_id, att.item_name, att.brand_name, att.bottle_volume, att.state_bottle_cost, att.state_bottle_retail,
+                 MD5(COALESCE(CAST(att.brand_id AS VARCHAR), '') || '|' || COALESCE(att.item_name, '') || '|' ||
+                     COALESCE(att.brand_name, '') || '|' || COALESCE(CAST(att.bottle_volume AS VARCHAR), '') || '|' ||
+                     COALESCE(CAST(att.state_bottle_cost AS VARCHAR), '') || '|' ||
+                     COALESCE(CAST(att.state_bottle_retail AS VARCHAR), '')) AS row_hash,
+                 MIN(att.date) AS valid_from,
+                 ROW_NUMBER() OVER (PARTITION BY att.item_id ORDER BY MAX(att.date) DESC, MIN(att.date) DESC) AS version
+        FROM (
+            SELECT sls.item_num    AS item_id,
+                   sls.vendor_num  AS brand_id,
+                   sls.item_name,
+                   sls.vendor_name AS brand_name,
+                   sls.bottle_volume,
+                   CAST({1} AS DECIMAL(8,2)) AS state_bottle_cost,
+                   CAST({2} AS DECIMAL(8,2)) AS state_bottle_retail,
+                   sls.date
+            FROM   {0} sls
+            WHERE  sls.item_num IS NOT NULL
+        ) att
+        GROUP BY att.item_id, att.brand_id, att.item_name, att.brand_name, att.bottle_volume, att.state_bottle_cost, att.state_bottle_retail
+    ) ver
+    LEFT JOIN item_dim cur ON cur.item_id = ver.item_id
+    WHERE ver.version = 1 AND (cur.row_hash IS NULL OR cur.row_hash <> ver.row_hash)
+""")
+
+store_dim_changes_insert = store_dim_changes_insert_template.format('staging_liquor_sales')
+item_dim_changes_insert = item_dim_changes_insert_template.format(
+    'staging_liquor_sales',
+    "TO_NUMBER(RIGHT(sls.state_bottle_cost, LEN(sls.state_bottle_cost)-1), '99999D99')",
+    "TO_NUMBER(RIGHT(sls.state_bottle_retail, LEN(sls.state_bottle_retail)-1), '99999D99')")
+
+dimension_changes_inserts = {'store_dim': store_dim_changes_insert, 'item_dim': item_dim_changes_insert}
+
+staging_dimension_clear = "DELETE FROM staging_{};"
+
+# Closes the current version of the changed keys, then opens their new one
+store_dim_history_close = ("""
+    UPDATE store_dim_history
+    SET    valid_to = GREATEST(store_dim_history.valid_from, chg.valid_from)
+    FROM   staging_store_dim chg
+    WHERE  store_dim_history.store_id = chg.store_id
+    AND    store_dim_history.valid_to IS NULL
+""")
+
+store_dim_history_insert = ("""
+    INSERT INTO store_dim_history (store_id, store_name, address, city, zip_code, county, longitude, latitude, row_hash, valid_from)
+    SELECT store_id, store_name, address, city, zip_code, county, longitude, latitude, row_hash, valid_from
+    FROM   staging_store_dim
+""")
+
+item_dim_history_close = ("""
+    UPDATE item_dim_history
+    SET    valid_to = GREATEST(item_dim_history.valid_from, chg.valid_from)
+    FROM   staging_item_dim chg
+    WHERE  item_dim_history.item_id = chg.item_id
+    AND    item_dim_history.valid_to IS NULL
+""")
+
+item_dim_history_insert = ("""
+    INSERT INTO item_dim_history (item_id, brand_id, item_name, brand_name, bottle_volume, state_bottle_cost, state_bottle_retail, row_hash, valid_from)
+    SELECT item_id, brand_id, item_name, brand_name, bottle_volume, state_bottle_cost, state_bottle_retail, row_hash, valid_from
+    FROM   staging_item_dim
+""")
+
+# Replaces the changed keys. The weather city of a replaced store is assigned again by weather_cities.py.
+store_dim_changes_delete = ("""
+    DELETE FROM store_dim
+    USING  staging_store_dim chg
+    WHERE  store_dim.store_id = chg.store_id
+""")
+
+store_dim_changes_apply = ("""
+    INSERT INTO store_dim (store_id, store_name, address, city, zip_code, county, longitude, latitude, row_hash)
+    SELECT store_id, store_name, address, city, zip_code, county, longitude, latitude, row_hash
+    FROM   staging_store_dim
+""")
+
+item_dim_changes_delete = ("""
+    DELETE FROM item_dim
+    USING  staging_item_dim chg
+    WHERE  item_dim.item_id = chg.item_id
+""")
+
+item_dim_changes_apply = ("""
+    INSERT INTO item_dim (item_id, brand_id, item_name, brand_name, bottle_volume, state_bottle_cost, state_bottle_retail, row_hash)
+    SELECT item_id, brand_id, item_name, brand_name, bottle_volume, state_bottle_cost, state_bottle_retail, row_hash
+    FROM   staging_item_dim
+""")
+
+dimension_history_queries = {'store_dim': [store_dim_history_close, store_dim_history_insert],
+                             'item_dim': [item_dim_history_close, item_dim_history_insert]}
+dimension_apply_queries = {'store_dim': [store_dim_changes_delete, store_dim_changes_apply],
+                           'item_dim': [item_dim_changes_delete, item_dim_changes_apply]}
+
+
+def dimension_merge(table, changes_insert, history=False):
+    '''
+    Returns the statements of the merge of store_dim or item_dim, run in a single transaction:
+    the changed keys are staged by changes_insert, recorded in the history table with history,
+    then replaced
+    '''
+    return ([staging_dimension_clear.format(table), changes_insert]
+            + (dimension_history_queries[table] if history else [])
+            + dimension_apply_queries[table]
+            + [table_version_delete.format(table), table_version_insert.format(table)])
+
+
+# TABLE MAINTENANCE
+# Health of the tables read by maintenance.py: table, percent of unsorted rows, percent of stale
+# statistics, percent of deleted rows not reclaimed, rows and MB. Redshift reports it in
+# svv_table_info (unsorted is NULL without a sort key).
+select_table_health = ("""
+    SELECT "table", COALESCE(unsorted, 0), COALESCE(stats_off, 0),
+           CASE WHEN tbl_rows > 0 THEN (tbl_rows - estimated_visible_rows) * 100.0 / tbl_rows ELSE 0 END,
+           tbl_rows, size
+    FROM   svv_table_info
+    WHERE  schema = current_schema()
+""")
+# Postgres stand-in: the rows modified since the last analyze and the dead rows, no sort order
+select_table_health_postgres = ("""
+    SELECT relname, 0,
+           CASE WHEN last_analyze IS NULL AND last_autoanalyze IS NULL AND n_live_tup > 0 THEN 100
+                WHEN n_live_tup > 0 THEN LEAST(n_mod_since_analyze * 100.0 / n_live_tup, 100)
+                ELSE 0 END,
+           CASE WHEN n_live_tup + n_dead_tup > 0 THEN n_dead_tup * 100.0 / (n_live_tup + n_dead_tup) ELSE 0 END,
+           n_live_tup, pg_total_relation_size(relid) / 1048576
+    FROM   pg_stat_user_tables
+    WHERE  schemaname = current_schema()
+""")
+# DuckDB keeps its statistics as it writes and has neither sort order nor deleted rows to reclaim
+select_table_health_duckdb = ("""
+    SELECT table_name, 0, 0, 0, estimated_size, 0
+    FROM   duckdb_tables()
+    WHERE  schema_name = current_schema()
+""")
+# Take the table. VACUUM cannot run inside a transaction.
+analyze_table = "ANALYZE {};"
+vacuum_sort_table = "VACUUM SORT ONLY {};"
+vacuum_delete_table = "VACUUM DELETE ONLY {};"
+vacuum_full_table = "VACUUM FULL {};"
+# Postgres has no sort order, its VACUUM reclaims the deleted rows
+vacuum_postgres_table = "VACUUM {};"
+
+
+# INCREMENTAL LOADING
+# Staging tables are emptied before every run so they only hold the new batch.
+truncate_staging_liquor_sales_table = "TRUNCATE staging_liquor_sales;"
+truncate_staging_temperature_table = "TRUNCATE staging_temperature;"
+truncate_staging_census_table = "TRUNCATE staging_census;"
+truncate_staging_crime_table = "TRUNCATE staging_crime;"
+
+# Counts the staged sales rows older than the high-water mark: late or corrected rows, merged
+# like the others since the merge replaces the rows of their invoices. Takes the staging table.
+# When no watermark exists yet the subquery is NULL and nothing is counted.
+count_staged_before_watermark = ("""
+    SELECT COUNT(*), MIN(date)
+    FROM   {}
+    WHERE  date < (SELECT max_date FROM load_watermark WHERE table_name = 'sales_fact')
+""")
+
+# Delete-then-insert merges. The statements of each merge are run in a single transaction.
+sales_fact_table_delete = ("""
+    DELETE FROM sales_fact
+    USING  staging_liquor_sales sls
+    WHERE  sales_fact.date = sls.date
+    AND    sales_fact.invoice_num = sls.invoice_num
+""")
+
+# The temperature, census and crime sources are small and restaged in full every run
+temperature_dim_table_delete = "DELETE FROM temperature_dim;"
+# The rollups name the county of each sale, so the merge of county_census_dim queues the dates
+# whose sales are in a county it added, renamed or removed. Before the first load of the reference
+# data (the backfill of the DAG) every county is missing, and every date with a county is queued.
+county_names_snapshot = "CREATE TEMP TABLE county_names_before AS SELECT county_id, county FROM county_census_dim;"
+county_names_snapshot_drop = "DROP TABLE county_names_before;"
+rollup_changed_county_dates_insert = ("""
+    INSERT INTO rollup_pending_dates (date)
+    SELECT DISTINCT f.date
+    FROM   sales_fact f
+    WHERE  f.county_id IN (SELECT county_id
+                           FROM   ((SELECT county_id, county FROM county_census_dim
+                                    EXCEPT
+                                    SELECT county_id, county FROM county_names_before)
+                                   UNION
+                                   (SELECT county_id, county FROM county_names_before
+                                    EXCEPT
+                                    SELECT county_id, county FROM county_census_dim)) changed)
+    AND    f.date NOT IN (SELECT date FROM rollup_pending_dates)
+""")
+
+county_census_dim_table_delete = "DELETE FROM county_census_dim;"
+
+sales_fact_table_merge = [rollup_pending_dates_insert.format('staging_liquor_sales'),
+                          sales_fact_table_delete, sales_fact_table_insert,
+                          table_version_delete.format('sales_fact'), table_version_insert.format('sales_fact')]
+temperature_dim_table_merge = [temperature_dim_table_delete, temperature_dim_table_insert,
+                               table_version_delete.format('temperature_dim'), table_version_insert.format('temperature_dim')]
+county_census_dim_table_merge = [county_names_snapshot, county_census_dim_table_delete, county_census_dim_table_insert,
+                                 rollup_changed_county_dates_insert, county_names_snapshot_drop,
+                                 table_version_delete.format('county_census_dim'), table_version_insert.format('county_census_dim')]
+# Cities are never deleted, so that their keys stay stable
+city_dim_table_merge = [city_dim_table_insert,
+                        table_version_delete.format('city_dim'), table_version_insert.format('city_dim')]
+
+# High-water mark of sales_fact. last_source_mtime keeps its previous value when NULL is passed.
+select_watermark = ("""
+    SELECT max_date, max_invoice_num, last_source_mtime
+    FROM   load_watermark
+    WHERE  table_name = %s
+""")
+
+sales_fact_watermark_seed = ("""
+    INSERT INTO load_watermark (table_name)
+    SELECT 'sales_fact'
+    WHERE  NOT EXISTS (SELECT 1 FROM load_watermark WHERE table_name = 'sales_fact')
+""")
+
+sales_fact_watermark_update = ("""
+    UPDATE load_watermark
+    SET    max_date          = (SELECT MAX(date) FROM sales_fact),
+           max_invoice_num   = (SELECT MAX(invoice_num) FROM sales_fact),
+           last_source_mtime = COALESCE(%(last_source_mtime)s, last_source_mtime),
+           updated_at        = GETDATE()
+    WHERE  table_name = 'sales_fact'
+""")
+
+sales_fact_watermark_upsert = [sales_fact_watermark_seed, sales_fact_watermark_update]
+
+
+# DAILY PARTITIONS
+# Each run of the DAG stages the sales files of its execution date in a staging table of that
+# day, so that the runs of a backfill do not share staged rows. The tasks name it after the
+# ds_nodash of their context.
+partition_staging_table = "staging_liquor_sales_{}"
+partition_staging_create = "CREATE TABLE IF NOT EXISTS {} (LIKE staging_liquor_sales);"
+partition_staging_drop = "DROP TABLE IF EXISTS {};"
+staging_table_clear = "DELETE FROM {};"
+
+# Rows of another day found in the files of a partition are not loaded with it
+partition_staging_prune = "DELETE FROM {} WHERE date IS NULL OR date <> '{}';"
+
+# The whole day is replaced, so a rerun also removes the sales no longer in its files
+sales_fact_partition_delete = "DELETE FROM sales_fact WHERE date = '{}';"
+
+# Queues the day even when its files are empty, so that its rollups are emptied too
+rollup_pending_date_insert = ("""
+    INSERT INTO rollup_pending_dates (date)
+    SELECT DATE '{0}'
+    WHERE  DATE '{0}' NOT IN (SELECT date FROM rollup_pending_dates)
+""")
+
+count_rollup_pending_dates = "SELECT COUNT(*) FROM rollup_pending_dates;"
+
+
+def partition_queries(queries, day):
+    '''
+    Points statements reading staging_liquor_sales at the staging table of one day
+    '''
+    table = partition_staging_table.format(day)
+    return [re.sub(r'\bstaging_liquor_sales\b', table, query) for query in queries]
+
+
+def sales_fact_partition_merge(ds, ds_nodash):
+    '''
+    Replaces the sales of one day with those of its staging table and queues the day for the rollups
+    '''
+    return ([rollup_pending_date_insert.format(ds), sales_fact_partition_delete.format(ds)]
+            + partition_queries([sales_fact_table_insert], ds_nodash)
+            + [table_version_delete.format('sales_fact'), table_version_insert.format('sales_fact')])
 
 
 # QUERY LISTS
@@ -377,47 +1230,102 @@ drop_then_create_tables_queries = [
     time_dim_table_drop,
     temperature_dim_table_drop,
     county_census_dim_table_drop,
+    city_dim_table_drop,
+    weather_city_dim_table_drop,
+    staging_store_weather_table_drop,
+    staging_store_dim_table_drop,
+    staging_item_dim_table_drop,
+    store_dim_history_table_drop,
+    item_dim_history_table_drop,
+    load_watermark_table_drop,
+    table_versions_table_drop,
+    dq_results_table_drop,
+    load_ledger_table_drop,
+    rollup_pending_dates_table_drop,
+    daily_store_item_sales_table_drop,
+    monthly_county_sales_table_drop,
+    monthly_city_sales_table_drop,
+    monthly_brand_sales_table_drop,
     staging_liquor_sales_table_create,
     staging_temperature_table_create,
     staging_census_table_create,
     staging_crime_table_create,
+    staging_store_weather_table_create,
+    staging_store_dim_table_create,
+    staging_item_dim_table_create,
+    store_dim_history_table_create,
+    item_dim_history_table_create,
+    weather_city_dim_table_create,
     store_dim_table_create,
     item_dim_table_create,
     time_dim_table_create,
     temperature_dim_table_create,
     county_census_dim_table_create,
-    sales_fact_table_create
+    city_dim_table_create,
+    sales_fact_table_create,
+    load_watermark_table_create,
+    table_versions_table_create,
+    dq_results_table_create,
+    load_ledger_table_create,
+    rollup_pending_dates_table_create,
+    daily_store_item_sales_table_create,
+    monthly_county_sales_table_create,
+    monthly_city_sales_table_create,
+    monthly_brand_sales_table_create
 ]
 
-check_tables_queries = [
-    'SELECT * FROM staging_liquor_sales     LIMIT 5',
-    'SELECT COUNT(*) FROM staging_liquor_sales',
-    
-    'SELECT * FROM staging_temperature     LIMIT 5',
-    'SELECT COUNT(*) FROM staging_temperature',
-    
-    'SELECT * FROM staging_census     LIMIT 5',
-    'SELECT COUNT(*) FROM staging_census',
-    
-    'SELECT * FROM staging_crime     LIMIT 5',
-    'SELECT COUNT(*) FROM staging_crime',    
-    
-    'SELECT * FROM sales_fact        LIMIT 5',
-    'SELECT COUNT(*) FROM sales_fact',
-    
-    'SELECT * FROM store_dim         LIMIT 5',
-    'SELECT COUNT(*) FROM store_dim',
-    
-    'SELECT * FROM item_dim          LIMIT 5',
-    'SELECT COUNT(*) FROM item_dim',
-    
-    'SELECT * FROM time_dim          LIMIT 5',
-    'SELECT COUNT(*) FROM time_dim',
-    
-    'SELECT * FROM temperature_dim   LIMIT 5',
-    'SELECT COUNT(*) FROM temperature_dim',
-    
-    'SELECT * FROM county_census_dim LIMIT 5',
-    'SELECT COUNT(*) FROM county_census_dim'
+create_if_not_exists_queries = [
+    staging_liquor_sales_table_create,
+    staging_temperature_table_create,
+    staging_census_table_create,
+    staging_crime_table_create,
+    staging_store_weather_table_create,
+    staging_store_dim_table_create,
+    staging_item_dim_table_create,
+    store_dim_history_table_create,
+    item_dim_history_table_create,
+    weather_city_dim_table_create,
+    store_dim_table_create,
+    item_dim_table_create,
+    time_dim_table_create,
+    temperature_dim_table_create,
+    county_census_dim_table_create,
+    city_dim_table_create,
+    sales_fact_table_create,
+    load_watermark_table_create,
+    table_versions_table_create,
+    dq_results_table_create,
+    load_ledger_table_create,
+    rollup_pending_dates_table_create,
+    daily_store_item_sales_table_create,
+    monthly_county_sales_table_create,
+    monthly_city_sales_table_create,
+    monthly_brand_sales_table_create
 ]
 
+# A full refresh of the DAG only recreates the staging tables and forgets the sources loaded
+# into them. The final tables keep the history loaded by the previous runs.
+staging_drop_then_create_tables_queries = [
+    staging_liquor_sales_table_drop,
+    staging_temperature_table_drop,
+    staging_census_table_drop,
+    staging_crime_table_drop,
+    staging_store_weather_table_drop,
+    staging_store_dim_table_drop,
+    staging_item_dim_table_drop,
+    staging_liquor_sales_table_create,
+    staging_temperature_table_create,
+    staging_census_table_create,
+    staging_crime_table_create,
+    staging_store_weather_table_create,
+    staging_store_dim_table_create,
+    staging_item_dim_table_create,
+    load_ledger_clear
+]
+
+truncate_staging_table_queries = [
+    truncate_staging_liquor_sales_table,
+    truncate_staging_temperature_table,
+    truncate_staging_census_table,
+    truncate_staging_crime_table
+]
@@ -0,0 +1,503 @@
+'''
+Physical design advisor for the star schema.
+
+Reads the table definitions of sql_queries.py, profiles a sample of the source data and
+a workload of typical queries, and emits DDL with a compound sort key, a distribution
+style and per-column encodings, along with an estimate of the bytes scanned and
+redistributed by the workload under the current and the tuned DDL.
+
+    python design_advisor.py --sample staging_liquor_sales=Iowa_Liquor_Sales_small.csv \
+        --sample staging_census=acs2017_county_data.csv --rows sales_fact=12000000 \
+        --workload workload.sql --output tuned_ddl.sql
+
+The estimates are meant to compare designs with each other, not to predict query times.
+'''
+
+import argparse
+import csv
+import datetime
+import re
+import struct
+import zlib
+from collections import Counter
+
+# Byte widths of the fixed size types as stored by Redshift
+TYPE_WIDTHS = {'SMALLINT': 2, 'INTEGER': 4, 'INT': 4, 'BIGINT': 8, 'DATE': 4, 'TIMESTAMP': 8,
+               'NUMERIC': 8, 'DECIMAL': 8, 'REAL': 4, 'FLOAT': 8, 'BOOLEAN': 1}
+
+# Tables with fewer rows than this are copied to every node (DISTSTYLE ALL)
+SMALL_TABLE_ROWS = 3000000
+
+# How the final tables are derived from the staging tables (see the INSERT statements)
+DERIVED_TABLES = {
+    'sales_fact': ('staging_liquor_sales', None, {
+        'invoice_num': 'invoice_num', 'date': 'date', 'store_id': 'store_num', 'brand_id': 'vendor_num',
+        'item_id': 'item_num', 'sold_count': 'bottle_sold', 'volume_sold': 'volume_sold_ltr',
+        'sales': 'sale', 'county_id': 'county_num', 'city_id': 'city'}),
+    'store_dim': ('staging_liquor_sales', 'store_id', {
+        'store_id': 'store_num', 'store_name': 'store_name', 'address': 'address', 'city': 'city',
+        'zip_code': 'zip', 'county': 'county_name'}),
+    'item_dim': ('staging_liquor_sales', 'item_id', {
+        'item_id': 'item_num', 'brand_id': 'vendor_num', 'item_name': 'item_name',
+        'brand_name': 'vendor_name', 'bottle_volume': 'bottle_volume',
+        'state_bottle_cost': 'state_bottle_cost', 'state_bottle_retail': 'state_bottle_retail'}),
+    'time_dim': ('staging_liquor_sales', 'date', {'date': 'date'}),
+    'county_census_dim': ('staging_census', 'county_id', {
+        'county_id': 'county_id', 'county': 'county', 'total_pop': 'total_pop', 'men': 'men', 'women': 'women',
+        'income': 'income', 'income_per_cap': 'income_per_cap', 'poverty': 'poverty',
+        'unemployment': 'unemployment'}),
+}
+
+# Typical dashboard queries, used when no workload file is given
+DEFAULT_WORKLOAD = [
+    """SELECT s.county, SUM(f.volume_sold) FROM sales_fact f JOIN store_dim s ON f.store_id = s.store_id
+       WHERE f.date BETWEEN '2017-01-01' AND '2017-01-31' GROUP BY s.county""",
+    """SELECT t.month, SUM(f.sales) FROM sales_fact f JOIN time_dim t ON f.date = t.date
+       WHERE f.date >= '2016-01-01' GROUP BY t.month""",
+    """SELECT i.brand_name, SUM(f.volume_sold) FROM sales_fact f JOIN item_dim i ON f.item_id = i.item_id
+       WHERE f.date BETWEEN '2017-06-01' AND '2017-06-30' GROUP BY i.brand_name""",
+    """SELECT c.county, SUM(f.volume_sold) / MAX(c.total_pop) FROM sales_fact f
+       JOIN county_census_dim c ON f.county_id = c.county_id GROUP BY c.county""",
+    """SELECT f.store_id, SUM(f.sales) FROM sales_fact f WHERE f.date = '2017-10-31' GROUP BY f.store_id""",
+]
+
+
+class Column:
+    '''
+    A column definition parsed from a CREATE TABLE statement
+    '''
+    def __init__(self, name, data_type, constraints):
+        self.name = name
+        self.data_type = data_type
+        self.constraints = constraints
+
+    @property
+    def base_type(self):
+        return re.match(r'\w+', self.data_type).group(0).upper()
+
+    def declared_width(self):
+        if self.base_type in TYPE_WIDTHS:
+            return TYPE_WIDTHS[self.base_type]
+        length = re.search(r'\((\d+)\)', self.data_type)
+        return int(length.group(1)) if length else 256
+
+
+class Table:
+    '''
+    A table definition parsed from a CREATE TABLE statement
+    '''
+    def __init__(self, name, columns, table_constraints, sortkey):
+        self.name = name
+        self.columns = columns
+        self.table_constraints = table_constraints
+        self.sortkey = sortkey
+
+    def column(self, name):
+        return next((c for c in self.columns if c.name == name), None)
+
+
+def parse_create(query):
+    '''
+    Parses a CREATE TABLE statement of sql_queries.py into a Table
+    '''
+    # migrations imports sql_queries, which reads dwh.cfg, so it is imported on use as in main
+    from migrations import split_top_level
+    name = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE).group(1)
+    body = query[query.index('(') + 1:query.rindex(')')]
+    columns, table_constraints, sortkey = [], [], []
+    for part in split_top_level(body):
+        if re.match(r'(PRIMARY\s+KEY|FOREIGN\s+KEY|UNIQUE)\b', part, re.IGNORECASE):
+            table_constraints.append(' '.join(part.split()))
+            continue
+        match = re.match(r'(\w+)\s+(\w+(?:\s*\([\d,\s]*\))?)\s*(.*)', part, re.DOTALL)
+        col_name, data_type, rest = match.group(1), match.group(2), ' '.join(match.group(3).split())
+        if re.search(r'\bSORTKEY\b', rest, re.IGNORECASE):
+            sortkey.append(col_name)
+            rest = re.sub(r'\s*\bSORTKEY\b', '', rest, flags=re.IGNORECASE)
+        columns.append(Column(col_name, data_type.replace(' ', ''), rest.strip()))
+    return Table(name, columns, table_constraints, sortkey)
+
+
+class ColumnStats:
+    '''
+    Statistics of one column computed on the sample
+    '''
+    def __init__(self, column, values):
+        present = [v for v in values if v not in ('', None)]
+        self.column = column
+        self.count = len(values)
+        self.distinct = len(set(present))
+        self.null_ratio = 1 - len(present) / len(values) if values else 0
+        self.avg_width = (sum(len(v) for v in present) / len(present)) if present else column.declared_width() / 2
+        self.values = present
+        self.minimum = min(present) if present else None
+        self.maximum = max(present) if present else None
+
+    def stored_width(self):
+        '''
+        Bytes per value without compression
+        '''
+        if self.column.base_type in TYPE_WIDTHS:
+            return TYPE_WIDTHS[self.column.base_type]
+        return self.avg_width + 4
+
+    def compression_ratio(self, encoding, sorted_values=False):
+        '''
+        Estimates the compressed to raw size ratio of an encoding on the sample values
+        '''
+        if encoding == 'RAW' or not self.values:
+            return 1.0
+        values = sorted(self.values) if sorted_values else self.values
+        if encoding == 'BYTEDICT':
+            return min(1.0, 1.0 / self.stored_width())
+        if encoding == 'RUNLENGTH':
+            runs = 1 + sum(1 for a, b in zip(values, values[1:]) if a != b)
+            return min(1.0, runs * (self.stored_width() + 1) / (len(values) * self.stored_width()))
+        if encoding == 'AZ64':
+            # AZ64 works on the binary values, approximated by deflating the packed deltas
+            numbers = [numeric_key(v) for v in values]
+            deltas = [b - a for a, b in zip([0] + numbers, numbers)]
+            raw = b''.join(struct.pack('<q', int(d)) for d in deltas)
+            return min(1.0, len(zlib.compress(raw, 6)) / (len(values) * self.stored_width()))
+        # ZSTD and LZO on text, approximated by deflate
+        raw = '\n'.join(values).encode()
+        return min(1.0, len(zlib.compress(raw, 6)) / len(raw))
+
+
+def numeric_key(value):
+    '''
+    Converts a sample value to a number for the AZ64 estimate
+    '''
+    try:
+        return int(datetime.date.fromisoformat(value).toordinal())
+    except ValueError:
+        pass
+    try:
+        return float(re.sub(r'[^\d.\-]', '', value) or 0) * 100
+    except ValueError:
+        return 0
+
+
+def parse_date(value):
+    '''
+    Parses the date formats found in the sources (ISO and MM/DD/YYYY)
+    '''
+    for fmt in ('%Y-%m-%d', '%m/%d/%Y'):
+        try:
+            return datetime.datetime.strptime(value.strip(), fmt).date()
+        except (ValueError, AttributeError):
+            continue
+    return None
+
+
+def read_sample(path, table, limit):
+    '''
+    Reads up to limit rows of a CSV sample as {column: [values]}.
+    Columns are matched by header name, or by position when the header does not match
+    the table (the raw source files are in the order of the staging columns).
+    '''
+    names = [c.name for c in table.columns]
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = [h.strip().lower() for h in next(reader)]
+        positions = {name: header.index(name) for name in names if name in header}
+        if len(positions) < len(names) / 2:
+            positions = {name: i for i, name in enumerate(names)}
+        sample = {name: [] for name in positions}
+        for i, row in enumerate(reader):
+            if i >= limit:
+                break
+            for name, position in positions.items():
+                sample[name].append(row[position].strip() if position < len(row) else '')
+    for name, column in sample.items():
+        if table.column(name).base_type == 'DATE':
+            sample[name] = [str(parse_date(v) or '') for v in column]
+    return sample
+
+
+def derive_sample(staging_sample, key, mapping):
+    '''
+    Builds the sample of a final table from the sample of its staging table
+    '''
+    if not all(source in staging_sample for source in mapping.values()):
+        return None
+    rows = zip(*[staging_sample[source] for source in mapping.values()])
+    if key:
+        # Dimensions hold one row per key
+        key_position = list(mapping).index(key)
+        rows = {row[key_position]: row for row in rows}.values()
+    columns = list(zip(*rows))
+    return {name: list(values) for name, values in zip(mapping, columns)}
+
+
+class Query:
+    '''
+    The tables, joins and filters of a workload query
+    '''
+    def __init__(self, sql, tables):
+        self.sql = ' '.join(sql.split())
+        aliases = {}
+        for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', self.sql, re.IGNORECASE):
+            if table in tables:
+                aliases[table] = table
+                if alias and alias.upper() not in ('ON', 'WHERE', 'JOIN', 'GROUP', 'INNER', 'LEFT', 'ORDER'):
+                    aliases[alias] = table
+        self.tables = sorted(set(aliases.values()))
+
+        def resolve(alias, column):
+            if alias:
+                return aliases.get(alias.rstrip('.'))
+            return next((t for t in self.tables if tables[t].column(column)), None)
+
+        self.joins = []
+        for a1, c1, a2, c2 in re.findall(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', self.sql):
+            t1, t2 = resolve(a1, c1), resolve(a2, c2)
+            if t1 and t2:
+                self.joins.append(((t1, c1), (t2, c2)))
+
+        self.filters = []
+        where = re.split(r'\bWHERE\b', self.sql, flags=re.IGNORECASE)
+        if len(where) > 1:
+            condition = re.split(r'\b(?:GROUP|ORDER|LIMIT)\b', where[1], flags=re.IGNORECASE)[0]
+            for alias, column, operator, rest in re.findall(
+                    r"(\w+\.)?(\w+)\s*(BETWEEN|>=|<=|=|>|<|IN)\s*('[^']*'(?:\s+AND\s+'[^']*')?|[\w.]+)",
+                    condition, re.IGNORECASE):
+                table = resolve(alias, column)
+                if table and not re.match(r'\w+\.\w+', rest):
+                    self.filters.append((table, column, operator.upper(), rest))
+
+        self.columns = {}
+        for table in self.tables:
+            used = [c.name for c in tables[table].columns
+                    if re.search(r'\b{}\b'.format(c.name), self.sql)]
+            self.columns[table] = used or [tables[table].columns[0].name]
+
+
+def filter_selectivity(column_stats, operator, operand):
+    '''
+    Estimates the fraction of the rows kept by a filter on a column
+    '''
+    if operator == '=':
+        return 1.0 / max(column_stats.distinct, 1) if column_stats else 0.01
+    dates = [parse_date(d) for d in re.findall(r"'([^']*)'", operand)]
+    if column_stats and column_stats.minimum and dates and all(dates):
+        low, high = parse_date(column_stats.minimum), parse_date(column_stats.maximum)
+        if low and high and high > low:
+            span = (high - low).days + 1
+            if operator == 'BETWEEN' and len(dates) == 2:
+                return min(1.0, ((dates[1] - dates[0]).days + 1) / span)
+            if operator in ('>', '>='):
+                return min(1.0, max(0, (high - dates[0]).days + 1) / span)
+            if operator in ('<', '<='):
+                return min(1.0, max(0, (dates[0] - low).days + 1) / span)
+    return 0.1
+
+
+class Design:
+    '''
+    The physical design of one table: distribution, sort key and column encodings
+    '''
+    def __init__(self, diststyle='EVEN', distkey=None, sortkey=None, encodings=None):
+        self.diststyle = diststyle
+        self.distkey = distkey
+        self.sortkey = sortkey or []
+        self.encodings = encodings or {}
+
+
+def current_design(table):
+    '''
+    The design of the DDL as written: no DISTKEY (EVEN distribution) and no encodings
+    '''
+    return Design('EVEN', None, table.sortkey, {c.name: 'RAW' for c in table.columns})
+
+
+def recommend(tables, stats, rows, workload):
+    '''
+    Recommends a design per table from the sample statistics and the workload
+    '''
+    filter_counts = {name: Counter() for name in tables}
+    join_counts = {name: Counter() for name in tables}
+    for query in workload:
+        for table, column, _, _ in query.filters:
+            filter_counts[table][column] += 1
+        for (t1, c1), (t2, c2) in query.joins:
+            join_counts[t1][(c1, t2)] += 1
+            join_counts[t2][(c2, t1)] += 1
+
+    designs = {}
+    # The largest table is distributed on the column joining it to its largest non-small dimension
+    fact = max(tables, key=lambda name: rows.get(name, 0))
+    fact_distkey = None
+    candidates = [(rows.get(other, 0), count, column) for (column, other), count in join_counts[fact].items()
+                  if rows.get(other, 0) >= SMALL_TABLE_ROWS]
+    if candidates:
+        fact_distkey = max(candidates)[2]
+    elif join_counts[fact]:
+        fact_distkey = join_counts[fact].most_common(1)[0][0][0]
+
+    for name, table in tables.items():
+        table_stats = stats.get(name, {})
+        sortkey = [column for column, _ in filter_counts[name].most_common(3)]
+        if not sortkey:
+            date_columns = [c.name for c in table.columns if c.base_type == 'DATE']
+            sortkey = date_columns[:1] or [table.columns[0].name]
+        if name == fact:
+            diststyle, distkey = ('KEY', fact_distkey) if fact_distkey else ('EVEN', None)
+        elif rows.get(name, 0) < SMALL_TABLE_ROWS:
+            diststyle, distkey = 'ALL', None
+        else:
+            # A large dimension is collocated with the fact table on their join column
+            joined = [column for (column, other), _ in join_counts[name].most_common() if other == fact]
+            diststyle, distkey = ('KEY', joined[0]) if joined else ('EVEN', None)
+
+        encodings = {}
+        for column in table.columns:
+            column_stats = table_stats.get(column.name)
+            if column.name == sortkey[0]:
+                # Leaving the leading sort key column raw keeps the zone maps precise
+                encodings[column.name] = 'RAW'
+            elif column_stats and column_stats.distinct and column_stats.distinct < 256 \
+                    and column.base_type not in TYPE_WIDTHS:
+                # Low cardinality strings are stored as one byte dictionary indexes
+                encodings[column.name] = 'BYTEDICT'
+            elif column.base_type in TYPE_WIDTHS and column.base_type not in ('REAL', 'FLOAT', 'BOOLEAN'):
+                encodings[column.name] = 'AZ64'
+            else:
+                encodings[column.name] = 'ZSTD'
+        designs[name] = Design(diststyle, distkey, sortkey, encodings)
+    return designs
+
+
+def render_ddl(table, design):
+    '''
+    Writes the CREATE TABLE statement of a table with a design applied
+    '''
+    width = max(len(c.name) for c in table.columns)
+    type_width = max(len(c.data_type) for c in table.columns)
+    lines = []
+    for column in table.columns:
+        parts = [column.name.ljust(width), column.data_type.ljust(type_width)]
+        if column.constraints:
+            parts.append(column.constraints)
+        parts.append('ENCODE {}'.format(design.encodings.get(column.name, 'RAW')))
+        lines.append('        ' + ' '.join(parts))
+    lines += ['        ' + constraint for constraint in table.table_constraints]
+    attributes = ['    DISTSTYLE {}'.format(design.diststyle)]
+    if design.distkey:
+        attributes.append('    DISTKEY ({})'.format(design.distkey))
+    if design.sortkey:
+        attributes.append('    COMPOUND SORTKEY ({})'.format(', '.join(design.sortkey)))
+    return '    CREATE TABLE IF NOT EXISTS {} (\n{}\n    )\n{};\n'.format(
+        table.name, ',\n'.join(lines), '\n'.join(attributes))
+
+
+def workload_cost(tables, stats, rows, designs, workload, nodes):
+    '''
+    Estimates the bytes scanned and redistributed by each workload query under the designs
+    '''
+    costs = []
+    for query in workload:
+        scanned = {}
+        for table in query.tables:
+            design = designs[table]
+            kept = 1.0
+            for t, column, operator, operand in query.filters:
+                # Zone maps only skip blocks for filters on the leading sort key column
+                if t == table and design.sortkey and column == design.sortkey[0]:
+                    kept = min(kept, filter_selectivity(stats.get(table, {}).get(column), operator, operand))
+            total = 0.0
+            for name in query.columns[table]:
+                column_stats = stats.get(table, {}).get(name)
+                width = column_stats.stored_width() if column_stats else tables[table].column(name).declared_width()
+                ratio = column_stats.compression_ratio(design.encodings.get(name, 'RAW'),
+                                                       sorted_values=name in design.sortkey[:1]) \
+                    if column_stats else 1.0
+                total += rows.get(table, 0) * width * ratio
+            scanned[table] = total * kept
+
+        redistributed = 0.0
+        for (t1, c1), (t2, c2) in query.joins:
+            d1, d2 = designs[t1], designs[t2]
+            if d1.diststyle == 'ALL' or d2.diststyle == 'ALL':
+                continue
+            if d1.distkey == c1 and d2.distkey == c2:
+                continue
+            # The planner moves the smaller side: broadcast to every node, or redistribute on the key
+            small = min(scanned.get(t1, 0), scanned.get(t2, 0))
+            keyed = d1.distkey == c1 or d2.distkey == c2
+            redistributed += small if keyed else small * nodes
+        costs.append((sum(scanned.values()), redistributed))
+    return costs
+
+
+def megabytes(value):
+    return '{:,.1f}'.format(value / 1024 / 1024)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Recommend sort keys, dist keys and encodings for the star schema')
+    parser.add_argument('--sample', action='append', default=[], metavar='TABLE=CSV',
+                        help='CSV sample of a staging or final table (repeatable)')
+    parser.add_argument('--rows', action='append', default=[], metavar='TABLE=N',
+                        help='full row count of a table, defaults to the sample size (repeatable)')
+    parser.add_argument('--sample-rows', type=int, default=200000, help='rows read from each sample')
+    parser.add_argument('--workload', help='file of ;-separated queries, defaults to typical dashboard queries')
+    parser.add_argument('--nodes', type=int, default=2, help='number of compute nodes')
+    parser.add_argument('--output', help='file receiving the tuned DDL')
+    args = parser.parse_args()
+
+    from sql_queries import create_table_queries
+    all_tables = {t.name: t for t in map(parse_create, create_table_queries)}
+    tables = {name: t for name, t in all_tables.items() if not name.startswith('staging_') and name != 'load_watermark'}
+
+    samples = {}
+    for spec in args.sample:
+        name, path = spec.split('=', 1)
+        samples[name] = read_sample(path, all_tables[name], args.sample_rows)
+    for name, (staging, key, mapping) in DERIVED_TABLES.items():
+        if name not in samples and staging in samples:
+            derived = derive_sample(samples[staging], key, mapping)
+            if derived:
+                samples[name] = derived
+
+    stats = {name: {column: ColumnStats(tables[name].column(column), values)
+                    for column, values in samples[name].items() if tables[name].column(column)}
+             for name in tables if name in samples}
+    rows = {name: len(next(iter(samples[name].values()), [])) for name in tables if name in samples}
+    for spec in args.rows:
+        name, count = spec.split('=', 1)
+        rows[name] = int(count)
+
+    if args.workload:
+        with open(args.workload) as f:
+            statements = [q for q in f.read().split(';') if q.strip()]
+    else:
+        statements = DEFAULT_WORKLOAD
+    workload = [Query(sql, tables) for sql in statements]
+
+    current = {name: current_design(table) for name, table in tables.items()}
+    tuned = recommend(tables, stats, rows, workload)
+    ddl = '\n'.join(render_ddl(tables[name], tuned[name]) for name in tables)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(ddl)
+        print('Tuned DDL written to {}'.format(args.output))
+    else:
+        print(ddl)
+
+    print("------------------------------------------------------")
+    print('{:<6} {:>14} {:>14} {:>14} {:>14}'.format('query', 'scan MB', 'tuned', 'moved MB', 'tuned'))
+    before = workload_cost(tables, stats, rows, current, workload, args.nodes)
+    after = workload_cost(tables, stats, rows, tuned, workload, args.nodes)
+    for i, ((scan0, move0), (scan1, move1)) in enumerate(zip(before, after), 1):
+        print('{:<6} {:>14} {:>14} {:>14} {:>14}'.format(
+            i, megabytes(scan0), megabytes(scan1), megabytes(move0), megabytes(move1)))
+    print('{:<6} {:>14} {:>14} {:>14} {:>14}'.format(
+        'total', megabytes(sum(c[0] for c in before)), megabytes(sum(c[0] for c in after)),
+        megabytes(sum(c[1] for c in before)), megabytes(sum(c[1] for c in after))))
+    print("------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+'''
+Translation of the Redshift statements of sql_queries.py for the local engines.
+
+to_postgres rewrites a statement for a local Postgres (benchmark.py),
+to_duckdb for the embedded DuckDB backend of backends.py. Only the syntax used by this project
+is translated: the IDENTITY columns, the distribution and sort keys, the informational keys,
+and the functions Redshift has and the other engine has not (GETDATE, INITCAP, TO_NUMBER, ...).
+
+The COPY statements are not translated, parse_copy reads their source and options so that the
+backend can load the matching local files.
+'''
+
+import re
+from migrations import split_top_level
+
+# Keys and foreign keys are informational in Redshift and the merges rely on it,
+# so they are dropped rather than enforced, along with the distribution and sort keys
+KEY_REWRITES = [
+    (r'\s+(?:COMPOUND\s+|INTERLEAVED\s+)?(?:SORTKEY|DISTKEY)\b(?:\s*\([^)]*\))?', ''),
+    (r'\s+DISTSTYLE\s+\w+', ''),
+    (r'\s+ENCODE\s+\w+', ''),
+    (r'\s+REFERENCES\s+\w+\s*\([^)]*\)', ''),
+    (r',\s*PRIMARY\s+KEY\s*\([^)]*\)', ''),
+    (r'\s+PRIMARY\s+KEY\b', ''),
+]
+
+EXTRACT_REWRITES = [
+    (r'\bEXTRACT\(\s*yr\b', 'EXTRACT(year'),
+    (r'\bEXTRACT\(\s*mon\b', 'EXTRACT(month'),
+    (r'\bEXTRACT\(\s*dw\b', 'EXTRACT(dow'),
+    (r'\bEXTRACT\(\s*d\b', 'EXTRACT(day'),
+]
+
+# Redshift syntax and its Postgres equivalent
+POSTGRES_REWRITES = [
+    (r'IDENTITY\((\d+),\s*(\d+)\)', r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 MINVALUE \1 INCREMENT BY \2)'),
+] + KEY_REWRITES + [
+    (r'\bGETDATE\(\)', 'LOCALTIMESTAMP'),
+    (r'\bLEN\(', 'LENGTH('),
+] + EXTRACT_REWRITES
+
+# The same for DuckDB, which has no unconstrained NUMERIC: Redshift reads it as
+# NUMERIC(18,0), DuckDB as DECIMAL(18,3). The IDENTITY columns become sequences.
+DUCKDB_REWRITES = KEY_REWRITES + [
+    (r'\b(NUMERIC|DECIMAL)\b(?!\s*\()', 'DECIMAL(18,0)'),
+    (r'\bGETDATE\(\)', 'CAST(CURRENT_LOCALTIMESTAMP() AS TIMESTAMP)'),
+] + EXTRACT_REWRITES
+
+# Functions of Redshift rewritten for DuckDB from their arguments
+DUCKDB_FUNCTIONS = {
+    'INITCAP': lambda args: ("array_to_string(list_transform(string_split(lower({}), ' '), "
+                             "lambda w: upper(w[1:1]) || w[2:]), ' ')").format(args[0]),
+    # The amounts are dollars with a thousands separator, e.g. $1,234.50
+    'TO_NUMBER': lambda args: "TRY_CAST(REPLACE(REPLACE({}, '$', ''), ',', '') AS DECIMAL(18,2))".format(args[0]),
+    'TO_DATE': lambda args: 'CAST(strptime({}, {}) AS DATE)'.format(args[0], quote(strptime_format(args[1]))),
+}
+
+# Redshift datetime format elements and their strptime equivalent, longest first
+DATE_FORMAT_ELEMENTS = [('YYYY', '%Y'), ('MON', '%b'), ('MM', '%m'), ('DD', '%d'), ('HH24', '%H'), ('HH', '%I'),
+                        ('MI', '%M'), ('SS', '%S'), ('YY', '%y')]
+
+
+def to_postgres(query):
+    '''
+    Rewrites a Redshift statement of sql_queries.py for Postgres
+    '''
+    for pattern, replacement in POSTGRES_REWRITES:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE)
+    return query
+
+
+def quote(text):
+    return "'{}'".format(text.replace("'", "''"))
+
+
+def strptime_format(redshift_format):
+    '''
+    Converts a quoted Redshift datetime format, e.g. 'MM/DD/YYYY', to a strptime one
+    '''
+    text = redshift_format.strip().strip("'")
+    pattern = '|'.join(element for element, _ in DATE_FORMAT_ELEMENTS)
+    return re.sub(pattern, lambda m: dict(DATE_FORMAT_ELEMENTS)[m.group(0)], text)
+
+
+def rewrite_calls(query, name, build):
+    '''
+    Replaces every call of a function by build(arguments), the arguments may hold parentheses
+    '''
+    pattern = re.compile(r'\b{}\s*\('.format(name), re.IGNORECASE)
+    match = pattern.search(query)
+    while match:
+        depth, end = 1, match.end()
+        while depth:
+            depth += {'(': 1, ')': -1}.get(query[end], 0)
+            end += 1
+        # The arguments may call the function too
+        args = [rewrite_calls(arg, name, build) for arg in split_top_level(query[match.end():end - 1])]
+        replacement = build(args)
+        query = query[:match.start()] + replacement + query[end:]
+        match = pattern.search(query, match.start() + len(replacement))
+    return query
+
+
+def identity_sequences(query):
+    '''
+    Replaces the IDENTITY columns of a CREATE TABLE by sequence defaults.
+    Returns the statements creating the sequences and the rewritten statement.
+    '''
+    table = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE)
+    sequences = []
+
+    def replace(match):
+        sequence = '{}_{}_seq'.format(table.group(1), match.group(1)).lower()
+        # DuckDB resets MINVALUE to 1 when INCREMENT BY follows it
+        sequences.append('CREATE OR REPLACE SEQUENCE {} INCREMENT BY {} MINVALUE {} START WITH {}'.format(
+            sequence, match.group(4), match.group(3), match.group(3)))
+        return "{} {} DEFAULT nextval('{}')".format(match.group(1), match.group(2), sequence)
+
+    query = re.sub(r'(\w+)\s+(\w+)\s+IDENTITY\((\d+),\s*(\d+)\)', replace, query, flags=re.IGNORECASE)
+    return sequences, query
+
+
+def to_duckdb(query):
+    '''
+    Rewrites a Redshift statement of sql_queries.py for DuckDB.
+    Returns the statements to run, the sequences of the IDENTITY columns come first.
+    '''
+    sequences, query = identity_sequences(query)
+    for pattern, replacement in DUCKDB_REWRITES:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE)
+    for name, build in DUCKDB_FUNCTIONS.items():
+        query = rewrite_calls(query, name, build)
+    return sequences + [query]
+
+
+def to_duckdb_params(query, params):
+    '''
+    Converts the pyformat placeholders of psycopg2 (%s, %(name)s) to the ones of DuckDB (?, $name)
+    '''
+    if params is None:
+        return query, None
+    names = re.findall(r'%\((\w+)\)s', query)
+    query = re.sub(r'%\((\w+)\)s', r'$\1', query).replace('%s', '?').replace('%%', '%')
+    if isinstance(params, dict):
+        # psycopg2 ignores the named parameters a statement does not use, DuckDB rejects them
+        params = {name: value for name, value in params.items() if name in names}
+    return query, params
+
+
+def parse_copy(query):
+    '''
+    Reads a Redshift COPY statement. Returns None for any other statement, otherwise a dict of
+    its table, column list (None when it loads every column), source URL, whether the source is
+    a manifest, its format, header lines, date format and compression.
+    '''
+    match = re.match(r'\s*copy\s+(\w+)\s*(\([^)]*\))?\s+from\s+\'([^\']+)\'', query, re.IGNORECASE)
+    if not match:
+        return None
+    options = query[match.end():]
+
+    def option(pattern):
+        found = re.search(pattern, options, re.IGNORECASE)
+        return found.group(1) if found else None
+
+    data_format = 'csv'
+    if re.search(r'\bjson\b', options, re.IGNORECASE):
+        data_format = 'json'
+    elif re.search(r'\bformat\s+as\s+parquet\b', options, re.IGNORECASE):
+        data_format = 'parquet'
+    compression = option(r'\b(gzip|zstd|bzip2)\b')
+    date_format = option(r'\bdateformat\s+(?:as\s+)?(\'[^\']*\')')
+    return {'table': match.group(1), 'columns': match.group(2), 'source': match.group(3),
+            'manifest': re.search(r'\bmanifest\b', options, re.IGNORECASE) is not None,
+            'format': data_format, 'header': int(option(r'\bignoreheader\s+(?:as\s+)?(\d+)') or 0),
+            'date_format': strptime_format(date_format) if date_format else None,
+            'compression': compression.lower() if compression else None}
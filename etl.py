@@ -1,52 +1,350 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sql_queries import (copy_reference_table_queries, copy_from_s3_to_staging_liquor_sales_table,
+                         load_manifest_from_S3, staging_data_formats, create_table_queries, merge_table_queries, truncate_staging_table_queries,
+                         load_typed_from_S3, typed_data_formats, truncate_typed_staging_table_queries, typed_merge_table_queries,
+                         refresh_rollup_queries, rollup_pending_dates_backfill, staging_table_clear)
+from create_tables import drop_tables, create_tables
+from scheduler import insert_target, table_dependencies, run_graph, critical_path
+import calendar_dim
+import county_keys
+import incremental
+import load_ledger
+import maintenance
+import weather_cities
+import connections
+import metrics
+import migrations
 
 
-def load_staging_tables(cur, conn):
+# Staged batch by batch, the other staging tables hold their whole source
+SALES_STAGING_TABLES = ('staging_liquor_sales', 'staging_liquor_sales_typed')
+
+
+def truncate_staging_tables(cur, conn, queries=truncate_staging_table_queries):
     '''
-    Copies the data from the log files to the staging tables 
+    Empties the staging tables so that they only hold the batch of this run
     '''
-    for query in copy_table_queries:
-        print('Executing {}...'.format(query))
+    for query in queries:
         cur.execute(query)
-        print("Done")
         conn.commit()
 
 
-def insert_tables(cur, conn):
+def truncate_target(query):
+    '''
+    Returns the name of the table a TRUNCATE statement empties
+    '''
+    return re.search(r'truncate\s+(?:table\s+)?(\w+)', query, re.IGNORECASE).group(1)
+
+
+def copy_target(query):
+    '''
+    Returns the name of the table a COPY statement loads into
+    '''
+    return re.search(r'copy\s+(\w+)', query, re.IGNORECASE).group(1)
+
+
+def execute_copy(cur, query):
+    cur.execute(query)
+    return cur.rowcount
+
+
+def stage_table(cur, table, queries):
+    cur.execute(staging_table_clear.format(table))
+    return [execute_copy(cur, query) for query in queries]
+
+
+def run_staging_load(pool, table, queries):
     '''
-    Inserts the data from the staging tables to the final tables
+    Runs the COPY statements of one staging table on a pooled connection, in one transaction
+    that first empties the table, so that a retry after a dropped connection does not stage
+    a file twice. Returns the elapsed time in seconds and the rows of each COPY.
     '''
-    for query in insert_table_queries:
+    start = time.perf_counter()
+    for query in queries:
+        print('Executing {}...'.format(query))
+    rows = pool.transaction(lambda cur: stage_table(cur, table, queries))
+    return time.perf_counter() - start, rows
+
+
+def load_staging_tables(pool, loads, max_workers):
+    '''
+    Copies the data from the source files to the staging tables.
+    The loads are independent, so they run concurrently on at most max_workers connections.
+    Returns the elapsed time of each load and the rows of each of its COPY, keyed by staging table.
+    '''
+    timings, rows = {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {table: executor.submit(run_staging_load, pool, table, queries)
+                   for table, queries in loads.items() if queries}
+        for table, future in futures.items():
+            timings[table], rows[table] = future.result()
+            print('Done {}'.format(table))
+    return timings, rows
+
+
+def plan_staging_loads(cur, conn, config, pool, loads):
+    '''
+    Keeps the COPY of the source files missing from the load ledger or changed since they were
+    loaded. The sales are staged file by file, the other sources in full when any file changed.
+    Returns the COPY and the source objects of every staging table that has any.
+    '''
+    list_objects = load_ledger.object_lister(config, pool)
+    copies = {}
+    for table, queries in loads.items():
+        planned = load_ledger.plan_copies(cur, table, queries, list_objects,
+                                          full=table not in SALES_STAGING_TABLES)
+        if planned:
+            copies[table] = planned
+            print('{}: {} new or changed source file(s)'.format(table, len(planned)))
+        elif table in SALES_STAGING_TABLES:
+            print('{}: no new source file'.format(table))
+        else:
+            print('{}: source unchanged, the staged copy is kept'.format(table))
+    conn.commit()
+    return copies
+
+
+def record_staging_loads(cur, conn, copies, rows):
+    '''
+    Records the source files staged by this run in the load ledger, once they are merged
+    '''
+    for table, planned in copies.items():
+        load_ledger.record(cur, table, zip((obj for _, obj in planned), rows.get(table, [])))
+    conn.commit()
+
+
+def print_timings(timings, wall_time):
+    '''
+    Prints the time taken by each load, slowest first
+    '''
+    print("------------------------------------------------------")
+    for table, elapsed in sorted(timings.items(), key=lambda t: t[1], reverse=True):
+        print('{:<25} {:>8.1f}s'.format(table, elapsed))
+    print('{:<25} {:>8.1f}s (sum of loads {:.1f}s)'.format('wall time', wall_time, sum(timings.values())))
+    print("------------------------------------------------------")
+
+
+def run_merge(pool, queries):
+    '''
+    Runs the delete and the insert of one final table in a single transaction
+    on a pooled connection
+    '''
+    for query in queries:
+        print('Executing {}...'.format(query))
+    pool.run(queries)
+
+
+def merge_target(merge):
+    '''
+    Returns the table a merge writes: the target of its last INSERT, but those queuing rollup dates
+    or stamping the table version
+    '''
+    targets = [insert_target(query) for query in merge if re.match(r'\s*INSERT\s+INTO', query, re.IGNORECASE)]
+    return [table for table in targets if table not in ('rollup_pending_dates', 'table_versions')][-1]
+
+
+def insert_tables(pool, max_workers, queries=merge_table_queries):
+    '''
+    Merges the data from the staging tables into the final tables.
+    The dimensions are merged in parallel and each table starts as soon as
+    the tables it references are done.
+    Returns the start and end time of each table.
+    '''
+    merges = {merge_target(merge): merge for merge in queries}
+    dependencies = table_dependencies(create_table_queries)
+    return run_graph(merges, dependencies, lambda table, queries: run_merge(pool, queries), max_workers)
+
+
+def print_critical_path(timings, wall_time):
+    '''
+    Prints the chain of dependent merges that bounds the insert time
+    '''
+    durations = {table: end - start for table, (start, end) in timings.items()}
+    path, total = critical_path(durations, table_dependencies(create_table_queries))
+    print_timings(durations, wall_time)
+    print('Critical path: {} ({:.1f}s)'.format(' -> '.join(path), total))
+
+
+def extend_calendar(cur, conn, config, staging_table):
+    '''
+    Generates the days of the calendar horizon and of the staged sales missing from time_dim,
+    before sales_fact references them
+    '''
+    first, last = calendar_dim.horizon(config)
+    staged_first, staged_last = calendar_dim.staged_date_range(cur, staging_table)
+    calendar_dim.extend_time_dim(cur, min(first, staged_first or first), max(last, staged_last or last))
+    conn.commit()
+
+
+def reconcile_county_keys(cur, conn, normalized):
+    '''
+    Keys the staged crime counties on their FIPS code and prints the Iowa counties of the census
+    or crime data that county_census_dim will not match
+    '''
+    suffix = '_typed' if normalized else ''
+    rows = county_keys.normalize_keys(cur, 'staging_census' + suffix, 'staging_crime' + suffix)
+    conn.commit()
+    print('\n'.join(county_keys.format_report(rows)))
+
+
+def refresh_rollups(cur, conn, rebuild=False):
+    '''
+    Re-aggregates the rollup tables for the dates touched since their last refresh.
+    With rebuild, every date of sales_fact is re-aggregated.
+    '''
+    if rebuild:
+        cur.execute(rollup_pending_dates_backfill)
+    for query in refresh_rollup_queries:
         print('Executing {}...'.format(query))
         cur.execute(query)
-        print("Done")
+    conn.commit()
+
+
+def typed_staging_loads(config):
+    '''
+    Builds the COPY of each typed staging table from the files written by normalize.py,
+    which are uploaded to one directory per table under normalized_prefix
+    '''
+    prefix = config.get('S3', 'normalized_prefix').strip().strip("'").rstrip('/')
+    data_format = typed_data_formats[config.get('ETL', 'normalized_format', fallback='csv')]
+    tables = [copy_target(query) + '_typed' for query in copy_reference_table_queries] + ['staging_liquor_sales_typed']
+    return {table: [load_typed_from_S3.format(table, "'{}/{}/'".format(prefix, table), data_format)]
+            for table in tables}
+
+
+def run(pool, conn, cur, args, config, max_workers):
+    '''
+    Stages the source data, merges it into the final tables and refreshes the rollups
+    '''
+    with pool.stage('migrate'):
+        if args.full_refresh:
+            print('Full refresh: recreating all the tables...')
+            drop_tables(cur, conn)
+            create_tables(cur, conn)
+        else:
+            migrations.migrate(cur, conn, create_table_queries)
+
+    # Load data from S3 to the staging tables
+    print('Loading S3 data into the staging...')
+    loads = {copy_target(query): [query] for query in copy_reference_table_queries}
+    liquor_sales_prefix = config.get('S3', 'liquor_sales_prefix', fallback='').strip()
+    liquor_sales_manifest = config.get('S3', 'liquor_sales_manifest', fallback='').strip()
+    normalized = config.getboolean('ETL', 'normalized', fallback=False)
+    last_source_mtime = None
+    if normalized:
+        # Typed files written by normalize.py, loaded with plain projections
+        loads = typed_staging_loads(config)
+    elif liquor_sales_prefix:
+        # Only the sales files added since the last run are staged
+        since = None if args.full_refresh else incremental.get_watermark(cur)[2]
+        loads['staging_liquor_sales'], last_source_mtime = incremental.new_liquor_sales_copies(
+            liquor_sales_prefix, since,
+            config.get('AWS', 'key', fallback=None), config.get('AWS', 'secret', fallback=None))
+    elif liquor_sales_manifest:
+        # Parts written by split_files.py, loaded by all the slices in parallel
+        loads['staging_liquor_sales'] = [load_manifest_from_S3.format(
+            'staging_liquor_sales', liquor_sales_manifest,
+            config.get('S3', 'manifest_compression', fallback='gzip'),
+            staging_data_formats['staging_liquor_sales'])]
+    else:
+        loads['staging_liquor_sales'] = [copy_from_s3_to_staging_liquor_sales_table]
+
+    with pool.stage('stage'):
+        copies = plan_staging_loads(cur, conn, config, pool, loads)
+        # A source that did not change keeps its staged copy
+        reloaded = set(copies) | set(SALES_STAGING_TABLES)
+        truncate_staging_tables(cur, conn, [query for query in (truncate_typed_staging_table_queries if normalized
+                                                                 else truncate_staging_table_queries)
+                                            if truncate_target(query) in reloaded])
+
+        start = time.perf_counter()
+        timings, rows = load_staging_tables(pool, {table: [query for query, _ in planned]
+                                                   for table, planned in copies.items()}, max_workers)
+        print_timings(timings, time.perf_counter() - start)
+
+        if not args.full_refresh:
+            incremental.report_late_rows(cur, conn, 'staging_liquor_sales_typed' if normalized
+                                         else 'staging_liquor_sales')
+
+        reconcile_county_keys(cur, conn, normalized)
+    print('Loading complete')
+
+    # Merge data from staging tables into the final tables
+    print('Inserting data into the tables...')
+    with pool.stage('insert'):
+        extend_calendar(cur, conn, config, 'staging_liquor_sales_typed' if normalized else 'staging_liquor_sales')
+        weather_cities.load_weather_cities(cur)
+        conn.commit()
+        start = time.perf_counter()
+        timings = insert_tables(pool, max_workers, typed_merge_table_queries if normalized
+                                else merge_table_queries)
+        print_critical_path(timings, time.perf_counter() - start)
+        # The stores and the temperatures are merged, each store gets its nearest weather city
+        weather_cities.assign_weather_cities(cur)
         conn.commit()
+        incremental.update_watermark(cur, conn, last_source_mtime)
+        record_staging_loads(cur, conn, copies, rows)
+    print('Inserting complete')
+
+    print('Refreshing the rollups...')
+    with pool.stage('rollups'):
+        refresh_rollups(cur, conn, args.rebuild_rollups)
+    print('Refreshing complete')
+
+    # The loads leave stale statistics and unsorted or deleted rows behind
+    print('Maintaining the tables...')
+    with pool.stage('maintenance'):
+        print('\n'.join(maintenance.format_report(maintenance.maintain(conn, config))))
+    print('Maintenance complete')
+
+
+
+def print_slowest_statements(pool, limit=5):
+    '''
+    Prints the statements that took the longest
+    '''
+    print('Slowest statements:')
+    for timing in pool.slowest(limit):
+        print('{:>8.1f}s {:>10} row(s)  {}'.format(timing.seconds, timing.rows, timing.label))
 
 
 def main():
-    
+
+    parser = argparse.ArgumentParser(description='Stage the source data and load the final tables')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='drop and recreate every table and reload all the source data')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='re-aggregate the rollup tables over all of sales_fact')
+    parser.add_argument('--profile', action='store_true',
+                        help='print every statement ranked by the time spent in it')
+    args = parser.parse_args()
+
     # Read credentials from cinfig file
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
-    
-    # Establish connection
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    # Load data from S3 to the staging tables 
-    print('Loading S3 data into the staging...')
-    load_staging_tables(cur, conn)
-    print('Loading complete')
+    max_workers = config.getint('ETL', 'max_workers', fallback=4)
 
-    # Insert data from staging tables to the final tables
-    print('Inserting data into the tables...')
-    insert_tables(cur, conn)
-    print('Inserting complete')
-    
-    conn.close()
+    # One connection for the sequential steps and one per concurrent load
+    pool = connections.pool_from_config(config, max_workers + 1)
+    started, status = time.time(), 'failure'
+    try:
+        with pool.connection() as conn:
+            run(pool, conn, conn.cursor(), args, config, max_workers)
+        status = 'success'
+        if args.profile:
+            metrics.print_profile(pool.timings)
+        else:
+            print_slowest_statements(pool)
+    finally:
+        metrics.emitter_from_config(config).emit(uuid.uuid4().hex, 'etl', pool.timings, pool.stage_seconds,
+                                                 started, status)
+        pool.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
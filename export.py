@@ -0,0 +1,357 @@
+'''
+Exports a warehouse table or the result of a query to partitioned, compressed CSV or Parquet files.
+
+The rows are never held in memory as a whole. Redshift writes the files itself with a parallel
+UNLOAD to S3, every slice writing its own files. From a local Postgres the rows are streamed
+with COPY ... TO STDOUT (CSV) or fetched in batches from a server-side cursor (Parquet, or
+partitioned CSV), and the DuckDB backend fetches them in batches. The files are cut every
+part_rows rows:
+
+    <destination>/part-0000.csv.gz
+    <destination>/date=2017-01-02/part-0000.parquet      with --partition-by date
+
+As with UNLOAD, the partition column is left out of the files, a partitioned export is sorted
+on it so that one file is open at a time, and NULL is written as __HIVE_DEFAULT_PARTITION__.
+
+    python export.py sales_fact exports/sales_fact --format parquet --partition-by date
+    python export.py "SELECT * FROM store_dim WHERE county = 'Polk'" exports/polk --format csv
+    python export.py sales_fact s3://myawsbucket20201109/exports/sales_fact/     # Redshift
+
+The rows, files, MB written, throughput and peak memory of the export are printed at the end.
+'''
+
+import argparse
+import configparser
+import csv
+import io
+import os
+import re
+import time
+import uuid
+import connections
+import metrics
+from split_files import open_part, peak_memory_mb
+from sql_queries import (DWH_IAM_ROLE_ARN, select_export_table, copy_to_stdout, select_export_sorted,
+                         unload_to_s3, unload_formats, select_unload_stats)
+
+# Rows fetched from the cursor at a time
+BATCH_ROWS = 50000
+
+DEFAULT_COMPRESSIONS = {'csv': 'gzip', 'parquet': 'snappy'}
+
+CSV_EXTENSIONS = {'gzip': '.csv.gz', 'zstd': '.csv.zst', 'none': '.csv'}
+
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def export_query(source):
+    '''
+    Returns the query of a table name or of a query
+    '''
+    if re.match(r'\s*(SELECT|WITH)\b', source, re.IGNORECASE):
+        return source.strip().rstrip(';')
+    if not re.match(r'\w+$', source):
+        raise SystemExit('Not a table name or a query: {}'.format(source))
+    return select_export_table.format(source).rstrip(';')
+
+
+def csv_line(values):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerow(values)
+    return out.getvalue().encode()
+
+
+class CsvPart:
+    '''
+    Writes rows to one compressed CSV file with a header line
+    '''
+    def __init__(self, path, columns, compression):
+        self.stream = open_part(path, compression, 6)
+        self.stream.write(csv_line(columns))
+
+    def write(self, rows):
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerows(rows)
+        self.stream.write(out.getvalue().encode())
+
+    def write_lines(self, data):
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.close()
+
+
+class ParquetPart:
+    '''
+    Writes rows to one Parquet file, one row group per batch. The types are inferred from the
+    first batch of the export, or taken from the previous part.
+    '''
+    def __init__(self, path, columns, compression, schema=None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit('The parquet format needs the pyarrow package: pip install pyarrow')
+        self.pa, self.pq = pa, pq
+        self.path, self.columns, self.compression = path, columns, compression
+        self.schema = schema
+        self.writer = None
+
+    def infer_schema(self, columns):
+        fields = []
+        for name, values in zip(self.columns, columns):
+            data_type = self.pa.array(values).type
+            if self.pa.types.is_null(data_type):
+                data_type = self.pa.string()
+            elif self.pa.types.is_decimal(data_type):
+                # A later batch may hold larger values of the same scale
+                data_type = self.pa.decimal128(38, data_type.scale)
+            fields.append(self.pa.field(name, data_type))
+        return self.pa.schema(fields)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        if self.schema is None:
+            self.schema = self.infer_schema(columns)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, self.schema,
+                                                compression='none' if self.compression == 'none' else self.compression)
+        arrays = [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class PartWriter:
+    '''
+    Writes the rows of an export to parts of at most part_rows rows, in a column=value directory
+    per partition. The rows of a partitioned export come sorted on the partition column.
+    '''
+    def __init__(self, directory, columns, output_format, compression, part_rows, partition_by=None):
+        self.directory = directory
+        self.output_format = output_format
+        self.compression = compression
+        self.part_rows = part_rows
+        self.partition = columns.index(partition_by) if partition_by else None
+        self.partition_by = partition_by
+        self.columns = [c for c in columns if c != partition_by]
+        self.part, self.part_value, self.part_count, self.part_number = None, None, 0, 0
+        self.schema = None
+        self.paths = []
+        self.rows = 0
+
+    def open_part(self, value):
+        directory = self.directory
+        if self.partition is not None:
+            directory = os.path.join(directory, '{}={}'.format(
+                self.partition_by, NULL_PARTITION if value is None else value))
+        if value != self.part_value:
+            self.part_number = 0
+        os.makedirs(directory, exist_ok=True)
+        extension = '.parquet' if self.output_format == 'parquet' else CSV_EXTENSIONS[self.compression]
+        path = os.path.join(directory, 'part-{:04d}{}'.format(self.part_number, extension))
+        if self.output_format == 'parquet':
+            self.part = ParquetPart(path, self.columns, self.compression, self.schema)
+        else:
+            self.part = CsvPart(path, self.columns, self.compression)
+        self.paths.append(path)
+        self.part_value, self.part_count = value, 0
+        self.part_number += 1
+
+    def close_part(self):
+        if self.part is not None:
+            self.part.close()
+            self.schema = getattr(self.part, 'schema', None)
+            self.part = None
+
+    def next_part(self, value):
+        '''
+        Opens the part of the next row when the partition changes or the part is full
+        '''
+        if self.part is None or value != self.part_value or self.part_count == self.part_rows:
+            self.close_part()
+            self.open_part(value)
+
+    def write(self, rows):
+        start = 0
+        while start < len(rows):
+            value = rows[start][self.partition] if self.partition is not None else None
+            self.next_part(value)
+            end = min(len(rows), start + self.part_rows - self.part_count)
+            if self.partition is not None:
+                end = next((i for i in range(start, end) if rows[i][self.partition] != value), end)
+                chunk = [row[:self.partition] + row[self.partition + 1:] for row in rows[start:end]]
+            else:
+                chunk = rows[start:end]
+            self.part.write(chunk)
+            self.part_count += end - start
+            self.rows += end - start
+            start = end
+
+    def write_line(self, data):
+        '''
+        Writes one CSV line of a COPY ... TO STDOUT
+        '''
+        self.next_part(None)
+        self.part.write_lines(data)
+        self.part_count += 1
+        self.rows += 1
+
+    def close(self):
+        self.close_part()
+
+    def bytes_written(self):
+        return sum(os.path.getsize(path) for path in self.paths)
+
+
+class CopySink:
+    '''
+    File object receiving a COPY ... TO STDOUT: psycopg2 writes the header line, from which the
+    PartWriter is built, then one line per row
+    '''
+    def __init__(self, parts_for):
+        self.parts_for = parts_for
+        self.parts = None
+
+    def write(self, data):
+        data = data.encode() if isinstance(data, str) else data
+        if self.parts is None:
+            self.parts = self.parts_for(next(csv.reader([data.decode()])))
+        else:
+            self.parts.write_line(data)
+
+
+def stream_rows(cur, query, parts_for, batch_rows):
+    '''
+    Fetches the rows of a query in batches into the PartWriter built from its columns
+    '''
+    cur.execute(query)
+    # A named cursor describes its columns once the first rows are fetched
+    rows = cur.fetchmany(batch_rows)
+    parts = parts_for([column[0] for column in cur.description])
+    try:
+        while rows:
+            parts.write([tuple(row) for row in rows])
+            rows = cur.fetchmany(batch_rows)
+    finally:
+        parts.close()
+    return parts
+
+
+def export_local(conn, kind, query, directory, output_format, compression, part_rows, partition_by=None,
+                 batch_rows=BATCH_ROWS):
+    '''
+    Streams the rows of a query from a local Postgres or DuckDB into files under a directory.
+    Returns (rows, files, bytes).
+    '''
+    if os.path.isdir(directory) and os.listdir(directory):
+        raise SystemExit('The destination {} is not empty'.format(directory))
+
+    def parts_for(columns):
+        if partition_by and partition_by not in columns:
+            raise SystemExit('No column {} to partition on'.format(partition_by))
+        return PartWriter(directory, columns, output_format, compression, part_rows, partition_by)
+
+    if partition_by:
+        query = select_export_sorted.format(query, partition_by)
+    if kind == 'postgres' and output_format == 'csv' and not partition_by:
+        sink = CopySink(parts_for)
+        statement = copy_to_stdout.format(query)
+        start = time.perf_counter()
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert(statement, sink)
+        finally:
+            if sink.parts is not None:
+                sink.parts.close()
+        parts = sink.parts
+        # copy_expert is not timed by the cursor
+        conn.record(statement, time.perf_counter() - start, parts.rows)
+    elif kind == 'postgres':
+        # A named cursor is kept on the server, which sends it itersize rows at a time
+        with conn.cursor('export_{}'.format(uuid.uuid4().hex)) as cur:
+            cur.itersize = batch_rows
+            parts = stream_rows(cur, query, parts_for, batch_rows)
+    else:
+        with conn.cursor() as cur:
+            parts = stream_rows(cur, query, parts_for, batch_rows)
+    conn.commit()
+    return parts.rows, len(parts.paths), parts.bytes_written()
+
+
+def export_redshift(conn, query, prefix, output_format, compression, partition_by=None, max_file_mb=256):
+    '''
+    Unloads the rows of a query to files under an S3 prefix, in parallel from every slice.
+    Returns (rows, files, bytes).
+    '''
+    if not prefix.startswith('s3://'):
+        raise SystemExit('UNLOAD writes to S3: the destination must be an s3:// prefix')
+    options = unload_formats[output_format]
+    if output_format == 'csv' and compression != 'none':
+        options += ' ' + compression.upper()
+    partition = 'PARTITION BY ({})'.format(partition_by) if partition_by else ''
+    with conn.cursor() as cur:
+        cur.execute(unload_to_s3.format(query.replace("'", "''"), prefix, DWH_IAM_ROLE_ARN, options, partition,
+                                        max_file_mb))
+        cur.execute(select_unload_stats)
+        rows, files, size = cur.fetchone()
+    conn.commit()
+    return int(rows), int(files), int(size)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Export a table or a query to partitioned, compressed files')
+    parser.add_argument('source', help='table name, or a SELECT query')
+    parser.add_argument('destination', help='local directory, or S3 prefix on Redshift')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--compression', choices=['gzip', 'zstd', 'snappy', 'none'], default=None,
+                        help='defaults to gzip for CSV and snappy for Parquet')
+    parser.add_argument('--partition-by', default=None, help='column whose values are written to their own directory')
+    parser.add_argument('--part-rows', type=int, default=1000000, help='rows per local file')
+    parser.add_argument('--max-file-mb', type=int, default=256, help='size of the files of an UNLOAD')
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS, help='rows fetched at a time')
+    args = parser.parse_args()
+
+    compression = args.compression or DEFAULT_COMPRESSIONS[args.format]
+    if args.format == 'csv' and compression == 'snappy':
+        raise SystemExit('CSV files are compressed with gzip or zstd')
+    query = export_query(args.source)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    pool = connections.pool_from_config(config, 1)
+    started, status = time.time(), 'failure'
+    try:
+        with pool.connection() as conn:
+            kind = connections.engine(conn)
+            destination = args.destination
+            if kind == 'duckdb' and destination.startswith('s3://'):
+                # The directory of the key under the data directory, as for the COPY of backends.py
+                destination = os.path.join(pool.data_dir, destination[len('s3://'):].partition('/')[2])
+            print('Exporting {} to {}...'.format(args.source, destination))
+            start = time.perf_counter()
+            with pool.stage('export'):
+                if kind == 'redshift':
+                    rows, files, size = export_redshift(conn, query, destination, args.format, compression,
+                                                        args.partition_by, args.max_file_mb)
+                else:
+                    rows, files, size = export_local(conn, kind, query, destination, args.format, compression,
+                                                     args.part_rows, args.partition_by, args.batch_rows)
+            elapsed = time.perf_counter() - start
+        status = 'success'
+        print("------------------------------------------------------")
+        print('{} row(s) in {} file(s), {:.1f} MB, in {:.1f}s: {:.0f} rows/s, {:.1f} MB/s, peak memory {:.1f} MB'.format(
+            rows, files, size / 1024 / 1024, elapsed, rows / elapsed if elapsed else 0,
+            size / 1024 / 1024 / elapsed if elapsed else 0, peak_memory_mb()))
+        print("------------------------------------------------------")
+    finally:
+        metrics.emitter_from_config(config).emit(uuid.uuid4().hex, 'export', pool.timings, pool.stage_seconds,
+                                                 started, status)
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
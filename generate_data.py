@@ -0,0 +1,249 @@
+'''
+Generates synthetic source files matching the staging tables of sql_queries.py.
+
+The liquor sales, census and crime files have the columns and formats of the original datasets
+(MM/DD/YYYY dates, dollar amounts, "X County, IA" crime counties) and the temperatures are JSON
+lines keyed by the columns of staging_temperature, so they are loaded by the same COPY and merged
+by the same queries. The output only depends on the
+scale factor and the seed.
+
+At scale 1 there are 100,000 sales rows and 50 temperature cities over the six years of sales.
+Both grow linearly with the scale. The census and crime files always hold the 3,220 counties of
+the original data, of which the 99 Iowa ones join the sales.
+
+    python generate_data.py data/ --scale 10 --seed 42
+'''
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import time
+
+SALES_ROWS = 100000
+TEMPERATURE_CITIES = 50
+STORES = 1500
+ITEMS = 8000
+VENDORS = 300
+START_DATE = datetime.date(2012, 1, 1)
+DAYS = 2191
+
+FILES = {'staging_liquor_sales': 'Iowa_Liquor_Sales.csv',
+         'staging_temperature': 'city_temperature.json',
+         'staging_census': 'acs2017_county_data.csv',
+         'staging_crime': 'crime_data_w_population_and_crime_rate.csv'}
+
+# In alphabetical order, so that county number n has the FIPS code 19000 + 2n - 1
+IOWA_COUNTIES = [
+    'Adair', 'Adams', 'Allamakee', 'Appanoose', 'Audubon', 'Benton', 'Black Hawk', 'Boone', 'Bremer',
+    'Buchanan', 'Buena Vista', 'Butler', 'Calhoun', 'Carroll', 'Cass', 'Cedar', 'Cerro Gordo', 'Cherokee',
+    'Chickasaw', 'Clarke', 'Clay', 'Clayton', 'Clinton', 'Crawford', 'Dallas', 'Davis', 'Decatur',
+    'Delaware', 'Des Moines', 'Dickinson', 'Dubuque', 'Emmet', 'Fayette', 'Floyd', 'Franklin', 'Fremont',
+    'Greene', 'Grundy', 'Guthrie', 'Hamilton', 'Hancock', 'Hardin', 'Harrison', 'Henry', 'Howard',
+    'Humboldt', 'Ida', 'Iowa', 'Jackson', 'Jasper', 'Jefferson', 'Johnson', 'Jones', 'Keokuk', 'Kossuth',
+    'Lee', 'Linn', 'Louisa', 'Lucas', 'Lyon', 'Madison', 'Mahaska', 'Marion', 'Marshall', 'Mills',
+    'Mitchell', 'Monona', 'Monroe', 'Montgomery', 'Muscatine', "O'Brien", 'Osceola', 'Page', 'Palo Alto',
+    'Plymouth', 'Pocahontas', 'Polk', 'Pottawattamie', 'Poweshiek', 'Ringgold', 'Sac', 'Scott', 'Shelby',
+    'Sioux', 'Story', 'Tama', 'Taylor', 'Union', 'Van Buren', 'Wapello', 'Warren', 'Washington', 'Wayne',
+    'Webster', 'Winnebago', 'Winneshiek', 'Woodbury', 'Worth', 'Wright']
+
+# (state, abbreviation, FIPS code) of the counties outside Iowa
+OTHER_STATES = [('Illinois', 'IL', 17), ('Indiana', 'IN', 18), ('Kansas', 'KS', 20), ('Minnesota', 'MN', 27),
+                ('Missouri', 'MO', 29), ('Nebraska', 'NE', 31), ('Ohio', 'OH', 39), ('South Dakota', 'SD', 46),
+                ('Texas', 'TX', 48), ('Wisconsin', 'WI', 55)]
+TOTAL_COUNTIES = 3220
+
+IOWA_CITIES = ['Des Moines', 'Cedar Rapids', 'Davenport', 'Sioux City', 'Iowa City', 'Waterloo', 'Ames',
+               'West Des Moines', 'Council Bluffs', 'Dubuque', 'Ankeny', 'Urbandale', 'Cedar Falls',
+               'Marion', 'Bettendorf', 'Mason City', 'Marshalltown', 'Clinton', 'Burlington', 'Ottumwa']
+SALES_CITIES = 450
+
+CATEGORIES = [(1011100, 'Blended Whiskies'), (1012100, 'Canadian Whiskies'), (1031100, 'American Vodkas'),
+              (1032100, 'Imported Vodkas'), (1062300, 'Flavored Rum'), (1081600, 'Whiskey Liqueur'),
+              (1022100, 'Tequila'), (1041100, 'American Dry Gins')]
+BOTTLE_VOLUMES = [50, 200, 375, 500, 750, 1000, 1750]
+
+SALES_HEADER = ['Invoice/Item Number', 'Date', 'Store Number', 'Store Name', 'Address', 'City', 'Zip Code',
+                'Store Location', 'County Number', 'County', 'Category', 'Category Name', 'Vendor Number',
+                'Vendor Name', 'Item Number', 'Item Description', 'Pack', 'Bottle Volume (ml)',
+                'State Bottle Cost', 'State Bottle Retail', 'Bottles Sold', 'Sale (Dollars)',
+                'Volume Sold (Liters)', 'Volume Sold (Gallons)']
+# Keys of the temperature records, read by the json 'auto' COPY into the columns of the same name
+TEMPERATURE_KEYS = ['region', 'country', 'state', 'city', 'month', 'day', 'year', 'temperature']
+CENSUS_HEADER = ['CountyId', 'State', 'County', 'TotalPop', 'Men', 'Women', 'Hispanic', 'White', 'Black',
+                 'Native', 'Asian', 'Pacific', 'VotingAgeCitizen', 'Income', 'IncomeErr', 'IncomePerCap',
+                 'IncomePerCapErr', 'Poverty', 'ChildPoverty', 'Professional', 'Service', 'Office',
+                 'Construction', 'Production', 'Drive', 'Carpool', 'Transit', 'Walk', 'OtherTransp',
+                 'WorkAtHome', 'MeanCommute', 'Employed', 'PrivateWork', 'PublicWork', 'SelfEmployed',
+                 'FamilyWork', 'Unemployment']
+CRIME_HEADER = ['county_name', 'crime_rate_per_100000', 'index', 'EDITION', 'PART', 'IDNO', 'CPOPARST',
+                'CPOPCRIM', 'AG_ARRST', 'AG_OFF', 'COVIND', 'INDEX', 'MODINDX', 'MURDER', 'RAPE', 'ROBBERY',
+                'AGASSLT', 'BURGLRY', 'LARCENY', 'MVTHEFT', 'ARSON', 'population', 'FIPS_ST', 'FIPS_CTY']
+
+
+def dollars(amount):
+    return '${:.2f}'.format(amount)
+
+
+def counties():
+    '''
+    Yields (state, abbreviation, state FIPS, county FIPS, county name) for every county
+    '''
+    for number, name in enumerate(IOWA_COUNTIES, 1):
+        yield 'Iowa', 'IA', 19, 2 * number - 1, name
+    others = TOTAL_COUNTIES - len(IOWA_COUNTIES)
+    for i in range(others):
+        state, abbreviation, fips = OTHER_STATES[i % len(OTHER_STATES)]
+        number = i // len(OTHER_STATES) + 1
+        yield state, abbreviation, fips, 2 * number - 1, 'County {}'.format(number)
+
+
+def make_stores(rng):
+    '''
+    Returns the attributes of every store. A store keeps the same attributes on every sale.
+    '''
+    cities = IOWA_CITIES + ['Town {}'.format(n) for n in range(1, SALES_CITIES - len(IOWA_CITIES) + 1)]
+    stores = []
+    for store_num in range(2000, 2000 + STORES):
+        county_num = rng.randint(1, len(IOWA_COUNTIES))
+        lon, lat = rng.uniform(-96.6, -90.2), rng.uniform(40.4, 43.5)
+        stores.append([store_num, 'Store #{}'.format(store_num), '{} Main St'.format(rng.randint(1, 9999)),
+                       rng.choice(cities), str(rng.randint(50001, 52809)),
+                       'POINT ({:.6f} {:.6f})'.format(lon, lat), county_num, IOWA_COUNTIES[county_num - 1]])
+    return stores
+
+
+def make_items(rng):
+    '''
+    Returns the attributes and the unit cost of every item
+    '''
+    items = []
+    for item_num in range(10000, 10000 + ITEMS):
+        category, category_name = rng.choice(CATEGORIES)
+        vendor_num = rng.randint(1, VENDORS)
+        cost = round(rng.uniform(2, 60), 2)
+        items.append([category, category_name, vendor_num, 'Vendor {}'.format(vendor_num), item_num,
+                      'Item {}'.format(item_num), rng.choice([6, 12, 24]), rng.choice(BOTTLE_VOLUMES), cost])
+    return items
+
+
+def write_liquor_sales(path, scale, seed):
+    rng = random.Random(seed)
+    stores, items = make_stores(rng), make_items(rng)
+    rows = SALES_ROWS * scale
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(SALES_HEADER)
+        for n in range(rows):
+            # Rows come in date order, like the daily files of the original data
+            date = START_DATE + datetime.timedelta(days=n * DAYS // rows)
+            store = rng.choice(stores)
+            category, category_name, vendor_num, vendor_name, item_num, item_name, pack, volume, cost = \
+                rng.choice(items)
+            retail = round(cost * 1.5, 2)
+            sold = rng.choice([1, 1, 2, 3, 6, 12, 24])
+            liters = sold * volume / 1000
+            writer.writerow(['INV-{:011d}'.format(n + 1), date.strftime('%m/%d/%Y')] + store[:8] +
+                            [category, category_name, vendor_num, vendor_name, item_num, item_name, pack,
+                             volume, dollars(cost), dollars(retail), sold, dollars(retail * sold),
+                             round(liters, 2), round(liters * 0.264172, 2)])
+    return rows
+
+
+def write_temperature(path, scale, seed):
+    rng = random.Random(seed + 1)
+    cities = [('North America', 'US', 'Iowa', city) for city in IOWA_CITIES[:10]]
+    for n in range(TEMPERATURE_CITIES * scale - len(cities)):
+        cities.append(rng.choice([('North America', 'US', 'Texas', 'City {}'.format(n)),
+                                  ('Europe', 'Germany', '', 'City {}'.format(n)),
+                                  ('Asia', 'Japan', '', 'City {}'.format(n))]))
+    rows = 0
+    with open(path, 'w') as f:
+        for region, country, state, city in cities:
+            for day in range(DAYS):
+                date = START_DATE + datetime.timedelta(days=day)
+                # -99 marks the missing measures, as in the original data
+                temperature = -99 if rng.random() < 0.01 else round(50 - 30 * ((date.month - 7) / 6) ** 2 +
+                                                                     rng.gauss(0, 8), 1)
+                f.write(json.dumps(dict(zip(TEMPERATURE_KEYS, [region, country, state, city, date.month, date.day,
+                                                               date.year, temperature]))) + '\n')
+                rows += 1
+    return rows
+
+
+def write_census(path, scale, seed):
+    rng = random.Random(seed + 2)
+    rows = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(CENSUS_HEADER)
+        for state, _, state_fips, county_fips, name in counties():
+            total = rng.randint(3000, 500000)
+            men = total * rng.randint(480, 520) // 1000
+            shares = [round(rng.uniform(0, 99), 1) for _ in range(6)]
+            writer.writerow([state_fips * 1000 + county_fips, state, name + ' County', total, men, total - men] +
+                            shares + [total * 3 // 4, rng.randint(30000, 90000), rng.randint(1000, 9000),
+                                      rng.randint(15000, 45000), rng.randint(500, 3000)] +
+                            [round(rng.uniform(0, 40), 1) for _ in range(13)] +
+                            [round(rng.uniform(10, 35), 1), total // 2] +
+                            [round(rng.uniform(0, 90), 1) for _ in range(4)] + [round(rng.uniform(1, 15), 1)])
+            rows += 1
+    return rows
+
+
+def write_crime(path, scale, seed):
+    rng = random.Random(seed + 3)
+    rows = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(CRIME_HEADER)
+        for index, (_, abbreviation, state_fips, county_fips, name) in enumerate(counties(), 1):
+            population = rng.randint(3000, 500000)
+            counts = [rng.randint(0, population // 100) for _ in range(8)]
+            writer.writerow(['{} County, {}'.format(name, abbreviation), round(sum(counts) / population * 1e5, 1),
+                             index, 1, 4, index, population, population, sum(counts) // 2, sum(counts),
+                             round(rng.uniform(50, 100), 2), sum(counts), sum(counts)] + counts +
+                            [population, state_fips, county_fips])
+            rows += 1
+    return rows
+
+
+WRITERS = {'staging_liquor_sales': write_liquor_sales,
+           'staging_temperature': write_temperature,
+           'staging_census': write_census,
+           'staging_crime': write_crime}
+
+
+def generate(output_dir, scale=1, seed=42):
+    '''
+    Writes the four source files. Returns the path and the number of rows of each, keyed by staging table.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    for table, write in WRITERS.items():
+        path = os.path.join(output_dir, FILES[table])
+        files[table] = (path, write(path, scale, seed))
+    return files
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Generate synthetic source files at a scale factor')
+    parser.add_argument('output_dir', help='directory receiving the four source files')
+    parser.add_argument('--scale', type=int, default=1, help='scale factor, 1 is 100,000 sales rows')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    files = generate(args.output_dir, args.scale, args.seed)
+    print("------------------------------------------------------")
+    for table, (path, rows) in files.items():
+        print('{:<22} {:>12} row(s)  {}'.format(table, rows, path))
+    print("------------------------------------------------------")
+    print('Generated in {:.1f}s'.format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
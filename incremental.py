@@ -0,0 +1,86 @@
+'''
+Helpers for the incremental (watermark-driven) load of sales_fact.
+'''
+
+import datetime
+from sql_queries import (select_watermark, sales_fact_watermark_upsert,
+                         count_staged_before_watermark, copy_to_staging_liquor_sales_table)
+
+
+def get_watermark(cur, table_name='sales_fact'):
+    '''
+    Returns (max_date, max_invoice_num, last_source_mtime) recorded for a table,
+    or a tuple of Nones if the table has never been loaded
+    '''
+    cur.execute(select_watermark, (table_name,))
+    row = cur.fetchone()
+    return row if row else (None, None, None)
+
+
+def update_watermark(cur, conn, last_source_mtime=None):
+    '''
+    Records the high-water mark of sales_fact after a successful merge
+    '''
+    for query in sales_fact_watermark_upsert:
+        cur.execute(query, {'last_source_mtime': last_source_mtime})
+    conn.commit()
+
+
+def split_s3_url(url):
+    '''
+    Splits a (possibly quoted) s3://bucket/key URL into bucket and key
+    '''
+    url = url.strip().strip("'\"")
+    if not url.startswith('s3://'):
+        raise ValueError('Not an S3 URL: {}'.format(url))
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_new_source_files(prefix, since, aws_key=None, aws_secret=None):
+    '''
+    Lists the S3 objects under a prefix that were modified after `since`.
+    Returns a list of (quoted url, last_modified) sorted by modification time.
+    '''
+    import boto3
+
+    bucket, key_prefix = split_s3_url(prefix)
+    s3 = boto3.client('s3', aws_access_key_id=aws_key or None, aws_secret_access_key=aws_secret or None)
+    files = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key_prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            # S3 returns aware datetimes, Redshift TIMESTAMP columns are naive UTC
+            modified = obj['LastModified'].astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            if since is None or modified > since:
+                files.append(("'s3://{}/{}'".format(bucket, obj['Key']), modified))
+    return sorted(files, key=lambda f: f[1])
+
+
+def new_liquor_sales_copies(prefix, since, aws_key=None, aws_secret=None):
+    '''
+    Builds one COPY per sales file added under the prefix since the last load.
+    Returns the queries and the newest modification time, or None if nothing was new.
+    '''
+    files = list_new_source_files(prefix, since, aws_key, aws_secret)
+    if not files:
+        print('No new sales files since {}'.format(since))
+        return [], None
+    print('{} new sales file(s) to stage'.format(len(files)))
+    return [copy_to_staging_liquor_sales_table.format(url) for url, _ in files], files[-1][1]
+
+
+def report_late_rows(cur, conn, staging_table='staging_liquor_sales'):
+    '''
+    Prints the number of staged sales rows dated before the high-water mark. They are late or
+    corrected rows and are merged like the others, replacing the rows of their invoices.
+    Returns the number of rows.
+    '''
+    cur.execute(count_staged_before_watermark.format(staging_table))
+    late, first = cur.fetchone()
+    conn.commit()
+    if late:
+        print('{} staged row(s) dated before the watermark, from {}, merged as late or corrected rows'.format(
+            late, first))
+    return late
@@ -0,0 +1,171 @@
+'''
+Micro-batch ingestion of the sales files arriving in a landing prefix.
+
+Runs until interrupted: the landing prefix (or the directory standing in for it with the
+DuckDB backend) is listed every poll_seconds, and the files missing from the load ledger are
+grouped into micro-batches. A batch is ingested once it holds batch_max_files files or
+batch_max_mb MB, or once its oldest file has waited batch_window_seconds. Every batch is staged,
+merged into the stores, items, cities and sales_fact, and the rollups are refreshed.
+
+The sales_fact merge and the ledger record of the files of the batch are committed together,
+so a file is counted once: a batch that fails before is ingested again from the start, and its
+dimension merges are idempotent.
+
+After every batch the freshness lag is emitted with the metrics of the [METRICS] section: the
+seconds from the arrival of the oldest file of the batch to its commit in sales_fact.
+
+    [INGEST]
+    landing_prefix = 's3://myawsbucket20201109/landing/liquor_sales/'
+    poll_seconds = 30
+    batch_max_files = 50
+    batch_max_mb = 512
+    batch_window_seconds = 300
+
+    python ingest.py
+    python ingest.py --once      # ingests the files waiting now, whatever their batch, and exits
+'''
+
+import argparse
+import configparser
+import datetime
+import time
+import uuid
+from sql_queries import (create_table_queries, copy_to_staging_liquor_sales_table, truncate_staging_liquor_sales_table,
+                         city_dim_table_merge, store_dim_table_merge, item_dim_table_merge, sales_fact_table_merge)
+from etl import execute_copy, extend_calendar, refresh_rollups
+import connections
+import incremental
+import load_ledger
+import metrics
+import migrations
+import weather_cities
+
+STAGING_TABLE = 'staging_liquor_sales'
+
+
+def pending_files(cur, conn, landing_copy, list_objects):
+    '''
+    Returns (COPY, object) of the landed files missing from the load ledger or changed since,
+    oldest first
+    '''
+    pending = load_ledger.plan_copies(cur, STAGING_TABLE, [landing_copy], list_objects)
+    conn.commit()
+    return sorted(pending, key=lambda copy: copy[1].modified)
+
+
+def next_batch(pending, max_files, max_bytes, window_seconds, now, flush=False):
+    '''
+    Returns the first micro-batch of the pending files when it is ready, None otherwise.
+    A batch is ready once it is full or its oldest file has waited the window.
+    '''
+    batch, size = [], 0
+    for copy in pending:
+        if batch and (len(batch) == max_files or size + copy[1].size > max_bytes):
+            return batch
+        batch.append(copy)
+        size += copy[1].size
+    if batch and (flush or len(batch) == max_files or size >= max_bytes
+                  or (now - batch[0][1].modified).total_seconds() >= window_seconds):
+        return batch
+    return None
+
+
+def ingest_batch(pool, cur, conn, config, batch):
+    '''
+    Stages the files of a batch and merges them. Returns the rows staged.
+    '''
+    with pool.stage('stage'):
+        cur.execute(truncate_staging_liquor_sales_table)
+        conn.commit()
+        rows = []
+        for query, obj in batch:
+            print('Staging {}...'.format(obj.url))
+            rows.append(execute_copy(cur, query))
+            conn.commit()
+
+    with pool.stage('insert'):
+        extend_calendar(cur, conn, config, STAGING_TABLE)
+        weather_cities.load_weather_cities(cur)
+        conn.commit()
+        # The cities come first, sales_fact looks up their keys
+        for merge in (city_dim_table_merge, store_dim_table_merge, item_dim_table_merge):
+            for query in merge:
+                cur.execute(query)
+            conn.commit()
+        weather_cities.assign_weather_cities(cur)
+        conn.commit()
+        # The sales and the ledger record of their files in one transaction: exactly once
+        for query in sales_fact_table_merge:
+            cur.execute(query)
+        load_ledger.record(cur, STAGING_TABLE, zip((obj for _, obj in batch), rows))
+        conn.commit()
+        incremental.update_watermark(cur, conn, max(obj.modified for _, obj in batch))
+
+    with pool.stage('rollups'):
+        refresh_rollups(cur, conn)
+    return sum(max(count, 0) for count in rows)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Ingest the sales files of a landing prefix in micro-batches')
+    parser.add_argument('--once', action='store_true', help='ingest the files waiting now and exit')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    landing_prefix = (config.get('INGEST', 'landing_prefix', fallback='').strip()
+                      or config.get('S3', 'liquor_sales_prefix', fallback='').strip())
+    if not landing_prefix:
+        raise SystemExit('A landing prefix is required (landing_prefix in the [INGEST] section of dwh.cfg)')
+    poll_seconds = config.getfloat('INGEST', 'poll_seconds', fallback=30)
+    max_files = config.getint('INGEST', 'batch_max_files', fallback=50)
+    max_bytes = config.getfloat('INGEST', 'batch_max_mb', fallback=512) * 1024 * 1024
+    window_seconds = config.getfloat('INGEST', 'batch_window_seconds', fallback=300)
+    landing_copy = copy_to_staging_liquor_sales_table.format("'{}'".format(landing_prefix.strip("'\"")))
+
+    pool = connections.pool_from_config(config, 1)
+    emitter = metrics.emitter_from_config(config)
+    list_objects = load_ledger.object_lister(config, pool)
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            migrations.migrate(cur, conn, create_table_queries)
+            pool.take_timings()
+            print('Watching {}...'.format(landing_prefix))
+            while True:
+                pending = pending_files(cur, conn, landing_copy, list_objects)
+                batch = next_batch(pending, max_files, max_bytes, window_seconds,
+                                   datetime.datetime.utcnow(), flush=args.once)
+                if batch is None:
+                    if args.once:
+                        break
+                    time.sleep(poll_seconds)
+                    continue
+
+                run_id, started, status = uuid.uuid4().hex, time.time(), 'failure'
+                try:
+                    rows = ingest_batch(pool, cur, conn, config, batch)
+                    status = 'success'
+                except Exception as error:
+                    conn.rollback()
+                    if args.once:
+                        raise
+                    print('Batch failed, retried at the next poll: {}'.format(error))
+                    time.sleep(poll_seconds)
+                finally:
+                    stage_seconds = dict(pool.stage_seconds)
+                    emitter.emit(run_id, 'ingest', pool.take_timings(), stage_seconds, started, status)
+                if status == 'success':
+                    lag = (datetime.datetime.utcnow() - batch[0][1].modified).total_seconds()
+                    emitter.emit_gauges(run_id, 'ingest', {'freshness_lag_seconds': round(lag, 1),
+                                                           'batch_files': len(batch), 'batch_rows': rows})
+                    print('Ingested {} file(s), {} row(s), freshness lag {:.0f}s'.format(len(batch), rows, lag))
+    except KeyboardInterrupt:
+        print('Stopped')
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
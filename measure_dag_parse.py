@@ -0,0 +1,111 @@
+'''
+Measures what importing the DAG file costs the scheduler.
+
+The scheduler parses the files of dags/ every few seconds, so whatever they do at import is
+paid again on every parse. Each revision of dags/ is imported in new processes, once Airflow
+itself is imported, so that only the DAG file and its modules are timed: sql_queries.py alone,
+and the whole DAG file when Airflow is installed.
+
+    python measure_dag_parse.py --rev HEAD~1 working --repeat 20
+    python measure_dag_parse.py --rev HEAD~1 working --no-config
+
+"working" is the working tree. With --no-config the files are imported from a directory
+without dwh.cfg, as on a scheduler that does not have it.
+'''
+
+import argparse
+import io
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+MODULES = ['sql_queries', 'dend_cap_dag']
+
+# Run in a new process: imports Airflow, then times the import of one module of dags/.
+# The standard modules Airflow loads are imported first too, for when it is not installed.
+timed_import = '''
+import configparser, datetime, functools, importlib, logging, re, sys, time
+sys.path.insert(0, {dags!r})
+try:
+    import airflow.models, airflow.hooks.postgres_hook, airflow.operators.postgres_operator
+except ImportError:
+    pass
+start = time.perf_counter()
+try:
+    importlib.import_module({module!r})
+except Exception as error:
+    print('error ' + type(error).__name__)
+else:
+    print(time.perf_counter() - start)
+'''
+
+
+def export_dags(rev, directory):
+    '''
+    Writes the dags/ directory of a revision (or of the working tree) under directory
+    '''
+    target = os.path.join(directory, rev.replace('/', '_'))
+    if rev == 'working':
+        shutil.copytree('dags', os.path.join(target, 'dags'), ignore=shutil.ignore_patterns('__pycache__'))
+    else:
+        archive = subprocess.check_output(['git', 'archive', rev, 'dags'])
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(target)
+    return os.path.join(target, 'dags')
+
+
+def time_import(dags, module, cwd, repeat):
+    '''
+    Returns the seconds taken by every import of a module, or the error it failed with
+    '''
+    # The bytecode of the modules is cached, as on a scheduler, by a first import not counted
+    env = {name: value for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE'}
+    timings = []
+    for _ in range(repeat + 1):
+        result = subprocess.run([sys.executable, '-c', timed_import.format(dags=dags, module=module)],
+                                cwd=cwd, env=env, capture_output=True, text=True)
+        output = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else 'error ' + result.stderr
+        if output.startswith('error'):
+            return output
+        timings.append(float(output))
+    return timings[1:]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Time the import of the DAG file at several revisions')
+    parser.add_argument('--rev', nargs='+', default=['HEAD', 'working'], help='git revisions, or working')
+    parser.add_argument('--repeat', type=int, default=10, help='imports of each module, each in a new process')
+    parser.add_argument('--config', default='dwh.cfg', help='config file available to the imports')
+    parser.add_argument('--no-config', action='store_true', help='import without any dwh.cfg')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        cwd = os.path.join(directory, 'cwd')
+        os.makedirs(cwd)
+        if not args.no_config and os.path.exists(args.config):
+            shutil.copy(args.config, os.path.join(cwd, 'dwh.cfg'))
+
+        print("------------------------------------------------------")
+        print('{:<12} {:<14} {:>10} {:>10}'.format('revision', 'module', 'median ms', 'min ms'))
+        for rev in args.rev:
+            dags = export_dags(rev, directory)
+            for module in MODULES:
+                timings = time_import(dags, module, cwd, args.repeat)
+                if isinstance(timings, str):
+                    print('{:<12} {:<14} {}'.format(rev, module, timings.strip().splitlines()[-1]))
+                else:
+                    print('{:<12} {:<14} {:>10.2f} {:>10.2f}'.format(
+                        rev, module, statistics.median(timings) * 1000, min(timings) * 1000))
+        print("------------------------------------------------------")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+'''
+Measures what the integer county and city keys of sales_fact save.
+
+A generated dataset is loaded twice: once with the county and city repeated as VARCHAR(25)
+on every row (the previous layout of sales_fact) and once with integer keys (the current one).
+The size of both tables and the time of the county and city joins are compared.
+
+The rows are generated on the server with generate_series, so this runs against a local
+Postgres (--dsn, or the dsn of the [API] section of dwh.cfg), not against Redshift.
+
+    python measure_slim_fact.py --rows 5000000 --dsn "dbname=dwh"
+'''
+
+import argparse
+import configparser
+import time
+import connections
+
+COUNTIES = 99
+CITIES = 450
+
+# Names of 4 to 17 characters, like the Iowa county and city names
+setup_queries = [
+    "DROP TABLE IF EXISTS bench_wide_fact, bench_slim_fact, bench_county, bench_city",
+    """CREATE TABLE bench_county AS
+       SELECT 19000 + 2 * n - 1 AS county_id, INITCAP(SUBSTR(MD5(n::TEXT), 1, 4 + n % 8))::VARCHAR(25) AS county
+       FROM   generate_series(1, {counties}) n""",
+    """CREATE TABLE bench_city AS
+       SELECT n AS city_id, INITCAP(SUBSTR(MD5('city' || n), 1, 4 + n % 14))::VARCHAR(25) AS city
+       FROM   generate_series(1, {cities}) n""",
+    """CREATE TABLE bench_wide_fact AS
+       SELECT n                                       AS sales_id,
+              DATE '2012-01-01' + (n % 2190)::INTEGER AS date,
+              (n * 7919) % 1500                       AS store_id,
+              (n * 104729) % 9000                     AS item_id,
+              1 + n % 12                              AS sold_count,
+              (1 + n % 12) * 750 / 1000               AS volume_sold,
+              ((1 + n % 12) * 12.99)::DECIMAL(8,2)    AS sales,
+              cn.county,
+              ct.city
+       FROM   generate_series(1, {rows}) n
+       JOIN   bench_county cn ON cn.county_id = 19000 + 2 * (1 + n % {counties}) - 1
+       JOIN   bench_city ct ON ct.city_id = 1 + (n * 31) % {cities}""",
+    """CREATE TABLE bench_slim_fact AS
+       SELECT w.sales_id, w.date, w.store_id, w.item_id, w.sold_count, w.volume_sold, w.sales,
+              cn.county_id, ct.city_id
+       FROM   bench_wide_fact w
+       JOIN   bench_county cn ON w.county = cn.county
+       JOIN   bench_city ct ON w.city = ct.city""",
+    "ANALYZE bench_county",
+    "ANALYZE bench_city",
+    "ANALYZE bench_wide_fact",
+    "ANALYZE bench_slim_fact",
+]
+
+cleanup_query = "DROP TABLE IF EXISTS bench_wide_fact, bench_slim_fact, bench_county, bench_city"
+
+table_size = "SELECT pg_total_relation_size(%s) / 1024.0 / 1024.0"
+
+# (measure, query on the VARCHAR layout, query on the integer key layout)
+join_queries = [
+    ('county join',
+     "SELECT c.county, SUM(f.sales) FROM bench_wide_fact f JOIN bench_county c ON f.county = c.county GROUP BY c.county",
+     "SELECT c.county, SUM(f.sales) FROM bench_slim_fact f JOIN bench_county c ON f.county_id = c.county_id GROUP BY c.county"),
+    ('city join',
+     "SELECT c.city, SUM(f.sales) FROM bench_wide_fact f JOIN bench_city c ON f.city = c.city GROUP BY c.city",
+     "SELECT c.city, SUM(f.sales) FROM bench_slim_fact f JOIN bench_city c ON f.city_id = c.city_id GROUP BY c.city"),
+]
+
+
+def best_time(pool, query, repeat):
+    '''
+    Returns the fastest of `repeat` runs of a query, in seconds
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pool.fetch(query)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure(pool, rows, repeat):
+    '''
+    Generates both layouts and returns (measure, wide, slim) tuples
+    '''
+    print('Generating {} row(s) in both layouts...'.format(rows))
+    pool.run([query.format(rows=rows, counties=COUNTIES, cities=CITIES) for query in setup_queries])
+    results = [('table size MB',
+                float(pool.fetch(table_size, ('bench_wide_fact',))[0][0]),
+                float(pool.fetch(table_size, ('bench_slim_fact',))[0][0]))]
+    for name, wide_query, slim_query in join_queries:
+        results.append((name + ' s', best_time(pool, wide_query, repeat), best_time(pool, slim_query, repeat)))
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compare sales_fact with VARCHAR and integer county/city keys')
+    parser.add_argument('--rows', type=int, default=1000000, help='rows of the generated fact table')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each join, the fastest is kept')
+    parser.add_argument('--dsn', default=None, help='libpq DSN of a local Postgres')
+    parser.add_argument('--keep', action='store_true', help='keep the generated tables')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    dsn = args.dsn or config.get('API', 'dsn', fallback='').strip() or None
+    if not dsn:
+        raise SystemExit('A local Postgres DSN is required (--dsn or dsn in the [API] section of dwh.cfg)')
+
+    pool = connections.pool_from_config(config, 1, dsn)
+    try:
+        results = measure(pool, args.rows, args.repeat)
+        print("------------------------------------------------------")
+        print('{:<16} {:>12} {:>12} {:>10}'.format('', 'VARCHAR', 'integer', 'change'))
+        for name, wide, slim in results:
+            change = (slim - wide) / wide * 100 if wide else 0
+            print('{:<16} {:>12.3f} {:>12.3f} {:>9.1f}%'.format(name, wide, slim, change))
+        print("------------------------------------------------------")
+    finally:
+        if not args.keep:
+            pool.run([cleanup_query])
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
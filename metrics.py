@@ -0,0 +1,148 @@
+'''
+Structured metrics of a run, built from the statements timed by connections.py.
+
+The statements of a run are summarized per stage (wall time, statements, time spent in them,
+rows affected and bytes loaded) and for the whole run. The summaries are appended as JSON lines
+to a file and/or sent as StatsD metrics over UDP, as set in the [METRICS] section of dwh.cfg:
+
+    {"run_id": "...", "job": "etl", "stage": "insert", "wall_seconds": 41.2, "statements": 21, ...}
+    dwh.etl.insert.wall_seconds:41200|ms
+
+Point-in-time values, such as the freshness lag of ingest.py, are emitted as gauges.
+
+The --profile flag of the scripts prints the statements ranked by the time spent in them.
+'''
+
+import datetime
+import json
+import socket
+import time
+
+
+def summarize(timings, stage_seconds=None):
+    '''
+    Aggregates StatementTiming records per stage.
+    Returns {stage: {'statements', 'seconds', 'rows', 'bytes', 'wall_seconds'}}, in the order of the run.
+    '''
+    stages = {}
+    for timing in timings:
+        stage = stages.setdefault(timing.stage or 'other', {'statements': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+        stage['statements'] += 1
+        stage['seconds'] += timing.seconds
+        stage['rows'] += max(timing.rows or 0, 0)
+        stage['bytes'] += timing.bytes or 0
+    for name, stage in stages.items():
+        # Concurrent statements overlap, so the wall time of a stage can be below their sum
+        stage['wall_seconds'] = (stage_seconds or {}).get(name, stage['seconds'])
+    return stages
+
+
+def profile(timings):
+    '''
+    Groups the statements by their first line.
+    Returns (label, stage, calls, total seconds, max seconds, rows, bytes), slowest total first.
+    '''
+    groups = {}
+    for timing in timings:
+        key = (timing.label, timing.stage)
+        calls, total, longest, rows, loaded = groups.get(key, (0, 0.0, 0.0, 0, 0))
+        groups[key] = (calls + 1, total + timing.seconds, max(longest, timing.seconds),
+                       rows + max(timing.rows or 0, 0), loaded + (timing.bytes or 0))
+    return sorted(((label, stage) + values for (label, stage), values in groups.items()),
+                  key=lambda g: g[3], reverse=True)
+
+
+def print_profile(timings, limit=20):
+    '''
+    Prints the statements that took the longest, with their share of the time of the run
+    '''
+    ranked = profile(timings)
+    total = sum(g[3] for g in ranked) or 1
+    print("------------------------------------------------------")
+    print('{:>9} {:>6} {:>6} {:>7} {:>12} {:>10}  {:<10} {}'.format(
+        'seconds', 'share', 'calls', 'max', 'rows', 'MB', 'stage', 'statement'))
+    for label, stage, calls, seconds, longest, rows, loaded in ranked[:limit]:
+        print('{:>9.2f} {:>5.1f}% {:>6} {:>7.2f} {:>12} {:>10.1f}  {:<10} {}'.format(
+            seconds, seconds / total * 100, calls, longest, rows, loaded / 1024 / 1024, stage or '', label))
+    print("------------------------------------------------------")
+
+
+class MetricsEmitter:
+    '''
+    Sends the summaries of a run to a JSON lines file and/or a StatsD server
+    '''
+    def __init__(self, json_path=None, statsd_host=None, statsd_port=8125, prefix='dwh'):
+        self.json_path = json_path
+        self.statsd = (statsd_host, statsd_port) if statsd_host else None
+        self.prefix = prefix
+
+    def send_statsd(self, lines):
+        # StatsD is fire and forget over UDP, a missing server does not fail the run
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line.encode(), self.statsd)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+    def emit(self, run_id, job, timings, stage_seconds=None, started=None, status='success'):
+        '''
+        Emits one record per stage and one for the whole run. Returns the records.
+        '''
+        now = datetime.datetime.utcnow()
+        stages = summarize(timings, stage_seconds)
+        records = [dict(stage_metrics, run_id=run_id, job=job, stage=name)
+                   for name, stage_metrics in stages.items()]
+        run = {'run_id': run_id, 'job': job, 'stage': None, 'status': status,
+               'statements': sum(s['statements'] for s in stages.values()),
+               'seconds': sum(s['seconds'] for s in stages.values()),
+               'rows': sum(s['rows'] for s in stages.values()),
+               'bytes': sum(s['bytes'] for s in stages.values()),
+               'wall_seconds': time.time() - started if started else sum(s['wall_seconds'] for s in stages.values())}
+        records.append(run)
+        for record in records:
+            record['emitted_at'] = now.isoformat(timespec='seconds')
+            for key in ('seconds', 'wall_seconds'):
+                record[key] = round(record[key], 3)
+
+        if self.json_path:
+            with open(self.json_path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+        if self.statsd:
+            lines = []
+            for record in records:
+                name = '{}.{}.{}'.format(self.prefix, job, record['stage'] or 'run')
+                lines += ['{}.wall_seconds:{:.0f}|ms'.format(name, record['wall_seconds'] * 1000),
+                          '{}.statements:{}|c'.format(name, record['statements']),
+                          '{}.rows:{}|c'.format(name, record['rows']),
+                          '{}.bytes:{}|c'.format(name, record['bytes'])]
+            if status != 'success':
+                lines.append('{}.{}.failures:1|c'.format(self.prefix, job))
+            self.send_statsd(lines)
+        return records
+
+    def emit_gauges(self, run_id, job, gauges):
+        '''
+        Emits point-in-time values of a job, e.g. the freshness lag of the data it loaded,
+        as one record and StatsD gauges. Returns the record.
+        '''
+        record = dict(gauges, run_id=run_id, job=job, emitted_at=datetime.datetime.utcnow().isoformat(timespec='seconds'))
+        if self.json_path:
+            with open(self.json_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.statsd:
+            self.send_statsd(['{}.{}.{}:{}|g'.format(self.prefix, job, name, value) for name, value in gauges.items()])
+        return record
+
+
+def emitter_from_config(config):
+    '''
+    Creates the emitter of the [METRICS] section of dwh.cfg
+    '''
+    return MetricsEmitter(config.get('METRICS', 'json_path', fallback='').strip() or None,
+                          config.get('METRICS', 'statsd_host', fallback='').strip() or None,
+                          config.getint('METRICS', 'statsd_port', fallback=8125),
+                          config.get('METRICS', 'prefix', fallback='dwh').strip() or 'dwh')
@@ -0,0 +1,198 @@
+'''
+Schema migrations driven by the CREATE statements of sql_queries.py.
+
+The columns of the existing tables are read from the catalog and compared with the CREATE
+statements, and only the differences are applied, all in a single transaction:
+
+    missing table                          CREATE TABLE
+    new columns after the existing ones    ALTER TABLE ... ADD COLUMN
+    columns no longer defined              ALTER TABLE ... DROP COLUMN
+    changed type or column order           the table is rebuilt: created under a temporary name,
+                                           filled from the old one, which is dropped, and renamed
+
+A run against an up-to-date schema only reads the catalog. Keys, encodings and constraints
+are not compared. The old table is dropped with CASCADE when it is rebuilt, which also drops
+the foreign keys referencing it (they are informational in Redshift), and its IDENTITY
+columns are numbered again.
+
+    python create_tables.py --dry-run
+'''
+
+import re
+from sql_queries import select_catalog_columns
+
+# Canonical names of the types, as written in sql_queries.py or reported by the catalog
+TYPE_ALIASES = {'int': 'integer', 'int4': 'integer', 'int8': 'bigint', 'int2': 'smallint',
+                'float': 'double precision', 'float8': 'double precision', 'double': 'double precision',
+                'float4': 'real', 'bool': 'boolean', 'text': 'varchar(256)',
+                'timestamp without time zone': 'timestamp'}
+
+
+def split_top_level(text):
+    '''
+    Splits a column list on the commas that are not inside parentheses
+    '''
+    parts, depth, current = [], 0, ''
+    for char in text:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def normalize_type(data_type):
+    '''
+    Returns the canonical form of a type, e.g. DECIMAL(4,1) -> numeric(4,1)
+    '''
+    data_type = ' '.join(data_type.lower().replace(' (', '(').split())
+    match = re.match(r'([a-z ]+?)\s*(?:\((\d+)(?:,\s*(\d+))?\))?$', data_type)
+    base, size, scale = match.group(1), match.group(2), match.group(3)
+    if base in ('decimal', 'numeric'):
+        return 'numeric({},{})'.format(size or 18, scale or 0)
+    if base in ('varchar', 'character varying'):
+        return 'varchar({})'.format(size or 256)
+    if base in ('char', 'character', 'bpchar'):
+        return 'char({})'.format(size or 1)
+    return TYPE_ALIASES.get(base, base)
+
+
+def catalog_type(data_type, length, precision, scale):
+    '''
+    Returns the canonical form of a type read from information_schema.columns.
+    DuckDB reports its types in upper case, does not keep the length of a VARCHAR and stores a
+    CHAR as a VARCHAR.
+    '''
+    data_type = data_type.lower()
+    if data_type in ('character varying', 'varchar'):
+        return 'varchar({})'.format(length) if length else 'varchar'
+    if data_type == 'character':
+        return 'char({})'.format(length or 1)
+    if data_type == 'numeric':
+        return 'numeric({},{})'.format(precision or 18, scale or 0)
+    return normalize_type(data_type)
+
+
+def same_type(existing, desired):
+    '''
+    Tells whether a column of the catalog has the declared type, a VARCHAR without length has any length
+    '''
+    if existing == 'varchar':
+        return desired.startswith(('varchar(', 'char('))
+    return existing == desired
+
+
+def parse_columns(query):
+    '''
+    Returns the table name of a CREATE TABLE statement and its (column, type, definition) list
+    '''
+    table = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE).group(1)
+    body = query[query.index('(') + 1:query.rindex(')')]
+    columns = []
+    for part in split_top_level(body):
+        if re.match(r'(PRIMARY\s+KEY|FOREIGN\s+KEY|UNIQUE)\b', part, re.IGNORECASE):
+            continue
+        match = re.match(r'(\w+)\s+(DOUBLE\s+PRECISION|CHARACTER\s+VARYING(?:\s*\([\d\s]*\))?|\w+(?:\s*\([\d,\s]*\))?)',
+                         part, re.IGNORECASE)
+        columns.append((match.group(1).lower(), normalize_type(match.group(2)), match.group(2)))
+    return table.lower(), columns
+
+
+def read_catalog(cur):
+    '''
+    Returns the (column, type) list of every existing table
+    '''
+    cur.execute(select_catalog_columns)
+    catalog = {}
+    for table, column, data_type, length, precision, scale in cur.fetchall():
+        catalog.setdefault(table, []).append((column, catalog_type(data_type, length, precision, scale)))
+    return catalog
+
+
+def rebuild_statements(query, table, desired, existing):
+    '''
+    Recreates a table from its CREATE statement and copies the common columns over
+    '''
+    temporary = '{}__migrating'.format(table)
+    create = re.sub(r'(CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?)' + table + r'\b',
+                    r'\g<1>' + temporary, query, count=1, flags=re.IGNORECASE)
+    # IDENTITY columns cannot be inserted into, they are numbered again
+    identity = {name.lower() for name in re.findall(r'(\w+)\s+\w+\s+IDENTITY\b', query, re.IGNORECASE)}
+    common = ', '.join(name for name, _, _ in desired if name in dict(existing) and name not in identity)
+    statements = [create]
+    if common:
+        statements.append('INSERT INTO {} ({}) SELECT {} FROM {}'.format(temporary, common, common, table))
+    return statements + ['DROP TABLE {} CASCADE'.format(table),
+                         'ALTER TABLE {} RENAME TO {}'.format(temporary, table)]
+
+
+def plan(cur, create_queries):
+    '''
+    Compares the catalog with the CREATE statements.
+    Returns the changes as (description, statements), in the order of the CREATE statements.
+    '''
+    catalog = read_catalog(cur)
+    changes = []
+    for query in create_queries:
+        table, desired = parse_columns(query)
+        existing = catalog.get(table)
+        if existing is None:
+            changes.append(('create {}'.format(table), [query]))
+            continue
+        existing_types = dict(existing)
+        desired_names = [name for name, _, _ in desired]
+        kept = [name for name, _ in existing if name in desired_names]
+        changed = [name for name, data_type, _ in desired
+                   if name in existing_types and not same_type(existing_types[name], data_type)]
+        if changed or kept != desired_names[:len(kept)]:
+            # Columns are positional for COPY, so a column inserted in the middle also needs a rebuild
+            reason = 'type of {} changed'.format(', '.join(changed)) if changed else 'columns reordered'
+            changes.append(('rebuild {} ({})'.format(table, reason),
+                            rebuild_statements(query, table, desired, existing)))
+            continue
+        for name, _ in existing:
+            if name not in desired_names:
+                changes.append(('drop column {}.{}'.format(table, name),
+                                ['ALTER TABLE {} DROP COLUMN {}'.format(table, name)]))
+        for name, _, declared in desired[len(kept):]:
+            changes.append(('add column {}.{} {}'.format(table, name, declared),
+                            ['ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, declared)]))
+    return changes
+
+
+def apply(cur, changes):
+    '''
+    Runs the statements of the planned changes on the cursor, without committing
+    '''
+    for description, statements in changes:
+        print('Migrating: {}'.format(description))
+        for statement in statements:
+            cur.execute(statement)
+
+
+def migrate(cur, conn, create_queries, dry_run=False):
+    '''
+    Brings the schema in line with the CREATE statements in a single transaction.
+    Returns the applied (or, with dry_run, planned) changes.
+    '''
+    try:
+        changes = plan(cur, create_queries)
+        if dry_run:
+            for description, statements in changes:
+                print('Would migrate: {}'.format(description))
+                for statement in statements:
+                    print('    {}'.format(' '.join(statement.split())))
+            conn.rollback()
+        else:
+            apply(cur, changes)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if not changes:
+        print('Schema is up to date')
+    return changes
@@ -0,0 +1,319 @@
+'''
+Normalizes the raw source files into typed, load-ready files.
+
+The raw files are streamed in chunks of records which are cleaned in a pool of processes:
+currency symbols are stripped, dates are parsed, county and city names are normalized and
+every value is cast once. The output (gzip CSV without header, or Parquet with pyarrow)
+matches the *_typed staging tables of sql_queries.py, so the final tables can be loaded
+with plain projections.
+
+    python normalize.py liquor_sales Iowa_Liquor_Sales.csv normalized/ --workers 4
+    python normalize.py temperature city_temperature.json normalized/
+'''
+
+import argparse
+import csv
+import datetime
+import decimal
+import gzip
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from split_files import open_part, read_records, peak_memory_mb
+
+# Output columns of each source and their types, in the order of the typed staging tables
+SCHEMAS = {
+    'liquor_sales': [
+        ('invoice_num', 'text'), ('date', 'date'), ('store_num', 'int'), ('store_name', 'text'),
+        ('address', 'text'), ('city', 'text'), ('zip', 'text'), ('store_location', 'text'),
+        ('county_num', 'int'), ('county_name', 'text'), ('category', 'text'), ('category_name', 'text'),
+        ('vendor_num', 'int'), ('vendor_name', 'text'), ('item_num', 'int'), ('item_name', 'text'),
+        ('pack', 'int'), ('bottle_volume', 'int'), ('state_bottle_cost', 'decimal'),
+        ('state_bottle_retail', 'decimal'), ('bottle_sold', 'int'), ('sale', 'decimal'),
+        ('volume_sold_ltr', 'decimal'), ('volume_sold_gal', 'decimal')],
+    'temperature': [
+        ('region', 'text'), ('country', 'text'), ('state', 'text'), ('city', 'text'),
+        ('date', 'date'), ('temperature', 'decimal')],
+    'census': [
+        ('county_id', 'int'), ('state', 'text'), ('county', 'text'), ('total_pop', 'int'), ('men', 'int'),
+        ('women', 'int'), ('hispanic', 'decimal'), ('white', 'decimal'), ('black', 'decimal'),
+        ('native', 'decimal'), ('asian', 'decimal'), ('pacific', 'decimal'), ('voting_age_citizen', 'int'),
+        ('income', 'int'), ('income_err', 'int'), ('income_per_cap', 'int'), ('income_per_cap_err', 'int')] + [
+        (name, 'decimal') for name in (
+            'poverty', 'child_poverty', 'professional', 'service', 'office', 'construction', 'production',
+            'drive', 'carpool', 'transit', 'walk', 'other_transp', 'work_at_home', 'mean_commute')] + [
+        ('employed', 'int')] + [
+        (name, 'decimal') for name in (
+            'private_work', 'public_work', 'self_employed', 'family_work', 'unemployment')],
+    'crime': [
+        ('county_name', 'text'), ('state', 'text'), ('crime_rate_per_100000', 'decimal')] + [
+        (name, 'int') for name in (
+            'index_1', 'edition', 'part', 'idno', 'cpoparst', 'cpopcrim', 'ag_arrst', 'ag_off')] + [
+        ('covind', 'decimal')] + [
+        (name, 'int') for name in (
+            'index_2', 'modindx', 'murder', 'rape', 'robbery', 'agasslt', 'burglry', 'larceny',
+            'mvtheft', 'arson', 'population', 'fips_st', 'fips_cty')] + [
+        ('county_fips', 'int')],
+}
+
+# Staging table loaded from the output of each source
+TYPED_TABLES = {
+    'liquor_sales': 'staging_liquor_sales_typed',
+    'temperature': 'staging_temperature_typed',
+    'census': 'staging_census_typed',
+    'crime': 'staging_crime_typed',
+}
+
+COUNTY_SUFFIXES = (' county', ' parish', ' borough')
+
+
+def parse_int(value):
+    value = value.strip().replace(',', '')
+    return int(float(value)) if value else None
+
+
+def parse_decimal(value):
+    value = value.strip().replace('$', '').replace(',', '')
+    return decimal.Decimal(value) if value else None
+
+
+def parse_date(value):
+    '''
+    Parses the MM/DD/YYYY dates of the sales file and ISO dates
+    '''
+    value = value.strip()
+    if not value:
+        return None
+    if '/' in value:
+        month, day, year = value.split('/')
+        return datetime.date(int(year), int(month), int(day))
+    return datetime.date.fromisoformat(value[:10])
+
+
+def normalize_county(name):
+    '''
+    Normalizes a county name so that the sources agree: 'POLK', 'Polk County' and
+    'Polk County, IA' all become 'Polk'
+    '''
+    name = name.split(',')[0].strip()
+    for suffix in COUNTY_SUFFIXES:
+        if name.lower().endswith(suffix):
+            name = name[:-len(suffix)]
+    return name.strip().title() if name.strip() else None
+
+
+def normalize_name(name):
+    '''
+    Normalizes the case and spacing of a city or store name
+    '''
+    name = ' '.join(name.split())
+    return name.title() if name else None
+
+
+CASTS = {'int': parse_int, 'decimal': parse_decimal, 'date': parse_date, 'text': lambda v: v.strip() or None}
+
+
+def cast_row(values, schema):
+    return tuple(CASTS[kind](value) for value, (_, kind) in zip(values, schema))
+
+
+def transform_liquor_sales(values):
+    row = list(cast_row(values, SCHEMAS['liquor_sales']))
+    row[5] = normalize_name(values[5])            # city
+    row[9] = normalize_county(values[9])          # county_name
+    return tuple(row)
+
+
+def transform_temperature(record):
+    record = {key.lower(): str(value) for key, value in record.items()}
+    month, day, year = int(float(record['month'])), int(float(record['day'])), int(float(record['year']))
+    temperature = parse_decimal(record.get('temperature', record.get('avgtemperature', '')))
+    if temperature is not None and temperature <= -99:
+        # -99 marks a missing measure in the source
+        temperature = None
+    return (record.get('region') or None, record.get('country') or None, record.get('state') or None,
+            normalize_name(record.get('city', '')), datetime.date(year, month, day), temperature)
+
+
+def transform_census(values):
+    row = list(cast_row(values, SCHEMAS['census']))
+    row[2] = normalize_county(values[2])
+    return tuple(row)
+
+
+def transform_crime(values):
+    # county_name is 'Adair County, IA': the state is split into its own column
+    county, _, state = values[0].rpartition(', ')
+    casts = cast_row([''] * 2 + values[1:], SCHEMAS['crime'])
+    # The 5-digit FIPS code of the county, the key county_id of the census
+    fips_st, fips_cty = casts[-2:]
+    county_fips = fips_st * 1000 + fips_cty if fips_st is not None and fips_cty is not None else None
+    return (normalize_county(county or values[0]), state.strip() or None) + casts[2:] + (county_fips,)
+
+
+TRANSFORMS = {
+    'liquor_sales': transform_liquor_sales,
+    'temperature': transform_temperature,
+    'census': transform_census,
+    'crime': transform_crime,
+}
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+def transform_chunk(source, records, output_format):
+    '''
+    Cleans a chunk of raw records in a worker process.
+    Returns the CSV bytes (or the rows for Parquet), the number of rows and of rejected records.
+    '''
+    transform = TRANSFORMS[source]
+    rows, rejected = [], 0
+    if source == 'temperature':
+        parsed = (json.loads(line) for line in records if line.strip())
+    else:
+        parsed = csv.reader(io.StringIO(b''.join(records).decode('utf-8', errors='replace')))
+    for values in parsed:
+        try:
+            rows.append(transform(values))
+        except (ValueError, IndexError, KeyError, decimal.InvalidOperation):
+            rejected += 1
+    if output_format == 'parquet':
+        return rows, len(rows), rejected
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    for row in rows:
+        writer.writerow([format_value(v) for v in row])
+    return out.getvalue().encode(), len(rows), rejected
+
+
+def chunks(stream, source, chunk_size, header):
+    '''
+    Groups the raw records of the input into lists of chunk_size records
+    '''
+    reader = read_records(stream, csv_quoting=source != 'temperature')
+    if header:
+        next(reader, None)
+    chunk = []
+    for record in reader:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ParquetPart:
+    '''
+    Writes typed rows to one Parquet file, one row group per chunk
+    '''
+    def __init__(self, path, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {'int': pa.int64(), 'decimal': pa.decimal128(12, 2), 'date': pa.date32(), 'text': pa.string()}
+        self.pa = pa
+        self.schema = pa.schema([(name, types[kind]) for name, kind in schema])
+        self.writer = pq.ParquetWriter(path, self.schema, compression='snappy')
+
+    def write(self, rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in self.schema]
+        arrays = []
+        for values, field in zip(columns, self.schema):
+            if self.pa.types.is_decimal(field.type):
+                values = [v.quantize(decimal.Decimal('0.01')) if v is not None else None for v in values]
+            arrays.append(self.pa.array(values, type=field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def normalize(source, input_path, output_dir, parts=4, workers=None, chunk_size=50000,
+              output_format='csv', header=True):
+    '''
+    Streams the input through the worker pool and writes the typed parts.
+    At most two chunks per worker are in flight, which bounds the memory use.
+    Returns the number of rows written and of records rejected.
+    '''
+    table_dir = os.path.join(output_dir, TYPED_TABLES[source])
+    os.makedirs(table_dir, exist_ok=True)
+    # The whole directory is loaded, so the parts of a previous run are removed first
+    for name in os.listdir(table_dir):
+        if name.startswith('part-'):
+            os.remove(os.path.join(table_dir, name))
+    extension = '.parquet' if output_format == 'parquet' else '.csv.gz'
+    paths = [os.path.join(table_dir, 'part-{:04d}{}'.format(i, extension)) for i in range(parts)]
+    # A part is opened by its first chunk: an empty file would fail the COPY of the DuckDB backend
+    writers = [None] * parts
+
+    def writer(part):
+        if writers[part] is None:
+            if output_format == 'parquet':
+                writers[part] = ParquetPart(paths[part], SCHEMAS[source])
+            else:
+                writers[part] = open_part(paths[part], 'gzip', 6)
+        return writers[part]
+
+    rows, rejected, written = 0, 0, 0
+    stream = gzip.open(input_path, 'rb') if input_path.endswith('.gz') else open(input_path, 'rb')
+    try:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight = set()
+            max_in_flight = 2 * workers
+            source_chunks = chunks(stream, source, chunk_size, header and source != 'temperature')
+            while True:
+                for chunk in source_chunks:
+                    in_flight.add(executor.submit(transform_chunk, source, chunk, output_format))
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    data, chunk_rows, chunk_rejected = future.result()
+                    if chunk_rows:
+                        writer(written % parts).write(data)
+                        written += 1
+                    rows += chunk_rows
+                    rejected += chunk_rejected
+    finally:
+        stream.close()
+        for part in writers:
+            if part is not None:
+                part.close()
+    return rows, rejected
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Normalize a raw source file into typed, load-ready files')
+    parser.add_argument('source', choices=sorted(SCHEMAS), help='kind of source file')
+    parser.add_argument('input', help='raw source file (.csv or .json, optionally .gz)')
+    parser.add_argument('output_dir', help='directory receiving one sub-directory per typed staging table')
+    parser.add_argument('--parts', type=int, default=4, help='number of output files, e.g. the slice count')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the CPU count')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='records per chunk')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--no-header', action='store_true', help='the input has no header line')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows, rejected = normalize(args.source, args.input, args.output_dir, args.parts, args.workers,
+                               args.chunk_size, args.format, not args.no_header)
+    elapsed = time.perf_counter() - start
+    print('{} row(s) written to {} ({} rejected) in {:.1f}s, {:.0f} rows/s, peak memory {:.1f} MB'.format(
+        rows, os.path.join(args.output_dir, TYPED_TABLES[args.source]), rejected, elapsed,
+        rows / elapsed if elapsed else 0, peak_memory_mb()))
+
+
+if __name__ == "__main__":
+    main()
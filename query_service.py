@@ -0,0 +1,296 @@
+'''
+Read API for the dashboards, with a result cache in front of the warehouse.
+
+Serves the common star-schema aggregates as JSON over HTTP. The queries run on a pool of
+connections, and their results are cached with a TTL and LRU eviction. The service polls the
+table_versions control table, which every load stamps, and drops the cached results that
+depend on a table as soon as the table has been reloaded by etl.py or the DAG.
+
+    python query_service.py --port 8080
+    curl 'localhost:8080/sales/county?start=2017-01-01&end=2017-01-31'
+
+The queries are plain SQL, so the service also runs against a local Postgres holding the
+same tables (set dsn in the [API] section of dwh.cfg).
+'''
+
+import argparse
+import asyncio
+import configparser
+import datetime
+import decimal
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+import connections
+
+# Endpoint: (query, parameters with their defaults, tables the result depends on)
+ENDPOINTS = {
+    '/sales/county': ("""
+        SELECT   county, SUM(sold_count) AS sold_count, SUM(volume_sold) AS volume_sold, SUM(sales) AS sales
+        FROM     daily_store_item_sales
+        WHERE    date BETWEEN %(start)s AND %(end)s
+        GROUP BY county
+        ORDER BY sales DESC
+    """, {'start': '2012-01-01', 'end': '2017-12-31'}, ['daily_store_item_sales']),
+
+    '/sales/date': ("""
+        SELECT   date, SUM(sold_count) AS sold_count, SUM(volume_sold) AS volume_sold, SUM(sales) AS sales
+        FROM     daily_store_item_sales
+        WHERE    date BETWEEN %(start)s AND %(end)s
+        GROUP BY date
+        ORDER BY date
+    """, {'start': '2017-01-01', 'end': '2017-12-31'}, ['daily_store_item_sales']),
+
+    '/sales/item': ("""
+        SELECT   d.item_id, i.item_name, i.brand_name, SUM(d.sold_count) AS sold_count,
+                 SUM(d.volume_sold) AS volume_sold, SUM(d.sales) AS sales
+        FROM     daily_store_item_sales d
+        JOIN     item_dim i ON d.item_id = i.item_id
+        WHERE    d.date BETWEEN %(start)s AND %(end)s
+        GROUP BY d.item_id, i.item_name, i.brand_name
+        ORDER BY sales DESC
+        LIMIT    %(limit)s
+    """, {'start': '2017-01-01', 'end': '2017-12-31', 'limit': 50}, ['daily_store_item_sales', 'item_dim']),
+
+    '/consumption/per_capita': ("""
+        SELECT   m.county, c.total_pop, SUM(m.volume_sold) AS volume_sold,
+                 SUM(m.volume_sold)::DECIMAL(18,4) / NULLIF(c.total_pop, 0) AS volume_per_capita,
+                 SUM(m.sales)::DECIMAL(18,4) / NULLIF(c.total_pop, 0) AS sales_per_capita,
+                 c.income_per_cap, c.unemployment
+        FROM     monthly_county_sales m
+        JOIN     county_census_dim c ON m.county = c.county
+        WHERE    m.year = %(year)s
+        GROUP BY m.county, c.total_pop, c.income_per_cap, c.unemployment
+        ORDER BY volume_per_capita DESC
+    """, {'year': 2017}, ['monthly_county_sales', 'county_census_dim']),
+}
+
+select_table_versions = "SELECT table_name, loaded_at FROM table_versions"
+
+
+class BadRequest(Exception):
+    '''
+    A request the service cannot answer, reported as a 400
+    '''
+
+
+class ResultCache:
+    '''
+    A TTL + LRU cache of query results, indexed by the tables they depend on
+    '''
+    def __init__(self, max_entries=1024, ttl=300):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, tables):
+        self.entries[key] = (value, time.monotonic() + self.ttl, set(tables))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        '''
+        Drops every result depending on one of the tables. Returns the number dropped.
+        '''
+        stale = [key for key, (_, _, depends) in self.entries.items() if depends & tables]
+        for key in stale:
+            del self.entries[key]
+        return len(stale)
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def percentile(values, fraction):
+    '''
+    Returns the value below which the given fraction of the values fall
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def to_json(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+
+class QueryService:
+    '''
+    Runs the endpoint queries on pooled connections and caches their results
+    '''
+    def __init__(self, pool, pool_size=8, cache=None, poll_interval=10):
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.cache = cache or ResultCache()
+        self.poll_interval = poll_interval
+        self.versions = {}
+        # Times the results of each table were invalidated, see fetch
+        self.generations = {}
+        self.in_flight = {}
+        self.latencies = deque(maxlen=10000)
+
+    def run_query(self, query, params):
+        '''
+        Runs a query on a pooled connection (in a worker thread)
+        '''
+        return self.pool.fetch(query, params, as_dicts=True)
+
+    async def fetch(self, path, params):
+        '''
+        Returns the result of an endpoint, from the cache when possible
+        '''
+        query, defaults, tables = ENDPOINTS[path]
+        # Parameters are cast to the type of their default, which also keeps the cache keys canonical
+        values = {}
+        for name, default in defaults.items():
+            try:
+                values[name] = type(default)(params[name]) if name in params else default
+            except ValueError:
+                raise BadRequest('{} must be of type {}, not {!r}'.format(name, type(default).__name__, params[name]))
+        key = (path, tuple(sorted(values.items())))
+        rows = self.cache.get(key)
+        if rows is not None:
+            return rows
+        # Concurrent misses on the same key share a single query
+        if key not in self.in_flight:
+            loop = asyncio.get_running_loop()
+            self.in_flight[key] = (loop.run_in_executor(self.executor, self.run_query, query, values),
+                                   self.generation(tables))
+        try:
+            rows = await asyncio.shield(self.in_flight[key][0])
+        finally:
+            started = self.in_flight.pop(key, None)
+        # A table reloaded while the query ran may have been read before its reload
+        if started is not None and started[1] == self.generation(tables):
+            self.cache.put(key, rows, tables)
+        return rows
+
+    def generation(self, tables):
+        return tuple(self.generations.get(table, 0) for table in tables)
+
+    async def poll_versions(self):
+        '''
+        Invalidates the cached results of the tables reloaded since the last poll
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                rows = await loop.run_in_executor(self.executor, self.run_query, select_table_versions, None)
+                versions = {row['table_name']: row['loaded_at'] for row in rows}
+                changed = {table for table, loaded_at in versions.items()
+                           if self.versions and self.versions.get(table) != loaded_at}
+                if changed:
+                    for table in changed:
+                        self.generations[table] = self.generations.get(table, 0) + 1
+                    dropped = self.cache.invalidate(changed)
+                    print('Reloaded {}: {} cached result(s) dropped'.format(', '.join(sorted(changed)), dropped))
+                self.versions = versions
+            except Exception as error:
+                print('Polling table_versions failed: {}'.format(error))
+            await asyncio.sleep(self.poll_interval)
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {'requests': len(latencies),
+                'cache_entries': len(self.cache.entries),
+                'hit_ratio': round(self.cache.hit_ratio(), 4),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 2)}
+
+    async def handle(self, reader, writer):
+        '''
+        Serves one HTTP/1.1 GET request
+        '''
+        start = time.perf_counter()
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                status, body = 405, {'error': 'only GET is supported'}
+            else:
+                url = urlsplit(request_line[1])
+                if url.path == '/stats':
+                    status, body = 200, self.stats()
+                elif url.path in ENDPOINTS:
+                    status, body = 200, await self.fetch(url.path, dict(parse_qsl(url.query)))
+                    self.latencies.append(time.perf_counter() - start)
+                else:
+                    status, body = 404, {'error': 'unknown endpoint', 'endpoints': sorted(ENDPOINTS)}
+        except BadRequest as error:
+            status, body = 400, {'error': str(error)}
+        except Exception as error:
+            status, body = 500, {'error': str(error)}
+        payload = json.dumps(body, default=to_json).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, 'OK' if status == 200 else 'Error',
+                                                         len(payload)).encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        poller = asyncio.ensure_future(self.poll_versions())
+        print('Serving {} on http://{}:{}'.format(', '.join(sorted(ENDPOINTS)), host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            poller.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.pool.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Serve the star-schema aggregates over HTTP with a result cache')
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    # The [API] dsn points the service at a local Postgres stand-in instead of the cluster
+    dsn = config.get('API', 'dsn', fallback='').strip() or connections.cluster_dsn(config)
+    pool_size = config.getint('API', 'pool_size', fallback=8)
+    cache = ResultCache(config.getint('API', 'cache_size', fallback=1024),
+                        config.getint('API', 'cache_ttl', fallback=300))
+    service = QueryService(connections.pool_from_config(config, pool_size, dsn), pool_size, cache,
+                           config.getint('API', 'poll_interval', fallback=10))
+    host = args.host or config.get('API', 'host', fallback='127.0.0.1')
+    port = args.port or config.getint('API', 'port', fallback=8080)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(service.stats()))
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
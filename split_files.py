@@ -0,0 +1,240 @@
+'''
+Splits a source file into compressed parts for a parallel COPY and writes the COPY manifest.
+
+COPY loads one file per slice at a time, so a single large CSV is read by one slice only.
+The input is streamed record by record and dealt round-robin to the parts, which keeps
+the memory use constant whatever the size of the input.
+
+    python split_files.py Iowa_Liquor_Sales.csv out/ --slices 4 \
+        --url-prefix s3://mybucket/liquor_sales/ --compression gzip --benchmark
+
+With --by-date the records are written instead to one CSV per day of sales, under the
+year=YYYY/month=MM/day=DD/ prefixes loaded by the daily runs of the Airflow DAG:
+
+    python split_files.py Iowa_Liquor_Sales.csv out/ --by-date
+    aws s3 sync out/ s3://mybucket/liquor_sales/
+'''
+
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import math
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+def open_part(path, compression, level):
+    '''
+    Opens a binary writer for one part with the requested compression
+    '''
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=level)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit('zstd compression requires the zstandard package (pip install zstandard)')
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+def read_records(stream, csv_quoting=True):
+    '''
+    Yields complete records from a binary stream.
+    A CSV record may span several lines when a quoted field holds a newline
+    (e.g. store_location), so lines are joined until the quotes are balanced.
+    '''
+    pending = []
+    quotes = 0
+    for line in stream:
+        if not csv_quoting:
+            yield line
+            continue
+        pending.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield b''.join(pending)
+            pending, quotes = [], 0
+    if pending:
+        yield b''.join(pending)
+
+
+def number_of_parts(input_size, slices, part_size_mb):
+    '''
+    Returns the number of parts: a multiple of the slice count such that each
+    uncompressed part is at most part_size_mb
+    '''
+    if not input_size or not part_size_mb:
+        return slices
+    multiple = math.ceil(input_size / (slices * part_size_mb * 1024 * 1024))
+    return slices * max(1, multiple)
+
+
+def split_file(input_path, output_dir, parts, compression='gzip', level=6, header=True, csv_quoting=True):
+    '''
+    Deals the records of the input round-robin into `parts` compressed files.
+    The header line is dropped so the parts can be loaded without ignoreheader.
+    Returns the written paths and the number of records.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.basename(input_path)
+    if input_path == '-':
+        base = 'stdin'
+    stem = base.split('.')[0]
+    suffix = '.' + base.split('.', 1)[1] if '.' in base else ''
+    suffix = suffix.replace('.gz', '')
+    paths = [os.path.join(output_dir, '{}.part{:04d}{}{}'.format(stem, i, suffix, COMPRESSIONS[compression]))
+             for i in range(parts)]
+    writers = [open_part(path, compression, level) for path in paths]
+
+    stream = sys.stdin.buffer if input_path == '-' else open(input_path, 'rb')
+    if input_path.endswith('.gz'):
+        stream = gzip.open(stream, 'rb')
+    records = 0
+    try:
+        reader = read_records(stream, csv_quoting)
+        if header:
+            next(reader, None)
+        for records, record in enumerate(reader, 1):
+            if not record.endswith(b'\n'):
+                record += b'\n'
+            writers[records % parts].write(record)
+    finally:
+        for writer in writers:
+            writer.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    return paths, records
+
+
+def partition_path(output_dir, stem, day):
+    '''
+    Returns the path of the file of one day under its year=/month=/day= prefix
+    '''
+    return os.path.join(output_dir, 'year={:%Y}'.format(day), 'month={:%m}'.format(day),
+                        'day={:%d}'.format(day), stem + '.csv')
+
+
+def split_by_date(input_path, output_dir, date_column=1, date_format='%m/%d/%Y', max_open=64):
+    '''
+    Writes the records of the input to one CSV per day, each starting with the header line.
+    Only max_open files are kept open, the others are reopened for appending.
+    Returns the written paths and the number of records.
+    '''
+    stem = 'stdin' if input_path == '-' else os.path.basename(input_path).split('.')[0]
+    stream = sys.stdin.buffer if input_path == '-' else open(input_path, 'rb')
+    if input_path.endswith('.gz'):
+        stream = gzip.open(stream, 'rb')
+    writers, paths, records = OrderedDict(), set(), 0
+    try:
+        reader = read_records(stream)
+        header = next(reader, b'')
+        for records, record in enumerate(reader, 1):
+            if not record.endswith(b'\n'):
+                record += b'\n'
+            field = next(csv.reader([record.decode('utf-8', 'replace')]))[date_column]
+            path = partition_path(output_dir, stem, datetime.datetime.strptime(field, date_format))
+            writer = writers.pop(path, None)
+            if writer is None:
+                if len(writers) >= max_open:
+                    writers.popitem(last=False)[1].close()
+                if path not in paths:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    writer = open(path, 'wb')
+                    writer.write(header)
+                    paths.add(path)
+                else:
+                    writer = open(path, 'ab')
+            writers[path] = writer
+            writer.write(record)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    return sorted(paths), records
+
+
+def write_manifest(paths, url_prefix, manifest_path):
+    '''
+    Writes a COPY manifest listing every part as mandatory
+    '''
+    url_prefix = url_prefix.rstrip('/') + '/'
+    entries = [{'url': url_prefix + os.path.basename(path),
+                'mandatory': True,
+                'meta': {'content_length': os.path.getsize(path)}}
+               for path in paths]
+    with open(manifest_path, 'w') as f:
+        json.dump({'entries': entries}, f, indent=2)
+    return manifest_path
+
+
+def peak_memory_mb():
+    '''
+    Returns the peak resident memory of this process in MB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Split a source file into compressed parts for a parallel COPY')
+    parser.add_argument('input', help="source file (.csv, .json, optionally .gz) or '-' for stdin")
+    parser.add_argument('output_dir', help='directory receiving the parts and the manifest')
+    parser.add_argument('--slices', type=int, default=4, help='number of slices of the cluster')
+    parser.add_argument('--part-size-mb', type=float, default=256,
+                        help='upper bound of the uncompressed size of a part')
+    parser.add_argument('--compression', choices=sorted(COMPRESSIONS), default='gzip')
+    parser.add_argument('--level', type=int, default=6, help='compression level')
+    parser.add_argument('--no-header', action='store_true', help='the input has no header line')
+    parser.add_argument('--url-prefix', default='s3://bucket/prefix/',
+                        help='S3 prefix the parts will be uploaded to, used in the manifest')
+    parser.add_argument('--by-date', action='store_true',
+                        help='write one CSV per day under year=/month=/day= prefixes instead of parts')
+    parser.add_argument('--date-column', type=int, default=1, help='position of the date field, with --by-date')
+    parser.add_argument('--benchmark', action='store_true', help='print throughput and peak memory')
+    args = parser.parse_args()
+
+    if args.by_date:
+        start = time.perf_counter()
+        paths, records = split_by_date(args.input, args.output_dir, args.date_column)
+        print('{} record(s) written to {} daily partition(s) in {:.2f}s'.format(
+            records, len(paths), time.perf_counter() - start))
+        return
+
+    input_size = os.path.getsize(args.input) if args.input != '-' else 0
+    parts = number_of_parts(input_size, args.slices, args.part_size_mb)
+    # JSON sources hold one object per line, so they are split on lines only
+    csv_quoting = not args.input.replace('.gz', '').endswith('.json')
+
+    start = time.perf_counter()
+    paths, records = split_file(args.input, args.output_dir, parts, args.compression, args.level,
+                                header=not args.no_header and csv_quoting, csv_quoting=csv_quoting)
+    elapsed = time.perf_counter() - start
+    stem = os.path.basename(paths[0]).split('.part')[0]
+    manifest = write_manifest(paths, args.url_prefix, os.path.join(args.output_dir, stem + '.manifest'))
+
+    print('{} record(s) split into {} part(s), manifest written to {}'.format(records, parts, manifest))
+    if args.benchmark:
+        output_size = sum(os.path.getsize(path) for path in paths)
+        print("------------------------------------------------------")
+        print('elapsed            {:>10.2f} s'.format(elapsed))
+        print('records/s          {:>10.0f}'.format(records / elapsed if elapsed else 0))
+        if input_size:
+            print('input MB/s         {:>10.1f}'.format(input_size / elapsed / 1024 / 1024 if elapsed else 0))
+            print('compression ratio  {:>10.2f}'.format(input_size / output_size if output_size else 0))
+        print('peak memory MB     {:>10.1f}'.format(peak_memory_mb()))
+        print("------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+'''
+Nearest weather city of every store.
+
+The temperature data only names its cities, so their coordinates are kept here and loaded into
+weather_city_dim, whose keys temperature_dim takes from the city name. The coordinates of the
+stores are parsed from store_location by the store_dim merge. The stores are then matched in bulk
+with the cities that have temperatures: the cities are bucketed in a grid of square cells and the
+cells around each store are searched ring by ring, so a store only measures its distance to the
+nearby cities. The nearest city is stored in store_dim, and only the stores whose city changed
+are updated, so a run with no new stores or cities writes nothing.
+This file is shared by etl.py and the Airflow DAG.
+
+The temperatures of a sale are then joined on integer keys:
+
+    SELECT f.date, f.sales, t.temperature
+    FROM   sales_fact f
+    JOIN   store_dim s       ON s.store_id = f.store_id
+    JOIN   temperature_dim t ON t.weather_city_id = s.weather_city_id AND t.date = f.date
+'''
+
+import math
+from sql_queries import (select_weather_cities, weather_city_insert, select_measured_weather_cities,
+                         select_store_locations, staging_store_weather_clear, staging_store_weather_insert,
+                         store_dim_weather_update)
+
+# (city, state) of the temperature data and their latitude and longitude
+COORDINATES = {
+    ('Ames', 'Iowa'): (42.0308, -93.6319),
+    ('Ankeny', 'Iowa'): (41.7318, -93.6001),
+    ('Bettendorf', 'Iowa'): (41.5245, -90.5157),
+    ('Burlington', 'Iowa'): (40.8075, -91.1129),
+    ('Cedar Falls', 'Iowa'): (42.5349, -92.4453),
+    ('Cedar Rapids', 'Iowa'): (41.9779, -91.6656),
+    ('Clinton', 'Iowa'): (41.8445, -90.1887),
+    ('Council Bluffs', 'Iowa'): (41.2619, -95.8608),
+    ('Davenport', 'Iowa'): (41.5236, -90.5776),
+    ('Des Moines', 'Iowa'): (41.5868, -93.6250),
+    ('Dubuque', 'Iowa'): (42.5006, -90.6646),
+    ('Fort Dodge', 'Iowa'): (42.4975, -94.1680),
+    ('Iowa City', 'Iowa'): (41.6611, -91.5302),
+    ('Marion', 'Iowa'): (42.0342, -91.5977),
+    ('Marshalltown', 'Iowa'): (42.0494, -92.9080),
+    ('Mason City', 'Iowa'): (43.1536, -93.2010),
+    ('Ottumwa', 'Iowa'): (41.0200, -92.4116),
+    ('Sioux City', 'Iowa'): (42.4963, -96.4049),
+    ('Spencer', 'Iowa'): (43.1414, -95.1444),
+    ('Urbandale', 'Iowa'): (41.6267, -93.7122),
+    ('Waterloo', 'Iowa'): (42.4928, -92.3426),
+    ('West Des Moines', 'Iowa'): (41.5772, -93.7113),
+}
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Side of the cells of the grid
+CELL_KM = 50.0
+
+# Rows inserted by one multi-row INSERT
+BATCH_SIZE = 1000
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    '''
+    Great-circle distance between two points, with the haversine formula
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class GridIndex:
+    '''
+    Points bucketed in square cells of cell_km, on a plane projected around their mean latitude.
+    The cells only prune the search, the points found are ranked by their great-circle distance.
+    '''
+    # Over the extent of a state, the projected distances are within a few percent of the true ones
+    PROJECTION_ERROR = 0.05
+
+    def __init__(self, points, cell_km=CELL_KM):
+        # points: (key, latitude, longitude)
+        self.cell_km = cell_km
+        self.scale = math.cos(math.radians(sum(lat for _, lat, _ in points) / len(points))) if points else 1.0
+        self.cells = {}
+        for key, lat, lon in points:
+            self.cells.setdefault(self.cell(lat, lon), []).append((key, lat, lon))
+        rows = [row for row, _ in self.cells] or [0]
+        columns = [column for _, column in self.cells] or [0]
+        self.bounds = (min(rows), max(rows), min(columns), max(columns))
+
+    def cell(self, lat, lon):
+        return (math.floor(lat * KM_PER_DEGREE / self.cell_km),
+                math.floor(lon * KM_PER_DEGREE * self.scale / self.cell_km))
+
+    def ring(self, row, column, radius):
+        '''
+        Yields the cells at a Chebyshev distance of radius from a cell
+        '''
+        for r in range(row - radius, row + radius + 1):
+            for c in range(column - radius, column + radius + 1):
+                if max(abs(r - row), abs(c - column)) == radius:
+                    yield r, c
+
+    def nearest(self, lat, lon):
+        '''
+        Returns the key of the nearest point and its distance in km, or None when there are no points
+        '''
+        row, column = self.cell(lat, lon)
+        min_row, max_row, min_column, max_column = self.bounds
+        last_ring = max(abs(row - min_row), abs(row - max_row), abs(column - min_column), abs(column - max_column))
+        best = None
+        for radius in range(last_ring + 1):
+            for cell in self.ring(row, column, radius):
+                for key, point_lat, point_lon in self.cells.get(cell, []):
+                    distance = distance_km(lat, lon, point_lat, point_lon)
+                    if best is None or distance < best[1]:
+                        best = (key, distance)
+            # The points of the next rings are at least radius cells away on the plane
+            if best and best[1] <= radius * self.cell_km * (1 - self.PROJECTION_ERROR):
+                break
+        return best
+
+
+def load_weather_cities(cur):
+    '''
+    Inserts the cities of COORDINATES missing from weather_city_dim. Does not commit.
+    '''
+    cur.execute(select_weather_cities)
+    loaded = {tuple(row) for row in cur.fetchall()}
+    missing = [(city, state, lat, lon) for (city, state), (lat, lon) in sorted(COORDINATES.items())
+               if (city, state) not in loaded]
+    if missing:
+        insert_rows(cur, weather_city_insert, missing)
+        print('{} weather cities added'.format(len(missing)))
+
+
+def literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return str(value)
+
+
+def insert_rows(cur, insert, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        cur.execute(insert + ', '.join('(' + ', '.join(literal(value) for value in row) + ')'
+                                       for row in rows[start:start + BATCH_SIZE]))
+
+
+def assign_weather_cities(cur):
+    '''
+    Stores the nearest weather city with temperatures of every located store whose nearest city
+    changed. Does not commit. Returns the number of stores updated.
+    '''
+    cur.execute(select_measured_weather_cities)
+    index = GridIndex([(city_id, float(lat), float(lon)) for city_id, lat, lon in cur.fetchall()
+                       if lat is not None and lon is not None])
+    if not index.cells:
+        print('No weather city with temperatures, the stores are not assigned')
+        return 0
+    cur.execute(select_store_locations)
+    changed = {}
+    for store_id, lat, lon, current in cur.fetchall():
+        city_id, distance = index.nearest(float(lat), float(lon))
+        if city_id != current:
+            changed[store_id] = (store_id, city_id, round(distance, 1))
+    if changed:
+        cur.execute(staging_store_weather_clear)
+        insert_rows(cur, staging_store_weather_insert, list(changed.values()))
+        cur.execute(store_dim_weather_update)
+    print('{} store(s) assigned a weather city'.format(len(changed)))
+    return len(changed)